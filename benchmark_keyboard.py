@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Frame budget benchmark of the keyboard. Runs trials on a headless keyboard (see headless.py) with the 5-key, 30-key
+and 42-symbol layouts, and reports the CPU time per frame, the setup time and the memory per key. The null window
+never waits for the vertical blank, so the time between two flips is the CPU time the keyboard spends on a frame.
+
+Usage:
+    python benchmark_keyboard.py
+    python benchmark_keyboard.py -f 120 --atlas --check -o benchmark.json
+"""
+
+import json
+import time
+import tracemalloc
+import numpy as np
+import generate_images
+from codebook import effective_rate
+from stimuli import StimulusProvider
+from speller import Keyboard, get_library, FR, PR, SCREEN_SIZE, SCREEN_WIDTH, SCREEN_DISTANCE, STT_WIDTH, \
+    TEXT_FIELD_HEIGHT
+
+TRIAL_TIME = 4.2
+
+LAYOUTS = {
+    5: [
+        ["W"],
+        ["A", "S", "D"],
+        ["X"]],
+    30: [
+        ["A", "B", "C", "D", "E", "F"],
+        ["G", "H", "I", "J", "K", "L"],
+        ["M", "N", "O", "P", "Q", "R"],
+        ["S", "T", "U", "V", "W", "X"],
+        ["Y", "Z", "_", ".", "question", "!"]],
+    42: [generate_images.keys[i:i + 8] for i in range(0, len(generate_images.keys), 8)],
+}
+
+KEY_COLORS = ["black", "white", "green"]
+
+KEY_SIZE = 3.75  # degrees
+KEY_SPACE = 1.0  # degrees
+
+PERCENTILES = (50, 95, 99)
+
+
+def get_codes(keys, framerate=FR):
+    """
+    Get a code per key, the circular shifts of the m-sequence presented at the framerate for a trial.
+
+    Args:
+        keys (list):
+            The names of the keys
+        framerate (float):
+            The framerate in Hz. Default: FR
+
+    Returns:
+        (dict):
+            The codes, mapping the name of each key to its code
+    """
+    n_frames = int(round(TRIAL_TIME * framerate))
+    codes = get_library().presented("m_sequence_shift_classes=5", framerate, effective_rate(framerate, PR), n_frames,
+                                    stride=1)
+    assert codes.shape[0] >= len(keys), f"Got {codes.shape[0]} codes for {len(keys)} keys"
+    return {key: codes[i].tolist() for i, key in enumerate(keys)}
+
+
+def benchmark_layout(n_keys, atlas=False, n_trials=10, framerate=FR, provider=None):
+    """
+    Benchmark the keyboard with one layout.
+
+    Args:
+        n_keys (int):
+            The number of keys of the layout, one of LAYOUTS
+        atlas (bool):
+            Whether to render the keys from a texture atlas. Default: False
+        n_trials (int):
+            The number of trials to run. Default: 10
+        framerate (float):
+            The framerate in Hz of the headless window, which sets the number of frames of a trial and the frame
+            budget. Default: FR
+        provider (StimulusProvider):
+            The provider of the key textures. If None, a new provider. Default: None
+
+    Returns:
+        (dict):
+            The results
+    """
+    if provider is None:
+        provider = StimulusProvider()
+    rows = LAYOUTS[n_keys]
+    keys = [key for row in rows for key in row]
+    images = {key: provider.get_images(key, KEY_COLORS) for key in keys}
+    budget = 1.0 / framerate
+
+    # Startup: the window and text field
+    tracemalloc.start()
+    start = time.perf_counter()
+    keyboard = Keyboard(size=SCREEN_SIZE, width=SCREEN_WIDTH, distance=SCREEN_DISTANCE, stream=False, atlas=atlas,
+                        headless=True)
+    keyboard.window.framerate = framerate  # the framerate the null window reports, see headless.Window
+    ppd = keyboard.get_pixels_per_degree()
+    keyboard.add_text_field("text", "", (SCREEN_SIZE[0] - STT_WIDTH * ppd, TEXT_FIELD_HEIGHT * ppd),
+                            (STT_WIDTH * ppd, SCREEN_SIZE[1] / 2 - TEXT_FIELD_HEIGHT * ppd / 2))
+    startup = time.perf_counter() - start
+
+    # Setup: the keys, and the memory they take
+    memory = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    for y, row in enumerate(rows):
+        for x, key in enumerate(row):
+            pos = ((x - len(row) / 2 + 0.5) * (KEY_SIZE + KEY_SPACE) * ppd,
+                   -(y - len(rows) / 2) * (KEY_SIZE + KEY_SPACE) * ppd - TEXT_FIELD_HEIGHT * ppd)
+            keyboard.add_key(key, (KEY_SIZE * ppd, KEY_SIZE * ppd), pos, images[key])
+    keyboard.set_keys_auto_draw(True)
+    setup = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0] - memory
+    tracemalloc.stop()
+
+    # Compile the trial plan once, as the first trial of a condition does
+    codes = get_codes(keys, framerate)
+    start = time.perf_counter()
+    keyboard.compile(codes, TRIAL_TIME)
+    compile_time = time.perf_counter() - start
+
+    # Trials
+    intervals = []
+    n_draws = keyboard.window.n_draws
+    n_frames = 0
+    cpu = time.process_time()
+    for i_trial in range(n_trials):
+        keyboard.run(codes, TRIAL_TIME, trial=i_trial)
+        intervals.append(np.diff(keyboard.timer.timestamps[:keyboard.timer.n_frames]))
+        n_frames += keyboard.timer.n_frames + 1  # the trial and the flip that shows the keys again
+    cpu = time.process_time() - cpu
+    n_draws = keyboard.window.n_draws - n_draws
+    intervals = np.concatenate(intervals)
+
+    # Feedback in the text field
+    start = time.perf_counter()
+    for i in range(n_trials):
+        keyboard.set_field_text("text", keys[i % len(keys)] * (i + 1))
+    text_time = (time.perf_counter() - start) / n_trials
+    keyboard.close()
+
+    frame = {f"p{p}": float(np.percentile(intervals, p)) for p in PERCENTILES}
+    frame.update(max=float(intervals.max()), mean=float(intervals.mean()),
+                 over_budget=float(np.mean(intervals > budget)))
+    return dict(n_keys=n_keys, atlas=atlas, framerate=framerate, budget=budget, n_trials=n_trials,
+                startup=startup, setup=setup, setup_per_key=setup / n_keys, memory_per_key=memory / n_keys,
+                compile=compile_time, frame=frame, cpu_per_frame=cpu / n_frames, draws_per_frame=n_draws / n_frames,
+                set_field_text=text_time)
+
+
+def print_results(results):
+    """
+    Print the results of benchmark_layout as a table, times in milliseconds.
+
+    Args:
+        results (list):
+            The results of each layout
+    """
+    header = ["keys", "atlas", "startup", "setup/key", "MB/key", "compile"] + [f"p{p}" for p in PERCENTILES] + \
+        ["max", "budget", ">budget", "draws", "text"]
+    print("\t".join(header))
+    for result in results:
+        frame = result["frame"]
+        row = [result["n_keys"], int(result["atlas"]), 1e3 * result["startup"], 1e3 * result["setup_per_key"],
+               result["memory_per_key"] / 2 ** 20, 1e3 * result["compile"]] + \
+            [1e3 * frame[f"p{p}"] for p in PERCENTILES] + \
+            [1e3 * frame["max"], 1e3 * result["budget"], f"{100 * frame['over_budget']:.1f}%",
+             result["draws_per_frame"], 1e3 * result["set_field_text"]]
+        print("\t".join(f"{value:.3f}" if isinstance(value, float) else str(value) for value in row))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Frame budget benchmark of the keyboard")
+    parser.add_argument("-k", "--keys", type=int, nargs="+", help="layouts by number of keys", default=list(LAYOUTS))
+    parser.add_argument("-n", "--ntrials", type=int, help="number of trials per layout", default=10)
+    parser.add_argument("-f", "--framerate", type=float, help="framerate in Hz of the headless window and frame budget", default=FR)
+    parser.add_argument("--atlas", action="store_true", help="also benchmark rendering from a texture atlas")
+    parser.add_argument("--check", action="store_true", help="fail if the p99 frame time exceeds the budget")
+    parser.add_argument("-o", "--output", type=str, help="file to save the results to as json", default=None)
+    args = parser.parse_args()
+
+    provider = StimulusProvider()
+    results = []
+    for n_keys in args.keys:
+        for atlas in ([False, True] if args.atlas else [False]):
+            results.append(benchmark_layout(n_keys, atlas, args.ntrials, args.framerate, provider))
+    print_results(results)
+
+    if args.output is not None:
+        with open(args.output, "w") as fid:
+            json.dump(results, fid, indent=2)
+
+    if args.check:
+        failed = [result for result in results if result["frame"]["p99"] > result["budget"]]
+        for result in failed:
+            print(f"{result['n_keys']} keys (atlas={result['atlas']}): p99 frame time "
+                  f"{1e3 * result['frame']['p99']:.3f} ms exceeds the budget of {1e3 * result['budget']:.3f} ms")
+        if failed:
+            raise SystemExit(1)
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Library of the code sets in data/codes. All sets are kept in one memory-mapped store with an index, which is
+rebuilt whenever the .npz files change. Derived forms of a set (circular shifts, presented at the framerate,
+bit-packed) are computed once and cached. Also finds the subset of a pool of codes with the lowest maximum pairwise
+circular correlation.
+
+Usage:
+    python codebook.py list
+    python codebook.py optimize mgold_61_6521 -n 30 -o mgold_61_6521_subset_30
+"""
+
+import json
+import os
+import numpy as np
+
+PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "codes")
+
+
+def effective_rate(framerate, pr, tolerance=0.01):
+    """
+    Get the presentation rate at which a code is effectively presented at a framerate. A rate within tolerance of a
+    whole number of frames per bit is snapped to it, e.g., 60 bits/s at 59.94 Hz is presented at 59.94 bits/s, one bit
+    per frame. Other rates are kept, their bits spanning a varying number of frames (see frame_bits).
+
+    Args:
+        framerate (float):
+            The framerate in Hz
+        pr (float):
+            The requested presentation rate in bits per second
+        tolerance (float):
+            The relative difference in frames per bit to snap within. Default: 0.01
+
+    Returns:
+        (float):
+            The effective presentation rate in bits per second
+    """
+    frames_per_bit = framerate / pr
+    n_frames = max(int(round(frames_per_bit)), 1)
+    if abs(frames_per_bit - n_frames) <= tolerance * frames_per_bit:
+        return framerate / n_frames
+    if frames_per_bit < 1:
+        raise Exception(f"Presentation rate {pr} exceeds the framerate {framerate}")
+    return float(pr)
+
+
+def frame_bits(n_frames, framerate, pr):
+    """
+    Get the bit of a code that is presented at each frame, for any ratio of the framerate and the presentation rate.
+    Bit k starts at the first frame at or after k / pr seconds, such that at non-integer ratios the bits alternate
+    between the neighbouring numbers of frames (e.g., 3, 2, 3, 2, 2 frames at 144 Hz and 60 bits/s) without drifting.
+
+    Args:
+        n_frames (int):
+            The number of frames
+        framerate (float):
+            The framerate in Hz
+        pr (float):
+            The presentation rate of the code in bits per second, at most the framerate (see effective_rate)
+
+    Returns:
+        (np.ndarray):
+            The index of the bit at each frame of shape (n_frames)
+    """
+    if pr > framerate:
+        raise Exception(f"Presentation rate {pr} exceeds the framerate {framerate}")
+    # The small offset keeps exact ratios, e.g., 60 / 180, from flooring below the bit boundary
+    return np.floor(np.arange(n_frames) * (pr / framerate) + 1e-9).astype("int64")
+
+
+def load_npz(fn):
+    """
+    Load a code set from an .npz file. Files with "codes" hold (samples, codes), files with "codes_real" hold
+    (codes, samples).
+
+    Args:
+        fn (str):
+            The .npz file
+
+    Returns:
+        (np.ndarray):
+            The codes of shape (codes, samples) of uint8
+    """
+    data = np.load(fn)
+    if "codes_real" in data:
+        codes = data["codes_real"]
+    else:
+        codes = data["codes"].T
+    return np.ascontiguousarray(codes).astype("uint8")
+
+
+class CodeLibrary(object):
+    """
+    Named code sets from one memory-mapped store, with their derived forms cached.
+    """
+
+    def __init__(self, path=PATH):
+        """
+        Open the code library, (re)building its store if the code sets changed.
+
+        Args:
+            path (str):
+                The folder with the code sets as .npz files. Default: PATH
+        """
+        self.path = path
+        self.cache = dict()
+        sources = {fn[:-4]: self._stat(fn) for fn in sorted(os.listdir(path)) if fn.endswith(".npz")}
+        index_file = os.path.join(path, "library.json")
+        index = None
+        if os.path.exists(index_file):
+            with open(index_file, "r") as fid:
+                index = json.load(fid)
+        if index is None or index["sources"] != sources:
+            index = self.build(sources)
+        self.index = index["sets"]
+        self.store = np.load(os.path.join(path, "library.npy"), mmap_mode="r")
+
+    def _stat(self, fn):
+        stat = os.stat(os.path.join(self.path, fn))
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def build(self, sources):
+        """
+        Build the store: all code sets concatenated into one flat array, with an index of their offsets and shapes.
+
+        Args:
+            sources (dict):
+                The names of the code sets and the size and modification time of their files
+
+        Returns:
+            (dict):
+                The index
+        """
+        sets = dict()
+        arrays = []
+        offset = 0
+        for name in sources:
+            codes = load_npz(os.path.join(self.path, f"{name}.npz"))
+            sets[name] = dict(offset=offset, shape=list(codes.shape))
+            arrays.append(codes.ravel())
+            offset += codes.size
+        index = dict(sources=sources, sets=sets)
+
+        # Write to temporary files first, such that readers never see a partial store
+        tmp = f".tmp{os.getpid()}"
+        np.save(os.path.join(self.path, f"library{tmp}.npy"), np.concatenate(arrays) if arrays else np.zeros(0, "uint8"))
+        with open(os.path.join(self.path, f"library{tmp}.json"), "w") as fid:
+            json.dump(index, fid)
+        os.replace(os.path.join(self.path, f"library{tmp}.npy"), os.path.join(self.path, "library.npy"))
+        os.replace(os.path.join(self.path, f"library{tmp}.json"), os.path.join(self.path, "library.json"))
+        return index
+
+    def names(self):
+        """
+        Get the names of the code sets.
+
+        Returns:
+            (list):
+                The names
+        """
+        return list(self.index.keys())
+
+    def get(self, name):
+        """
+        Get a code set.
+
+        Args:
+            name (str):
+                The name of the code set, i.e., the name of its .npz file
+
+        Returns:
+            (np.ndarray):
+                The read-only codes of shape (codes, samples)
+        """
+        if name not in self.index:
+            raise Exception("Unknown code set:", name)
+        item = self.index[name]
+        size = int(np.prod(item["shape"]))
+        return self.store[item["offset"]:item["offset"] + size].reshape(item["shape"])
+
+    def _cached(self, key, make):
+        if key not in self.cache:
+            self.cache[key] = make()
+        return self.cache[key]
+
+    def shifted(self, name, stride, i_code=0):
+        """
+        Get the circular shifts of one code of a set, as pyntbci.stimulus.shift.
+
+        Args:
+            name (str):
+                The name of the code set
+            stride (int):
+                The shift in samples between consecutive codes
+            i_code (int):
+                The index of the code to shift. Default: 0
+
+        Returns:
+            (np.ndarray):
+                The codes of shape (samples // stride, samples)
+        """
+        def make():
+            code = np.asarray(self.get(name)[i_code])
+            idx = (np.arange(code.size)[np.newaxis, :] - np.arange(0, code.size, stride)[:, np.newaxis]) % code.size
+            return code[idx]
+        return self._cached(("shifted", name, stride, i_code), make)
+
+    def repeated(self, name, factor, stride=None):
+        """
+        Get a code set with each sample repeated, e.g., FR / PR times to present it at the framerate.
+
+        Args:
+            name (str):
+                The name of the code set
+            factor (int):
+                The number of times each sample is repeated
+            stride (int):
+                If given, the circular shifts of the first code instead (see shifted). Default: None
+
+        Returns:
+            (np.ndarray):
+                The codes of shape (codes, samples * factor)
+        """
+        def make():
+            codes = self.get(name) if stride is None else self.shifted(name, stride)
+            return np.repeat(codes, factor, axis=1)
+        return self._cached(("repeated", name, factor, stride), make)
+
+    def presented(self, name, framerate, pr, n_frames, stride=None):
+        """
+        Get a code set as presented at the framerate, i.e., the bit shown at each frame (see frame_bits). The code is
+        repeated as needed, the bits continuing over the cycles even if a cycle is not a whole number of frames.
+
+        Args:
+            name (str):
+                The name of the code set
+            framerate (float):
+                The framerate in Hz
+            pr (float):
+                The presentation rate of the codes in bits per second
+            n_frames (int):
+                The number of frames
+            stride (int):
+                If given, the circular shifts of the first code instead (see shifted). Default: None
+
+        Returns:
+            (np.ndarray):
+                The codes of shape (codes, n_frames)
+        """
+        def make():
+            codes = self.get(name) if stride is None else self.shifted(name, stride)
+            return np.asarray(codes)[:, frame_bits(n_frames, framerate, pr) % codes.shape[1]]
+        return self._cached(("presented", name, framerate, pr, n_frames, stride), make)
+
+    def packed(self, name):
+        """
+        Get a binary code set bit-packed along samples.
+
+        Args:
+            name (str):
+                The name of the code set
+
+        Returns:
+            (np.ndarray):
+                The packed codes of shape (codes, ceil(samples / 8)) of uint8
+        """
+        return self._cached(("packed", name), lambda: np.packbits(self.get(name), axis=1))
+
+    def save(self, name, codes):
+        """
+        Add a code set to the library, saved as data/codes/{name}.npz with "codes" of shape (samples, codes).
+
+        Args:
+            name (str):
+                The name of the code set
+            codes (np.ndarray):
+                The codes of shape (codes, samples)
+        """
+        np.savez(os.path.join(self.path, f"{name}.npz"), codes=np.asarray(codes).astype("uint8").T)
+        self.__init__(self.path)
+
+
+def circular_correlation(codes, block_size=64):
+    """
+    Compute the maximum circular correlation over all lags of all pairs of codes, with FFTs over blocks of pairs.
+    The maximum over all lags is symmetric in the pair, so only one triangle is computed.
+
+    Args:
+        codes (np.ndarray):
+            The codes of shape (codes, samples)
+        block_size (int):
+            The number of codes correlated with all others at once. Default: 64
+
+    Returns:
+        (np.ndarray):
+            The maximum correlation of each pair of shape (codes, codes). The diagonal is the maximum over all lags
+            but lag 0
+    """
+    from scipy import fft
+    codes = np.asarray(codes, dtype="float32")
+    codes = codes - codes.mean(axis=1, keepdims=True)
+    codes /= np.maximum(np.linalg.norm(codes, axis=1, keepdims=True), 1e-12)
+    n_codes, n_samples = codes.shape
+    F = fft.rfft(codes, axis=1)
+    M = np.zeros((n_codes, n_codes), dtype="float32")
+    for start in range(0, n_codes, block_size):
+        stop = min(start + block_size, n_codes)
+        R = fft.irfft(F[start:stop, np.newaxis, :] * np.conj(F[np.newaxis, start:, :]), n=n_samples, axis=2,
+                      workers=-1)
+        idx = np.arange(stop - start)
+        R[idx, idx, 0] = -np.inf  # a code with itself at lag 0
+        M[start:stop, start:] = R.max(axis=2)
+        M[start:, start:stop] = M[start:stop, start:].T
+    return M
+
+
+def optimize_subset(codes, n_codes, n_iterations=100):
+    """
+    Find a subset of codes with a low maximum pairwise circular correlation: a greedy selection, improved by
+    swapping codes in and out of the subset while that lowers the maximum (or, at an equal maximum, the mean).
+
+    Args:
+        codes (np.ndarray):
+            The pool of codes of shape (codes, samples)
+        n_codes (int):
+            The number of codes in the subset
+        n_iterations (int):
+            The maximum number of rounds of swaps. Default: 100
+
+    Returns:
+        (tuple):
+            The indexes of the subset in the pool of shape (n_codes), and its maximum pairwise correlation
+    """
+    M = circular_correlation(codes)
+    n_pool = M.shape[0]
+    assert n_codes <= n_pool, f"Cannot select {n_codes} codes from a pool of {n_pool}"
+    off = M.copy()
+    np.fill_diagonal(off, -np.inf)
+
+    # Greedy: start from the least correlated pair, add the code with the lowest maximum to the subset
+    pairs = M.copy()
+    np.fill_diagonal(pairs, np.inf)
+    i, j = np.unravel_index(np.argmin(pairs), pairs.shape)
+    subset = [i, j][:n_codes]
+    worst = np.maximum(off[:, i], off[:, j])
+    worst[subset] = np.inf
+    while len(subset) < n_codes:
+        k = int(np.argmin(worst))
+        subset.append(k)
+        worst = np.maximum(worst, off[:, k])
+        worst[subset] = np.inf
+    subset = np.array(subset)
+
+    def cost(s):
+        S = off[np.ix_(s, s)]
+        return S.max(), S[np.isfinite(S)].mean()
+
+    # Swaps: replace the member involved in the worst pair by the best outsider
+    best = cost(subset)
+    for _ in range(n_iterations):
+        S = off[np.ix_(subset, subset)]
+        improved = False
+        for member in np.argsort(-S.max(axis=1)):
+            others = np.delete(subset, member)
+            outside = np.setdiff1d(np.arange(n_pool), subset)
+            candidates = off[np.ix_(outside, others)].max(axis=1)
+            candidate = subset.copy()
+            candidate[member] = outside[np.argmin(candidates)]
+            value = cost(candidate)
+            if value < best:
+                subset, best, improved = candidate, value, True
+                break
+        if not improved:
+            break
+    return subset, float(best[0])
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Code set library")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="list the code sets")
+    optimize = subparsers.add_parser("optimize", help="select a subset of a code set")
+    optimize.add_argument("pool", type=str, help="code set to select from")
+    optimize.add_argument("-n", "--ncodes", type=int, help="number of codes", required=True)
+    optimize.add_argument("-o", "--output", type=str, help="name of the new code set", default=None)
+    args = parser.parse_args()
+
+    library = CodeLibrary()
+    if args.command == "list":
+        for name in library.names():
+            print(f"{name}\t{library.get(name).shape}")
+    elif args.command == "optimize":
+        subset, value = optimize_subset(library.get(args.pool), args.ncodes)
+        print(f"Subset of {args.pool}: {subset.tolist()}")
+        print(f"Maximum circular correlation: {value:.3f}")
+        if args.output is not None:
+            library.save(args.output, library.get(args.pool)[subset])
@@ -0,0 +1,134 @@
+"""
+Throughput and accuracy benchmark of the decoding on synthetic data (see synthetic.py). Times fitting eCCA,
+predicting with it and the leave-one-out cross-validation of decode(), and reports the cross-validated accuracy,
+while varying the number of trials, channels and classes and the trial length, one at a time from a base setup.
+
+Usage:
+    python benchmark_decoding.py
+    python benchmark_decoding.py --sweep classes length --repeats 5 -o benchmark.json
+"""
+
+import json
+import time
+import numpy as np
+import pyntbci
+from synthetic import FS, PR, load_codes, shift_codes, make_labels, make_data
+from crossvalidation import loo_ecca
+
+BASE = dict(n_trials=60, n_channels=64, n_classes=30, trial_time=4.2)
+
+SWEEPS = dict(
+    trials=("n_trials", [30, 60, 120, 240]),
+    channels=("n_channels", [8, 16, 32, 64]),
+    classes=("n_classes", [5, 30, 63]),
+    length=("trial_time", [2.1, 4.2, 8.4]),
+)
+
+
+def get_setups(sweeps=SWEEPS, base=BASE):
+    """
+    Get the setups of the sweeps: the base setup with one parameter changed at a time. Duplicates are run once.
+
+    Args:
+        sweeps (dict):
+            The sweeps, mapping their name to the parameter and its values. Default: SWEEPS
+        base (dict):
+            The base setup. Default: BASE
+
+    Returns:
+        (list):
+            The setups
+    """
+    setups = []
+    for parameter, values in sweeps.values():
+        for value in values:
+            setup = dict(base, **{parameter: value})
+            if setup not in setups:
+                setups.append(setup)
+    return setups
+
+
+def benchmark_setup(n_trials, n_channels, n_classes, trial_time, snr=0.05, repeats=3, seed=0):
+    """
+    Benchmark the decoding of one setup.
+
+    Args:
+        n_trials (int):
+            The number of trials
+        n_channels (int):
+            The number of channels
+        n_classes (int):
+            The number of classes, shifts of the m-sequence
+        trial_time (float):
+            The duration of a trial in seconds
+        snr (float):
+            The signal to noise ratio of the data (see synthetic.make_data). Default: 0.05
+        repeats (int):
+            The number of times each step is timed, of which the fastest is reported. Default: 3
+        seed (int):
+            The seed of the data. Default: 0
+
+    Returns:
+        (dict):
+            The results, times in seconds
+    """
+    code = load_codes("m_sequence_shift_classes=5", FS, PR)[0]
+    V, stride = shift_codes(code, n_classes)
+    lags = np.arange(n_classes) * stride / FS
+    cycle_size = V.shape[1] / FS
+    y = make_labels(n_trials, n_classes, seed=seed)
+    X = make_data(V, y, FS, n_channels, trial_time, snr=snr, seed=seed).astype("float64")  # as loo_ecca casts
+
+    def best(function):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            value = function()
+            times.append(time.perf_counter() - start)
+        return min(times), value
+
+    fit, model = best(lambda: pyntbci.classifiers.eCCA(lags, FS, cycle_size).fit(X, y))
+    predict, _ = best(lambda: model.predict(X))
+    loo, yh = best(lambda: loo_ecca(X, y, lags, FS, cycle_size))
+    return dict(n_trials=n_trials, n_channels=n_channels, n_classes=n_classes, trial_time=trial_time, fit=fit,
+                predict_per_trial=predict / n_trials, loo=loo, loo_per_fold=loo / n_trials,
+                accuracy=float(np.mean(yh == y)))
+
+
+def print_results(results, header=True):
+    """
+    Print the results of benchmark_setup as a table, times in milliseconds.
+
+    Args:
+        results (list):
+            The results of each setup
+        header (bool):
+            Whether to print the header of the table. Default: True
+    """
+    if header:
+        print("trials\tchannels\tclasses\tlength\tfit\tpredict/trial\tloo\tloo/fold\taccuracy")
+    for result in results:
+        print(f"{result['n_trials']}\t{result['n_channels']}\t{result['n_classes']}\t{result['trial_time']}\t"
+              f"{1e3 * result['fit']:.2f}\t{1e3 * result['predict_per_trial']:.3f}\t{1e3 * result['loo']:.2f}\t"
+              f"{1e3 * result['loo_per_fold']:.3f}\t{result['accuracy']:.3f}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Decoding benchmark on synthetic data")
+    parser.add_argument("-s", "--sweep", type=str, nargs="+", help="sweeps to run", choices=list(SWEEPS),
+                        default=list(SWEEPS))
+    parser.add_argument("-r", "--repeats", type=int, help="number of timings per step", default=3)
+    parser.add_argument("--snr", type=float, help="signal to noise ratio", default=0.05)
+    parser.add_argument("--seed", type=int, help="seed of the data", default=0)
+    parser.add_argument("-o", "--output", type=str, help="file to save the results to as json", default=None)
+    args = parser.parse_args()
+
+    results = []
+    for setup in get_setups({name: SWEEPS[name] for name in args.sweep}):
+        results.append(benchmark_setup(**setup, snr=args.snr, repeats=args.repeats, seed=args.seed))
+        print_results(results[-1:], header=len(results) == 1)
+
+    if args.output is not None:
+        with open(args.output, "w") as fid:
+            json.dump(results, fid, indent=2)
@@ -0,0 +1,223 @@
+"""
+Fast leave-one-out cross-validation of eCCA. Instead of refitting pyntbci.classifiers.eCCA on all but one trial for
+each fold, the statistics that eCCA is fit from (the latency-corrected template and the covariance of the data and
+templates) are accumulated once over all trials, and each fold's model is derived by subtracting the contribution
+of its held-out trial.
+
+It covers the eCCA setup of decode(): lags given, mean templates, correlation scores, one component, no ensemble and
+no regularization. N.B. without regularization, the covariances must be invertible. eCCA.fit raises a LinAlgError
+only where the inversion fails numerically, here a fold raises a LinAlgError as soon as the condition number of a
+covariance exceeds MAX_CONDITION (e.g., rank-deficient, re-referenced or band-limited data), instead of predicting
+from a near-singular inverse. Below it, the predictions are those of eCCA.
+"""
+
+import numpy as np
+
+MAX_CONDITION = 1e12  # the maximum condition number of the covariances
+
+
+def _inv_sqrt(M, name, max_condition=MAX_CONDITION):
+    # The inverse square root of a symmetric positive definite matrix, raising if it is (nearly) singular
+    w, V = np.linalg.eigh(M)
+    if w.min() <= 0 or w.max() / w.min() > max_condition:
+        condition = np.inf if w.min() <= 0 else w.max() / w.min()
+        raise np.linalg.LinAlgError(f"The covariance of {name} of shape {M.shape} is ill-conditioned (condition "
+                                    f"number {condition:.3g}), e.g., the data is rank-deficient")
+    return (V / np.sqrt(w)) @ V.T
+
+
+def _cut_cycles(X, n_cycle):
+    n_trials, n_channels, n_samples = X.shape
+    n_cycles = int(n_samples / n_cycle)
+    X = X[:, :, :n_cycles * n_cycle].reshape((n_trials, n_channels, n_cycles, n_cycle))
+    return X.transpose((0, 2, 1, 3))  # trials cycles channels samples
+
+
+def get_statistics(X, y, shifts, n_cycle):
+    """
+    Compute the per-trial contributions to the eCCA fit.
+
+    Args:
+        X (np.ndarray):
+            The trials of shape (trials, channels, samples)
+        y (np.ndarray):
+            The labels of shape (trials)
+        shifts (np.ndarray):
+            The latency of each class in samples of shape (classes)
+        n_cycle (int):
+            The number of samples of one code cycle
+
+    Returns:
+        (tuple):
+            Per trial the sum of its latency-corrected cycles of shape (trials, channels, n_cycle), the sum of its
+            samples of shape (trials, channels) and the sum of its outer products of shape (trials, channels,
+            channels), and the number of cycles per trial
+    """
+    C = _cut_cycles(X, n_cycle)
+    n_cycles = C.shape[1]
+    Z = np.zeros((X.shape[0], X.shape[1], n_cycle))
+    for i_trial in range(X.shape[0]):
+        Z[i_trial] = np.roll(C[i_trial].sum(axis=0), -shifts[y[i_trial]], axis=-1)
+    S = C.sum(axis=(1, 3))
+    C = C.transpose((0, 2, 1, 3)).reshape((X.shape[0], X.shape[1], -1))
+    G = C @ C.transpose((0, 2, 1))
+    return Z, S, G, n_cycles
+
+
+def fit_filter(Z, S, G, n_cycles):
+    """
+    Fit the spatial filter and template of eCCA from accumulated statistics, as eCCA.fit does from the trials. Raises
+    a LinAlgError if the covariance of the data or templates is ill-conditioned (see MAX_CONDITION).
+
+    Args:
+        Z (np.ndarray):
+            The sum of the latency-corrected cycles of shape (channels, n_cycle)
+        S (np.ndarray):
+            The sum of the samples of shape (channels)
+        G (np.ndarray):
+            The sum of the outer products of the samples of shape (channels, channels)
+        n_cycles (int):
+            The number of cycles the sums are over
+
+    Returns:
+        (tuple):
+            The spatial filter of shape (channels) and the spatially filtered template at latency 0 of shape
+            (n_cycle)
+    """
+    n = n_cycles * Z.shape[1]
+    B = Z / n_cycles  # template at latency 0
+
+    # Covariance of the data (X) and templates (Y), each template being a circular shift of B
+    avg_x = S / n
+    avg_y = B.mean(axis=1)
+    BB = n_cycles * (B @ B.T)
+    Cxx = (G - n * np.outer(avg_x, avg_x)) / (n - 1)
+    Cyy = (BB - n * np.outer(avg_y, avg_y)) / (n - 1)
+    Cxy = (BB - n * np.outer(avg_x, avg_y)) / (n - 1)
+
+    # CCA
+    iCxx = _inv_sqrt(Cxx, "X")
+    iCyy = _inv_sqrt(Cyy, "Y")
+    U, _, _ = np.linalg.svd(iCxx @ Cxy @ iCyy)
+    w = iCxx @ U[:, 0]
+    return w, w @ (B - avg_x[:, np.newaxis])
+
+
+def loo_ecca(X, y, lags, fs, cycle_size=None, return_scores=False, statistics=None):
+    """
+    Leave-one-out cross-validation of eCCA, giving the same predictions as fitting
+    pyntbci.classifiers.eCCA(lags, fs, cycle_size) on all but one trial and predicting that trial, for each trial.
+    Unlike eCCA, a fold whose covariances are ill-conditioned raises a LinAlgError (see MAX_CONDITION).
+
+    Args:
+        X (np.ndarray):
+            The trials of shape (trials, channels, samples)
+        y (np.ndarray):
+            The labels of shape (trials)
+        lags (np.ndarray):
+            The latency in seconds of each class relative to the first
+        fs (int):
+            The sampling frequency
+        cycle_size (float):
+            The duration of one code cycle in seconds. If None, the full trial. Default: None
+        return_scores (bool):
+            Whether to return the scores as well. Default: False
+        statistics (tuple):
+            The per-trial contributions of X (see get_statistics), e.g., of a superset of the channels indexed to
+            those of X. If None, they are computed. Default: None
+
+    Returns:
+        (np.ndarray):
+            The predicted label of each held-out trial of shape (trials), and if return_scores the correlation of
+            each held-out trial with each class of shape (trials, classes)
+    """
+    X = np.asarray(X, dtype="float64")
+    y = np.asarray(y).astype("int")
+    n_trials, n_channels, n_samples = X.shape
+    n_cycle = n_samples if cycle_size is None else int(cycle_size * fs)
+    shifts = np.array([int(np.round(lag * fs)) for lag in lags])
+
+    # Accumulate once
+    Z, S, G, n_cycles = get_statistics(X, y, shifts, n_cycle) if statistics is None else statistics
+    Z_all, S_all, G_all = Z.sum(axis=0), S.sum(axis=0), G.sum(axis=0)
+
+    # Index of each class's template sample at each trial sample
+    idx = (np.arange(n_samples)[np.newaxis, :] - shifts[:, np.newaxis]) % n_cycle
+
+    scores = np.zeros((n_trials, len(lags)))
+    for i_trial in range(n_trials):
+        # Downdate: remove the held-out trial
+        w, t = fit_filter(Z_all - Z[i_trial], S_all - S[i_trial], G_all - G[i_trial], (n_trials - 1) * n_cycles)
+
+        # Correlate the held-out trial with the templates of all classes
+        T = t[idx]
+        T -= T.mean(axis=1, keepdims=True)
+        x = w @ X[i_trial]
+        x -= x.mean()
+        scores[i_trial] = T @ x / np.sqrt((T ** 2).sum(axis=1) * (x ** 2).sum())
+
+    yh = np.argmax(scores, axis=1)
+    if return_scores:
+        return yh, scores
+    return yh
+
+
+def loo_ecca_curve(X, y, lags, fs, cycle_size=None, windows=None):
+    """
+    Leave-one-out cross-validation of eCCA over a range of decoding windows. Each fold's eCCA is fit on the full
+    trials (see loo_ecca), and the held-out trial is classified on each prefix of itself, as when decoding stops
+    after that window. The correlations of all prefixes follow from cumulative sums over the samples, such that each
+    longer window only adds its new samples.
+
+    Args:
+        X (np.ndarray):
+            The trials of shape (trials, channels, samples)
+        y (np.ndarray):
+            The labels of shape (trials)
+        lags (np.ndarray):
+            The latency in seconds of each class relative to the first
+        fs (int):
+            The sampling frequency
+        cycle_size (float):
+            The duration of one code cycle in seconds. If None, the full trial. Default: None
+        windows (np.ndarray):
+            The decoding windows in seconds. If None, every sample up to the full trial. Default: None
+
+    Returns:
+        (np.ndarray):
+            The predicted label of each held-out trial for each window of shape (trials, windows)
+    """
+    X = np.asarray(X, dtype="float64")
+    y = np.asarray(y).astype("int")
+    n_trials, n_channels, n_samples = X.shape
+    n_cycle = n_samples if cycle_size is None else int(cycle_size * fs)
+    shifts = np.array([int(np.round(lag * fs)) for lag in lags])
+    if windows is None:
+        lengths = np.arange(2, n_samples + 1)
+    else:
+        lengths = np.array([int(np.round(window * fs)) for window in windows])
+    assert lengths.min() >= 2 and lengths.max() <= n_samples, "The windows must be 2 samples up to the trial length"
+
+    # Accumulate once
+    Z, S, G, n_cycles = get_statistics(X, y, shifts, n_cycle)
+    Z_all, S_all, G_all = Z.sum(axis=0), S.sum(axis=0), G.sum(axis=0)
+    idx = (np.arange(n_samples)[np.newaxis, :] - shifts[:, np.newaxis]) % n_cycle
+
+    yh = np.zeros((n_trials, lengths.size), dtype="int")
+    for i_trial in range(n_trials):
+        w, t = fit_filter(Z_all - Z[i_trial], S_all - S[i_trial], G_all - G[i_trial], (n_trials - 1) * n_cycles)
+        T = t[idx]
+        x = w @ X[i_trial]
+
+        # Cumulative sums over the samples, read out at the end of each window
+        Sx = np.cumsum(x)[lengths - 1]
+        Sxx = np.cumsum(x ** 2)[lengths - 1]
+        ST = np.cumsum(T, axis=1)[:, lengths - 1]
+        STT = np.cumsum(T ** 2, axis=1)[:, lengths - 1]
+        SxT = np.cumsum(T * x, axis=1)[:, lengths - 1]
+
+        # Correlation of each window: the covariance and variances of the demeaned window
+        cov = SxT - Sx * ST / lengths
+        var = (STT - ST ** 2 / lengths) * (Sxx - Sx ** 2 / lengths)
+        yh[i_trial] = np.argmax(cov / np.sqrt(var), axis=0)
+    return yh
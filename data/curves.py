@@ -0,0 +1,123 @@
+"""
+Decoding curves: the cross-validated accuracy and ITR as a function of the decoding window, for each subject and
+condition. Each curve is computed in one pass over the trials (see crossvalidation.loo_ecca_curve), and the subjects
+and conditions are spread over processes.
+
+Usage:
+    python curves.py 01 02 03 04 --data-dir ~/ideaProjects/programming/BCI/Thesis/steven/steven -o curves.npz
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pyntbci
+from derivatives import load_derivative
+from crossvalidation import loo_ecca_curve
+
+CONDITIONS = ["classes=5_bw", "classes=5_grating", "classes=30_bw", "classes=30_grating"]
+
+WINDOWS = np.round(np.arange(1, 43) * 0.1, 1)  # 0.1 to 4.2 seconds
+
+PR = 60  # presentation rate of the codes
+INTERTRIAL_TIME = 0.8  # ITI in seconds for computing ITR
+
+
+def decoding_curve(data_dir, subject, condition, windows=WINDOWS, intertrial_time=INTERTRIAL_TIME):
+    """
+    Compute the decoding curve of one subject and condition.
+
+    Args:
+        data_dir (str):
+            The data directory
+        subject (str):
+            The subject, e.g., "01"
+        condition (str):
+            The condition, e.g., "classes=30_bw"
+        windows (np.ndarray):
+            The decoding windows in seconds. Default: WINDOWS
+        intertrial_time (float):
+            The time between trials in seconds, added to the window for the ITR. Default: INTERTRIAL_TIME
+
+    Returns:
+        (tuple):
+            The accuracy and the ITR in bits per minute for each window of shape (windows)
+    """
+    derivative = load_derivative(data_dir, subject, condition)
+    fs = derivative.fs
+    y = np.array(derivative.y)
+    V = np.array(derivative.V)
+    if V.shape[0] == 31:  # the 30-class set has a spare code
+        V = V[:-1]
+    n_classes = V.shape[0]
+
+    # The codes are shifts of one code by an equal number of bits
+    n_bits = int(V.shape[1] * PR / fs)
+    lags = np.arange(n_classes) * ((n_bits // n_classes) / PR)
+    cycle_size = V.shape[1] / fs
+
+    X = derivative.get_data(tmax=max(windows))
+    yh = loo_ecca_curve(X, y, lags, fs, cycle_size, windows)
+    accuracy = np.mean(yh == y[:, np.newaxis], axis=0)
+    itr = pyntbci.utilities.itr(n_classes, accuracy, np.asarray(windows) + intertrial_time)
+    return accuracy, itr
+
+
+def _decoding_curve(args):
+    return decoding_curve(*args)
+
+
+def decoding_curves(data_dir, subjects, conditions=CONDITIONS, windows=WINDOWS, intertrial_time=INTERTRIAL_TIME,
+                    n_workers=None):
+    """
+    Compute the decoding curves of all subjects and conditions in parallel.
+
+    Args:
+        data_dir (str):
+            The data directory
+        subjects (list):
+            The subjects, e.g., ["01", "02"]
+        conditions (list):
+            The conditions. Default: CONDITIONS
+        windows (np.ndarray):
+            The decoding windows in seconds. Default: WINDOWS
+        intertrial_time (float):
+            The time between trials in seconds, added to the window for the ITR. Default: INTERTRIAL_TIME
+        n_workers (int):
+            The maximum number of worker processes. If None, the number of CPUs. Default: None
+
+    Returns:
+        (dict):
+            The accuracy and ITR of shape (subjects, conditions, windows), and the subjects, conditions and windows
+    """
+    items = [(data_dir, subject, condition, windows, intertrial_time)
+             for subject in subjects for condition in conditions]
+    if n_workers == 1:
+        results = list(map(_decoding_curve, items))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(_decoding_curve, items))
+    shape = (len(subjects), len(conditions), len(windows))
+    return dict(
+        accuracy=np.array([accuracy for accuracy, _ in results]).reshape(shape),
+        itr=np.array([itr for _, itr in results]).reshape(shape),
+        subjects=np.array(subjects), conditions=np.array(conditions), windows=np.asarray(windows))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Decoding curves of accuracy and ITR over decoding windows")
+    parser.add_argument("subjects", type=str, nargs="+", help="subjects, e.g., 01 02")
+    parser.add_argument("-d", "--data-dir", type=str, help="data directory",
+                        default=os.path.join(os.path.expanduser("~"), "ideaProjects", "programming", "BCI", "Thesis", "steven", "steven"))
+    parser.add_argument("-w", "--workers", type=int, help="maximum number of worker processes", default=None)
+    parser.add_argument("-o", "--output", type=str, help="file to save the curves to", default="curves.npz")
+    args = parser.parse_args()
+
+    curves = decoding_curves(args.data_dir, args.subjects, n_workers=args.workers)
+    np.savez(args.output, **curves)
+    for i_condition, condition in enumerate(curves["conditions"]):
+        accuracy = curves["accuracy"][:, i_condition, :].mean(axis=0)
+        itr = curves["itr"][:, i_condition, :].mean(axis=0)
+        best = np.argmax(itr)
+        print(f"{condition}: accuracy {accuracy[-1]:.3f} at {curves['windows'][-1]} s, "
+              f"maximum ITR {itr[best]:.1f} bits/min at {curves['windows'][best]} s")
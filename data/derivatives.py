@@ -0,0 +1,170 @@
+"""
+Memory-mapped store of the preprocessed data. Each derivative is a folder with one .npy file per array and a small
+metadata header (info.json). The .npy files are raw, aligned arrays, so readers get lazy memory-mapped views and
+slicing a subset of channels or samples reads only those bytes.
+"""
+
+import json
+import os
+import shutil
+import numpy as np
+
+CAPFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "biosemi64.loc")
+
+ARRAYS = ("X", "y", "V")
+
+
+def read_channels(capfile=CAPFILE):
+    """
+    Read the channel labels from a cap file.
+
+    Args:
+        capfile (str):
+            The cap file with the label in the last tab-separated field of each line. Default: CAPFILE
+
+    Returns:
+        (list):
+            The channel labels
+    """
+    with open(capfile, "r") as fid:
+        return [line.split("\t")[-1].strip() for line in fid.readlines() if line.strip()]
+
+
+def get_path(data_dir, subject, condition):
+    """
+    Get the folder of a derivative.
+
+    Args:
+        data_dir (str):
+            The data directory
+        subject (str):
+            The subject, e.g., "01"
+        condition (str):
+            The condition, e.g., "classes=30_bw"
+
+    Returns:
+        (str):
+            The folder of the derivative
+    """
+    return os.path.join(data_dir, "derivatives", subject, f"{subject}_cvep_{condition}")
+
+
+class Derivative(object):
+    """
+    A derivative: the trials X (trials channels samples), labels y (trials) and codes V (classes samples) as
+    read-only memory-mapped arrays, and its metadata.
+    """
+
+    def __init__(self, path):
+        """
+        Open a derivative. No data is read until it is accessed.
+
+        Args:
+            path (str):
+                The folder of the derivative, as written by save_derivative
+        """
+        self.path = path
+        with open(os.path.join(path, "info.json"), "r") as fid:
+            self.info = json.load(fid)
+        self.fs = self.info["fs"]
+        self.condition = self.info["condition"]
+        self.codename = self.info["codename"]
+        self.channels = self.info["channels"]
+        self.signature = self.info.get("signature")
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r"))
+
+    def get_data(self, channels=None, tmin=0, tmax=None, trials=None):
+        """
+        Get (part of) the trials. Only the requested bytes are read from disk.
+
+        Args:
+            channels (list):
+                The labels of the channels. If None, all channels. Default: None
+            tmin (float):
+                The start of the time window in seconds. Default: 0
+            tmax (float):
+                The end of the time window in seconds. If None, the end of the trials. Default: None
+            trials (array-like):
+                The indexes or boolean mask of the trials. If None, all trials. Default: None
+
+        Returns:
+            (np.ndarray):
+                The data of shape (trials, channels, samples)
+        """
+        X = self.X if trials is None else self.X[trials]
+        start = int(round(tmin * self.fs))
+        stop = None if tmax is None else int(round(tmax * self.fs))
+        X = X[:, :, start:stop]
+        if channels is not None:
+            X = X[:, [self.channels.index(channel) for channel in channels], :]
+        return X
+
+
+def save_derivative(path, X, y, V, fs, condition, codename, channels=None, signature=None):
+    """
+    Save a derivative atomically: it is written to a temporary folder that then replaces the derivative.
+
+    Args:
+        path (str):
+            The folder of the derivative (see get_path)
+        X (np.ndarray):
+            The trials of shape (trials, channels, samples)
+        y (np.ndarray):
+            The labels of shape (trials)
+        V (np.ndarray):
+            The codes of shape (classes, samples)
+        fs (int):
+            The sampling frequency
+        condition (str):
+            The condition, e.g., "classes=30_bw"
+        codename (str):
+            The name of the codes, e.g., "m_sequence_shift_classes=30"
+        channels (list):
+            The channel labels. If None, read from CAPFILE. Default: None
+        signature (str):
+            The signature of the inputs and parameters the derivative was made from. Default: None
+
+    Returns:
+        (Derivative):
+            The derivative
+    """
+    if channels is None:
+        channels = read_channels()
+    assert len(channels) == X.shape[1], f"Got {len(channels)} channel labels for {X.shape[1]} channels"
+
+    tmp = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp, exist_ok=True)
+    for name, array in zip(ARRAYS, (X, y, V)):
+        np.save(os.path.join(tmp, f"{name}.npy"), np.ascontiguousarray(array))
+    info = dict(fs=int(fs), condition=condition, codename=codename, channels=list(channels), signature=signature,
+                shapes={name: list(array.shape) for name, array in zip(ARRAYS, (X, y, V))})
+    with open(os.path.join(tmp, "info.json"), "w") as fid:
+        json.dump(info, fid)
+
+    # Swap the folders, such that readers never see a partial derivative
+    old = f"{path}.old{os.getpid()}"
+    if os.path.exists(path):
+        os.rename(path, old)
+    os.rename(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
+    return Derivative(path)
+
+
+def load_derivative(data_dir, subject, condition):
+    """
+    Load a derivative as memory-mapped arrays.
+
+    Args:
+        data_dir (str):
+            The data directory
+        subject (str):
+            The subject, e.g., "01"
+        condition (str):
+            The condition, e.g., "classes=30_bw"
+
+    Returns:
+        (Derivative):
+            The derivative
+    """
+    return Derivative(get_path(data_dir, subject, condition))
@@ -0,0 +1,228 @@
+"""
+Event index of the keyboard marker streams. A marker stream is parsed once into a table of events (a NumPy
+structured array with one column per field), which is cached next to the recording. Queries on the table are
+vectorized: selecting events by type, pairing start and stop events, and the windows and labels of trials.
+
+Usage:
+    index = load_events(recording, "KeyboardMarkerStream1")
+    trials = index.pairs("start_trial", "stop_trial")
+    trials["duration"], index.labels(), index.conditions[0]["classes"]
+"""
+
+import json
+import os
+import shutil
+import numpy as np
+
+# The event types of the keyboard (see speller.py), other markers are of type "other"
+TYPES = ("condition", "start_run", "stop_run", "start_cue", "stop_cue", "start_trial", "stop_trial", "timing_trial",
+         "code_table", "codes", "other")
+
+DTYPE = np.dtype([
+    ("type", "u1"),  # index in TYPES
+    ("time", "f8"),  # time stamp in seconds
+    ("block", "i2"),  # the number of condition markers before the event, i.e., the condition it belongs to
+    ("trial", "i4"),  # -1 if none
+    ("target", "i4"),  # -1 if none
+    ("key", "U16"),  # "" if none
+    ("elapsed", "f8"),  # the elapsed time of an early stopped trial, NaN if none
+    ("index", "i4"),  # the index of the marker in the stream
+])
+
+PAIR_DTYPE = np.dtype([("block", "i2"), ("trial", "i4"), ("target", "i4"), ("key", "U16"), ("start", "f8"),
+                       ("stop", "f8"), ("duration", "f8")])
+
+VERSION = 1  # the version of the table, part of the name of cached tables
+
+
+def _parse_value(value):
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+class EventIndex(object):
+    """
+    The events of a marker stream, and the metadata of the conditions in it.
+    """
+
+    def __init__(self, events, conditions):
+        """
+        Create an event index.
+
+        Args:
+            events (np.ndarray):
+                The events as a structured array of DTYPE
+            conditions (list):
+                The fields of each condition marker as a dictionary, e.g., {"classes": 30, "images": "bw"}
+        """
+        self.events = events
+        self.conditions = conditions
+
+    @classmethod
+    def from_markers(cls, time_stamps, markers):
+        """
+        Build the event index of a marker stream, parsing each marker once.
+
+        Args:
+            time_stamps (array-like):
+                The time stamps of the markers
+            markers (list):
+                The markers as strings, or as lists of one string as in pyxdf streams
+
+        Returns:
+            (EventIndex):
+                The event index
+        """
+        events = np.zeros(len(markers), dtype=DTYPE)
+        events["time"] = time_stamps
+        events["trial"] = -1
+        events["target"] = -1
+        events["elapsed"] = np.nan
+        events["index"] = np.arange(len(markers))
+        types = {name: i for i, name in enumerate(TYPES)}
+        conditions = []
+        for i, marker in enumerate(markers):
+            if not isinstance(marker, str):
+                marker = str(marker[0])
+            name, *fields = marker.split(";")
+            values = dict(field.split("=", 1) for field in fields if "=" in field)
+            if name == "condition":
+                conditions.append({key: _parse_value(value) for key, value in values.items()})
+            event = events[i]
+            event["type"] = types.get(name, types["other"])
+            event["block"] = len(conditions) - 1
+            if "trial" in values:
+                event["trial"] = int(values["trial"])
+            if "target" in values:
+                event["target"] = int(values["target"])
+            if "key" in values:
+                event["key"] = values["key"]
+            if "elapsed" in values:
+                event["elapsed"] = float(values["elapsed"])
+        return cls(events, conditions)
+
+    def select(self, event_type):
+        """
+        Select the events of a type.
+
+        Args:
+            event_type (str):
+                The type of the events, one of TYPES
+
+        Returns:
+            (np.ndarray):
+                The events as a structured array of DTYPE
+        """
+        return self.events[self.events["type"] == TYPES.index(event_type)]
+
+    def pairs(self, start="start_trial", stop="stop_trial"):
+        """
+        Pair start and stop events by their condition and trial. The target and key are taken from the cue of the
+        trial.
+
+        Args:
+            start (str):
+                The type of the start events. Default: "start_trial"
+            stop (str):
+                The type of the stop events. Default: "stop_trial"
+
+        Returns:
+            (np.ndarray):
+                The pairs as a structured array of PAIR_DTYPE, ordered by the start time
+        """
+        starts, stops, cues = self.select(start), self.select(stop), self.select("start_cue")
+        _, i_start, i_stop = np.intersect1d(self._keys(starts), self._keys(stops), return_indices=True)
+        order = np.argsort(starts["time"][i_start], kind="stable")
+        i_start, i_stop = i_start[order], i_stop[order]
+
+        pairs = np.zeros(i_start.size, dtype=PAIR_DTYPE)
+        for name in ("block", "trial", "target", "key"):
+            pairs[name] = starts[name][i_start]
+        pairs["start"] = starts["time"][i_start]
+        pairs["stop"] = stops["time"][i_stop]
+        pairs["duration"] = pairs["stop"] - pairs["start"]
+
+        # Fill in the target and key from the cues
+        _, i_pair, i_cue = np.intersect1d(self._keys(pairs), self._keys(cues), return_indices=True)
+        pairs["target"][i_pair] = cues["target"][i_cue]
+        pairs["key"][i_pair] = cues["key"][i_cue]
+        return pairs
+
+    @staticmethod
+    def _keys(events):
+        return events["block"].astype("int64") * 2 ** 32 + events["trial"]
+
+    def windows(self, tmin=0.0, tmax=None, event_type="start_trial"):
+        """
+        Get the time windows around the events of a type.
+
+        Args:
+            tmin (float):
+                The start of the windows relative to the events in seconds. Default: 0.0
+            tmax (float):
+                The end of the windows relative to the events in seconds. If None, the stop event of each trial
+                (see pairs). Default: None
+            event_type (str):
+                The type of the events. Default: "start_trial"
+
+        Returns:
+            (np.ndarray):
+                The start and end time of each window of shape (events, 2)
+        """
+        if tmax is None:
+            pairs = self.pairs(event_type, event_type.replace("start", "stop"))
+            return np.stack((pairs["start"] + tmin, pairs["stop"]), axis=1)
+        times = self.select(event_type)["time"]
+        return np.stack((times + tmin, times + tmax), axis=1)
+
+    def labels(self):
+        """
+        Get the targets of the cued trials, in order.
+
+        Returns:
+            (np.ndarray):
+                The labels of shape (trials)
+        """
+        cues = self.select("start_cue")
+        return cues["target"][cues["target"] >= 0]
+
+
+def load_events(recording, name):
+    """
+    Load the event index of a marker stream of a recording, building it only if it is not cached yet. The index is
+    cached in the cache folder of the recording (see ingestion.load_recording).
+
+    Args:
+        recording (ingestion.Recording):
+            The recording
+        name (str):
+            The name of the marker stream, e.g., "KeyboardMarkerStream1"
+
+    Returns:
+        (EventIndex):
+            The event index
+    """
+    path = os.path.join(recording.path, "events")
+    fn = os.path.join(path, f"{name}_v{VERSION}")
+    if os.path.exists(f"{fn}.json"):
+        with open(f"{fn}.json", "r") as fid:
+            conditions = json.load(fid)
+        return EventIndex(np.load(f"{fn}.npy"), conditions)
+
+    index = EventIndex.from_markers(*recording.get_markers(name))
+
+    # Write to a temporary folder first, the metadata last, such that readers never see a partial index
+    tmp = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp, exist_ok=True)
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(tmp, f"{name}_v{VERSION}.npy"), index.events)
+    with open(os.path.join(tmp, f"{name}_v{VERSION}.json"), "w") as fid:
+        json.dump(index.conditions, fid)
+    os.replace(os.path.join(tmp, f"{name}_v{VERSION}.npy"), f"{fn}.npy")
+    os.replace(os.path.join(tmp, f"{name}_v{VERSION}.json"), f"{fn}.json")
+    shutil.rmtree(tmp, ignore_errors=True)
+    return index
@@ -0,0 +1,177 @@
+"""
+Filter bank over continuous recordings. The EEG is band-pass filtered into several bands in one overlap-add pass: each
+block of the data is transformed once, and multiplied with the frequency response of each band (bands with filters
+of very different lengths are filtered in separate passes). The filters are those of mne.io.Raw.filter (zero-phase
+FIR, firwin design, reflect_limited padding), and each band's output is cached with the recording, keyed by the
+filter coefficients.
+
+Usage:
+    bands = filter_recording(recording, [(6.0, 21.0), (0.05, 25.05)], picks=np.arange(64))
+"""
+
+import hashlib
+import os
+import numpy as np
+from ingestion import MICROVOLTS
+
+
+def design_filter(fs, l_freq, h_freq):
+    """
+    Design the band-pass filter that mne.io.Raw.filter uses by default.
+
+    Args:
+        fs (float):
+            The sampling frequency
+        l_freq (float):
+            The lower pass-band edge. If None, a low-pass filter
+        h_freq (float):
+            The upper pass-band edge. If None, a high-pass filter
+
+    Returns:
+        (np.ndarray):
+            The symmetric FIR filter of odd length
+    """
+    from mne.filter import create_filter
+    return create_filter(None, fs, l_freq, h_freq, verbose=False)
+
+
+def _pad(x, n_pad):
+    # Pad the last axis with reflect_limited, as mne.filter does: point reflections about the edges, then zeros
+    n_times = x.shape[-1]
+    left = np.zeros(x.shape[:-1] + (max(n_pad - n_times + 1, 0),))
+    right = np.zeros(x.shape[:-1] + (max(n_pad - n_times + 1, 0),))
+    return np.concatenate([left, 2 * x[..., :1] - x[..., n_pad:0:-1], x, 2 * x[..., -1:] - x[..., -2:-n_pad - 2:-1],
+                           right], axis=-1)
+
+
+class FilterBank(object):
+    """
+    A bank of zero-phase FIR band-pass filters, applied in one overlap-add pass per group of filters of similar
+    length.
+    """
+
+    def __init__(self, fs, bands):
+        """
+        Design the filters of a filter bank.
+
+        Args:
+            fs (float):
+                The sampling frequency
+            bands (list):
+                The (l_freq, h_freq) of each band, see design_filter
+        """
+        self.fs = fs
+        self.bands = [tuple(None if f is None else float(f) for f in band) for band in bands]
+        self.filters = [design_filter(fs, *band) for band in self.bands]
+
+        # Group the filters of similar length, each group sharing one pass. Within a group, all filters are centered
+        # in the length of the longest, such that all have the same delay
+        self.groups = []
+        for i in sorted(range(len(self.filters)), key=lambda i: self.filters[i].size):
+            if not self.groups or self.filters[i].size > 2 * self.filters[self.groups[-1][0]].size:
+                self.groups.append([])
+            self.groups[-1].append(i)
+        self.responses = []
+        for group in self.groups:
+            n_taps = max(self.filters[i].size for i in group)
+            n_fft = int(2 ** np.ceil(np.log2(8 * n_taps)))
+            H = np.zeros((len(group), n_taps))
+            for j, i in enumerate(group):
+                offset = (n_taps - self.filters[i].size) // 2
+                H[j, offset:offset + self.filters[i].size] = self.filters[i]
+            self.responses.append((n_taps, n_fft, np.fft.rfft(H, n=n_fft, axis=1)))
+
+    def get_key(self, i_band):
+        """
+        Get the key of a band, covering its filter, to cache its output under.
+
+        Args:
+            i_band (int):
+                The index of the band
+
+        Returns:
+            (str):
+                The key
+        """
+        l_freq, h_freq = self.bands[i_band]
+        digest = hashlib.blake2b(self.filters[i_band].tobytes(), digest_size=8).hexdigest()
+        return f"{l_freq}-{h_freq}_{digest}"
+
+    def apply(self, x, out=None):
+        """
+        Filter the data into all bands.
+
+        Args:
+            x (np.ndarray):
+                The data of shape (channels, samples)
+            out (list):
+                The arrays to write the output of each band to, each of shape (channels, samples), e.g., memory-mapped
+                arrays. If None, new arrays. Default: None
+
+        Returns:
+            (list):
+                The output of each band of shape (channels, samples)
+        """
+        n_channels, n_times = x.shape
+        if out is None:
+            out = [np.zeros((n_channels, n_times)) for _ in self.bands]
+        x = np.asarray(x, dtype="float64")
+        for group, (n_taps, n_fft, H) in zip(self.groups, self.responses):
+            n_edge = min(n_taps, n_times) - 1
+            xp = _pad(x, n_edge)
+            n_block = n_fft - n_taps + 1
+
+            # The output at a sample of x is the full convolution at this offset: the padding and the filter delay
+            offset = n_edge + (n_taps - 1) // 2
+
+            tail = np.zeros((len(group), n_channels, n_fft - n_block))
+            for start in range(0, offset + n_times, n_block):
+                X = np.fft.rfft(xp[:, start:start + n_block], n=n_fft, axis=1) if start < xp.shape[1] else 0
+                for j, i_band in enumerate(group):
+                    y = np.fft.irfft(X * H[j], n=n_fft, axis=1)
+                    y[:, :tail.shape[2]] += tail[j]
+                    tail[j] = y[:, n_block:]
+
+                    # Write the samples that are complete
+                    a, b = max(start, offset), min(start + n_block, offset + n_times)
+                    if a < b:
+                        out[i_band][:, a - offset:b - offset] = y[:, a - start:b - start]
+        return out
+
+
+def filter_recording(recording, bands, picks=None):
+    """
+    Filter the EEG of a recording into bands, filtering only the bands that are not cached yet. The outputs are
+    cached in the cache folder of the recording (see ingestion.load_recording) as memory-mappable arrays.
+
+    Args:
+        recording (ingestion.Recording):
+            The recording
+        bands (list):
+            The (l_freq, h_freq) of each band, see design_filter
+        picks (array-like):
+            The indexes of the channels to filter. If None, all channels. Default: None
+
+    Returns:
+        (list):
+            The output of each band in volts of shape (channels, samples), read-only memory-mapped
+    """
+    picks = np.arange(len(recording.labels)) if picks is None else np.asarray(picks)
+    bank = FilterBank(recording.fs, bands)
+    path = os.path.join(recording.path, "filterbank")
+    os.makedirs(path, exist_ok=True)
+    picks_key = hashlib.blake2b(picks.astype("int64").tobytes(), digest_size=4).hexdigest()
+    fns = [os.path.join(path, f"{bank.get_key(i)}_{picks_key}.npy") for i in range(len(bands))]
+
+    # Filter the missing bands in one pass
+    missing = [i for i, fn in enumerate(fns) if not os.path.exists(fn) and fn not in fns[:i]]
+    if missing:
+        scale = np.array([1e-6 if unit in MICROVOLTS else 1 for unit in recording.units])[picks]
+        x = recording.eeg[:, picks].T * scale[:, np.newaxis]
+        tmps = [f"{fns[i]}.tmp{os.getpid()}.npy" for i in missing]
+        out = [np.lib.format.open_memmap(tmp, mode="w+", dtype="float32", shape=x.shape) for tmp in tmps]
+        FilterBank(recording.fs, [bands[i] for i in missing]).apply(x, out)
+        for array, tmp, i in zip(out, tmps, missing):
+            array.flush()
+            os.replace(tmp, fns[i])
+    return [np.load(fn, mmap_mode="r") for fn in fns]
@@ -0,0 +1,218 @@
+"""
+Single-pass ingestion of XDF recordings. Each recording is parsed once, keeping only the EEG channels that are
+used, and cached as memory-mappable arrays keyed by the hash of the XDF file.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import pyxdf
+
+# BioSemi channels that are not used: external electrodes and analog inputs
+DROP_CHANNELS = [f"EX{i}" for i in range(1, 9)] + [f"AIB{i}" for i in range(1, 33)]
+
+MICROVOLTS = ("microvolt", "microvolts", "µV", "?V", "uV")
+
+
+def hash_file(fn, block_size=2**20):
+    """
+    Compute the content hash of a file.
+
+    Args:
+        fn (str):
+            The file name
+        block_size (int):
+            The number of bytes read at once. Default: 2**20
+
+    Returns:
+        (str):
+            The hexadecimal content hash
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(fn, "rb") as fid:
+        for block in iter(lambda: fid.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _is_markerstream(stream):
+    srate = float(stream["info"]["nominal_srate"][0])
+    n_chans = int(stream["info"]["channel_count"][0])
+    return srate == 0 and n_chans == 1
+
+
+def _read_channels(stream):
+    """
+    Read the channel labels, types and units of a stream from its header, as in read_raw_xdf.
+
+    Args:
+        stream (dict):
+            The stream header as given by pyxdf
+
+    Returns:
+        (tuple):
+            The lists of labels, types and units
+    """
+    from mne.io import get_channel_type_constants
+
+    n_chans = int(stream["info"]["channel_count"][0])
+    labels, types, units = [], [], []
+    try:
+        for ch in stream["info"]["desc"][0]["channels"][0]["channel"]:
+            labels.append(str(ch["label"][0]))
+            if ch["type"] and ch["type"][0].lower() in get_channel_type_constants(True):
+                types.append(ch["type"][0].lower())
+            else:
+                types.append("misc")
+            units.append(ch["unit"][0] if ch["unit"] else "NA")
+    except (TypeError, IndexError):  # no channel labels found
+        pass
+
+    if not labels:
+        labels = [f"{stream['info']['name'][0]}_{n}" for n in range(n_chans)]
+    if not units:
+        units = ["NA" for _ in range(n_chans)]
+    if not types:
+        types = ["misc" for _ in range(n_chans)]
+    return labels, types, units
+
+
+class Recording(object):
+    """
+    A cached recording: the EEG stream as memory-mapped arrays and all marker streams.
+    """
+
+    def __init__(self, path):
+        """
+        Open a cached recording.
+
+        Args:
+            path (str):
+                The cache folder of the recording, as written by load_recording
+        """
+        self.path = path
+        with open(os.path.join(path, "info.json"), "r") as fid:
+            info = json.load(fid)
+        self.fs = info["fs"]
+        self.labels = info["labels"]
+        self.types = info["types"]
+        self.units = info["units"]
+        self.markers = info["markers"]
+
+        # EEG of shape (samples, channels) and its time stamps of shape (samples)
+        self.eeg = np.load(os.path.join(path, "eeg.npy"), mmap_mode="r")
+        self.eeg_times = np.load(os.path.join(path, "eeg_times.npy"), mmap_mode="r")
+
+    def get_markers(self, name):
+        """
+        Get a marker stream.
+
+        Args:
+            name (str):
+                The name of the marker stream, e.g., "KeyboardMarkerStream1"
+
+        Returns:
+            (tuple):
+                The time stamps of shape (markers) and the list of marker strings
+        """
+        stream = self.markers[name]
+        return np.array(stream["time_stamps"]), stream["time_series"]
+
+    def to_raw(self, marker_stream=None):
+        """
+        Convert the recording to an MNE raw object, as read_raw_xdf does. Markers are added as annotations from the
+        start_run marker onwards.
+
+        Args:
+            marker_stream (str):
+                The name of the marker stream to add as annotations. If None, all marker streams are added.
+                Default: None
+
+        Returns:
+            (mne.io.RawArray):
+                The raw object
+        """
+        import mne
+
+        info = mne.create_info(ch_names=self.labels, sfreq=self.fs, ch_types=self.types, verbose=False)
+        scale = np.array([1e-6 if u in MICROVOLTS else 1 for u in self.units])
+        raw = mne.io.RawArray((self.eeg * scale).T, info, verbose=False)
+        raw._filenames = [self.path]
+
+        first_time = self.eeg_times[0]
+        names = self.markers.keys() if marker_stream is None else [marker_stream]
+        for name in names:
+            onsets, descriptions = self.get_markers(name)
+            if "start_run" in descriptions:
+                start_run_index = descriptions.index("start_run")
+                raw.annotations.append(onsets[start_run_index:] - first_time, 0, descriptions[start_run_index:])
+        return raw
+
+
+def load_recording(fn, eeg_stream="BioSemi", drop_channels=DROP_CHANNELS, cache_dir=None):
+    """
+    Load a recording, parsing the XDF file only if it is not cached yet. The file is parsed once: channels that are
+    dropped are removed from each chunk while it is read, and all marker streams are kept.
+
+    Args:
+        fn (str):
+            The XDF file
+        eeg_stream (str):
+            The name of the EEG stream. Default: "BioSemi"
+        drop_channels (list):
+            The labels of the EEG channels that are not loaded. Default: DROP_CHANNELS
+        cache_dir (str):
+            The folder to cache recordings in. If None, a folder "cache" next to the XDF file. Default: None
+
+    Returns:
+        (Recording):
+            The recording
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(fn)), "cache")
+    key = hash_file(fn) + "_" + hashlib.blake2b(repr((eeg_stream, list(drop_channels))).encode(), digest_size=4).hexdigest()
+    path = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(path, "info.json")):
+        return Recording(path)
+
+    # Select channels per chunk while parsing
+    keep = dict()
+
+    def on_chunk(values, stamps, stream, stream_id):
+        if stream["info"]["name"][0] != eeg_stream:
+            return values, stamps, stream
+        if stream_id not in keep:
+            labels, _, _ = _read_channels(stream)
+            keep[stream_id] = np.array([i for i, label in enumerate(labels) if label not in drop_channels])
+        return values[:, keep[stream_id]], stamps, stream
+
+    streams, _ = pyxdf.load_xdf(fn, on_chunk=on_chunk)
+    names = [stream["info"]["name"][0] for stream in streams]
+    assert eeg_stream in names, f"No stream {eeg_stream} in {fn}"
+    eeg = streams[names.index(eeg_stream)]
+    labels, types, units = _read_channels(eeg)
+    idx = [i for i, label in enumerate(labels) if label not in drop_channels]
+    info = dict(
+        fs=float(np.array(eeg["info"]["effective_srate"]).item()),
+        labels=[labels[i] for i in idx],
+        types=[types[i] for i in idx],
+        units=[units[i] for i in idx],
+        markers={stream["info"]["name"][0]: dict(
+            time_stamps=stream["time_stamps"].tolist(),
+            time_series=[str(sample[0]) for sample in stream["time_series"]])
+            for stream in streams if _is_markerstream(stream)})
+
+    # Write to a temporary folder first, such that an interrupted write never leaves a partial cache
+    tmp = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp, exist_ok=True)
+    np.save(os.path.join(tmp, "eeg.npy"), np.ascontiguousarray(eeg["time_series"]))
+    np.save(os.path.join(tmp, "eeg_times.npy"), eeg["time_stamps"])
+    with open(os.path.join(tmp, "info.json"), "w") as fid:
+        json.dump(info, fid)
+    try:
+        os.rename(tmp, path)
+    except OSError:  # cached concurrently by another process
+        shutil.rmtree(tmp, ignore_errors=True)
+    return Recording(path)
@@ -0,0 +1,302 @@
+"""
+Level-of-detail overview of long multichannel recordings. A min/max pyramid is built once per recording and cached
+with it: level k holds the minimum and maximum of each channel over bins of factor ** (k + 1) samples. A time range is
+rendered at the resolution of the screen from the coarsest level that still has a bin per pixel, such that plotting a
+full session reads a few thousand values per channel instead of all samples, and zooming in stays interactive.
+
+Usage:
+    pyramid = load_pyramid(recording, picks=np.arange(1, 65))
+    plot = PyramidPlot(pyramid, onsets=index.select("start_trial")["time"] - recording.eeg_times[0])
+    plot.plot(tmin=0, tmax=60)
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+from ingestion import MICROVOLTS
+
+VERSION = 1  # the version of the pyramid, part of the name of cached pyramids
+
+
+def _reduce(lo, hi, factor):
+    # The minimum and maximum over bins of factor samples along the last axis, the last bin may be partial
+    n_pad = -lo.shape[-1] % factor
+    if n_pad:
+        lo = np.pad(lo, ((0, 0), (0, n_pad)), mode="edge")
+        hi = np.pad(hi, ((0, 0), (0, n_pad)), mode="edge")
+    shape = lo.shape[:-1] + (-1, factor)
+    return lo.reshape(shape).min(axis=-1), hi.reshape(shape).max(axis=-1)
+
+
+def build_pyramid(x, factor=4, min_bins=256, block_size=2**18, picks=None):
+    """
+    Build the min/max pyramid of data, reading it in blocks such that it may be memory-mapped.
+
+    Args:
+        x (np.ndarray):
+            The data of shape (channels, samples)
+        factor (int):
+            The number of bins of a level that make up one bin of the next level. Default: 4
+        min_bins (int):
+            The number of bins at which to stop adding levels. Default: 256
+        block_size (int):
+            The number of samples read at once, rounded to a multiple of factor. Default: 2**18
+        picks (array-like):
+            The indexes of the channels. If None, all channels. Default: None
+
+    Returns:
+        (list):
+            The levels, each of shape (2, channels, bins) of float32 with the minimum and maximum of each bin
+    """
+    picks = np.arange(x.shape[0]) if picks is None else np.asarray(picks)
+    n_times = x.shape[1]
+    block_size = max(block_size // factor, 1) * factor
+    level = np.empty((2, picks.size, -(-n_times // factor)), dtype="float32")
+    for start in range(0, n_times, block_size):
+        block = np.asarray(x[:, start:start + block_size], dtype="float32")[picks]
+        lo, hi = _reduce(block, block, factor)
+        level[0, :, start // factor:start // factor + lo.shape[1]] = lo
+        level[1, :, start // factor:start // factor + hi.shape[1]] = hi
+    levels = [level]
+    while levels[-1].shape[2] > min_bins:
+        levels.append(np.stack(_reduce(levels[-1][0], levels[-1][1], factor)))
+    return levels
+
+
+class Pyramid(object):
+    """
+    The min/max pyramid of a recording, and the data it was built from to render short ranges sample by sample.
+    """
+
+    def __init__(self, data, levels, fs, factor, labels=None, scale=None, picks=None):
+        """
+        Create a pyramid.
+
+        Args:
+            data (np.ndarray):
+                The data of shape (channels, samples), e.g., memory-mapped
+            levels (list):
+                The levels of the pyramid, see build_pyramid
+            fs (float):
+                The sampling frequency
+            factor (int):
+                The factor between the levels, see build_pyramid
+            labels (list):
+                The labels of the channels. If None, their indexes. Default: None
+            scale (np.ndarray):
+                The scale of each channel applied to the rendered values, e.g., to microvolts. If None, 1.
+                Default: None
+            picks (array-like):
+                The indexes of the channels of the pyramid in data. If None, all channels. Default: None
+        """
+        self.data = data
+        self.levels = levels
+        self.fs = fs
+        self.factor = factor
+        self.picks = np.arange(data.shape[0]) if picks is None else np.asarray(picks)
+        self.labels = [str(i) for i in self.picks] if labels is None else labels
+        self.scale = np.ones(self.picks.size) if scale is None else np.asarray(scale)
+
+    @classmethod
+    def from_array(cls, data, fs, labels=None, factor=4):
+        """
+        Build the pyramid of data in memory, e.g., of an MNE raw object, without caching it.
+
+        Args:
+            data (np.ndarray):
+                The data of shape (channels, samples)
+            fs (float):
+                The sampling frequency
+            labels (list):
+                The labels of the channels. If None, their indexes. Default: None
+            factor (int):
+                The factor between the levels, see build_pyramid. Default: 4
+
+        Returns:
+            (Pyramid):
+                The pyramid
+        """
+        return cls(data, build_pyramid(data, factor), fs, factor, labels)
+
+    @property
+    def duration(self):
+        """
+        (float): The duration of the data in seconds
+        """
+        return self.data.shape[1] / self.fs
+
+    def get_range(self, tmin, tmax, n_pixels):
+        """
+        Get the envelope of a time range at a resolution of at least n_pixels bins, from the coarsest level that has
+        as many. Ranges of fewer than factor * n_pixels samples are read from the data.
+
+        Args:
+            tmin (float):
+                The start of the range in seconds
+            tmax (float):
+                The end of the range in seconds
+            n_pixels (int):
+                The number of pixels the range is rendered on
+
+        Returns:
+            (tuple):
+                The start time of each bin of shape (bins), and the minimum and maximum of each channel of shape
+                (channels, bins)
+        """
+        a = int(np.clip(np.floor(tmin * self.fs), 0, self.data.shape[1]))
+        b = int(np.clip(np.ceil(tmax * self.fs) + 1, a, self.data.shape[1]))
+        n_levels = int(np.floor(np.log(max((b - a) / max(n_pixels, 1), 1)) / np.log(self.factor)))
+        n_levels = min(n_levels, len(self.levels))
+        if n_levels == 0:
+            values = np.asarray(self.data[:, a:b], dtype="float32")[self.picks] * self.scale[:, np.newaxis]
+            return np.arange(a, b) / self.fs, values, values
+
+        # The bins of the level that overlap with the range
+        size = self.factor ** n_levels
+        level = self.levels[n_levels - 1]
+        a, b = a // size, min(-(-b // size), level.shape[2])
+        times = np.arange(a, b) * size / self.fs
+        lo, hi = level[0, :, a:b] * self.scale[:, np.newaxis], level[1, :, a:b] * self.scale[:, np.newaxis]
+        return times, np.minimum(lo, hi), np.maximum(lo, hi)  # a negative scale swaps the minimum and maximum
+
+
+def load_pyramid(recording, picks=None, factor=4):
+    """
+    Load the min/max pyramid of the EEG of a recording in microvolts, building it only if it is not cached yet. The
+    pyramid is cached in the cache folder of the recording (see ingestion.load_recording).
+
+    Args:
+        recording (ingestion.Recording):
+            The recording
+        picks (array-like):
+            The indexes of the channels. If None, all channels. Default: None
+        factor (int):
+            The factor between the levels, see build_pyramid. Default: 4
+
+    Returns:
+        (Pyramid):
+            The pyramid
+    """
+    picks = np.arange(len(recording.labels)) if picks is None else np.asarray(picks)
+    data = recording.eeg.T  # a view, the channels are picked from each range that is read
+    scale = np.array([1 if unit in MICROVOLTS else 1e6 for unit in recording.units])[picks]
+    labels = [recording.labels[i] for i in picks]
+
+    picks_key = hashlib.blake2b(picks.astype("int64").tobytes(), digest_size=4).hexdigest()
+    path = os.path.join(recording.path, "pyramid", f"{picks_key}_f{factor}_v{VERSION}")
+    if os.path.exists(os.path.join(path, "info.json")):
+        with open(os.path.join(path, "info.json"), "r") as fid:
+            n_levels = json.load(fid)["n_levels"]
+        levels = [np.load(os.path.join(path, f"level{k}.npy"), mmap_mode="r") for k in range(n_levels)]
+        return Pyramid(data, levels, recording.fs, factor, labels, scale, picks)
+
+    levels = build_pyramid(data, factor, picks=picks)
+
+    # Write to a temporary folder first, the metadata last, such that readers never see a partial pyramid
+    tmp = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp, exist_ok=True)
+    for k, level in enumerate(levels):
+        np.save(os.path.join(tmp, f"level{k}.npy"), level)
+    with open(os.path.join(tmp, "info.json"), "w") as fid:
+        json.dump(dict(n_levels=len(levels), factor=factor, picks=picks.tolist()), fid)
+    if os.path.exists(path):
+        shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    return Pyramid(data, levels, recording.fs, factor, labels, scale, picks)
+
+
+class PyramidPlot(object):
+    """
+    A grid of channels rendered from a pyramid, re-rendered at the resolution of the screen whenever the time range
+    changes, e.g., by panning and zooming in an interactive backend.
+    """
+
+    def __init__(self, pyramid, onsets=None, n_cols=8, figsize=None, color="C0", onset_color="r", unit="µV"):
+        """
+        Create the figure of a pyramid.
+
+        Args:
+            pyramid (Pyramid):
+                The pyramid
+            onsets (array-like):
+                The onsets of annotations in seconds, drawn as vertical lines in each channel. Default: None
+            n_cols (int):
+                The number of columns of the grid. Default: 8
+            figsize (tuple):
+                The size of the figure. If None, 3.75 by 1.25 inches per channel. Default: None
+            color (str):
+                The color of the channels. Default: "C0"
+            onset_color (str):
+                The color of the onsets. Default: "r"
+            unit (str):
+                The unit of the values, see Pyramid. Default: "µV"
+        """
+        import matplotlib.pyplot as plt
+
+        self.pyramid = pyramid
+        n_channels = len(pyramid.labels)
+        n_rows = -(-n_channels // n_cols)
+        if figsize is None:
+            figsize = (3.75 * n_cols, 1.25 * n_rows)
+        self.fig, axs = plt.subplots(n_rows, n_cols, figsize=figsize, sharex=True, squeeze=False)
+        self.axs = axs.flatten()[:n_channels]
+        for ax in axs.flatten()[n_channels:]:
+            ax.set_visible(False)
+
+        self.lines = []
+        for ax, label in zip(self.axs, pyramid.labels):
+            self.lines.append(ax.plot([], [], color=color, linewidth=0.5)[0])
+            ax.set_title(label, fontsize="small")
+            if onsets is not None:
+                # All onsets of a channel as one collection, spanning the height of the axes
+                ax.vlines(onsets, 0, 1, transform=ax.get_xaxis_transform(), color=onset_color, linewidth=0.5)
+        for ax in axs[-1, :]:
+            ax.set_xlabel("time (s)")
+        for ax in axs[:, 0]:
+            ax.set_ylabel(unit)
+
+        self._updating = False
+        self.axs[0].callbacks.connect("xlim_changed", lambda ax: self.update(*ax.get_xlim()))
+
+    def update(self, tmin, tmax):
+        """
+        Render a time range from the level of the pyramid that matches the width of the axes.
+
+        Args:
+            tmin (float):
+                The start of the range in seconds
+            tmax (float):
+                The end of the range in seconds
+        """
+        if self._updating:
+            return
+        self._updating = True
+        n_pixels = int(np.ceil(self.axs[0].get_window_extent().width))
+        times, lo, hi = self.pyramid.get_range(tmin, tmax, n_pixels)
+
+        # Draw the envelope of each channel as one line, going from the minimum to the maximum of each bin
+        x = np.repeat(times, 2)
+        y = np.stack((lo, hi), axis=2).reshape(lo.shape[0], -1)
+        for ax, line, values, low, high in zip(self.axs, self.lines, y, lo, hi):
+            line.set_data(x, values)
+            if values.size:
+                margin = 0.05 * max(float(high.max() - low.min()), 1e-12)
+                ax.set_ylim(float(low.min()) - margin, float(high.max()) + margin)
+        self.fig.canvas.draw_idle()
+        self._updating = False
+
+    def plot(self, tmin=0.0, tmax=None):
+        """
+        Show a time range.
+
+        Args:
+            tmin (float):
+                The start of the range in seconds. Default: 0.0
+            tmax (float):
+                The end of the range in seconds. If None, the end of the recording. Default: None
+        """
+        tmax = self.pyramid.duration if tmax is None else tmax
+        self.axs[0].set_xlim(tmin, tmax)  # renders through the xlim_changed callback
+        self.update(tmin, tmax)
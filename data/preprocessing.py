@@ -0,0 +1,343 @@
+"""
+Preprocessing of the c-VEP recordings: band-pass filtering, epoching and downsampling of each run, written as one
+derivative per subject and condition. Runs are processed in parallel, and derivatives whose inputs and parameters
+did not change are skipped.
+
+Usage:
+    python preprocessing.py 01 02 03 --data-dir ~/ideaProjects/programming/BCI/Thesis/steven/steven --workers 4
+"""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from ingestion import load_recording
+from derivatives import get_path, save_derivative, Derivative
+from events import load_events
+from filterbank import filter_recording
+from resampling import Resampler
+
+condition_order = [[1, 2, 4, 3, 2, 3, 1, 4],  # row
+                   [2, 3, 1, 4, 1, 2, 4, 3],  # row, rotated by 1 to the left
+                   [3, 4, 2, 1, 4, 1, 3, 2],  # row, rotated by 2 to the left
+                   [4, 1, 3, 2, 3, 4, 2, 1],  # row, rotated by 3 to the left
+                   [1, 2, 4, 3, 1, 2, 4, 3],
+                   [2, 3, 1, 4, 2, 3, 1, 4],
+                  ]
+
+condition_to_codename = {1: "m_sequence_shift_classes=30", 2: "m_sequence_shift_classes=5", 3: "m_sequence_shift_classes=5", 4: "m_sequence_shift_classes=30"}
+condition_to_codename_saving = {1: "classes=30_bw", 2: "classes=5_grating", 3: "classes=5_bw", 4: "classes=30_grating"}
+
+PARAMS = dict(
+    trial_time=4.2,  # trial time
+    n_trials=30,
+    fs=120,
+    pr=60,
+    l_freq=6.00,  # 0.05
+    h_freq=21.00,  # 25.05
+    runs=[0, 1],
+)
+
+
+def get_fingerprint(fn):
+    """
+    Get a fingerprint of an input file that changes whenever the file is replaced or modified.
+
+    Args:
+        fn (str):
+            The file name
+
+    Returns:
+        (list):
+            The file name, size and modification time
+    """
+    stat = os.stat(fn)
+    return [os.path.basename(fn), stat.st_size, stat.st_mtime_ns]
+
+
+def get_work_items(subject, data_dir):
+    """
+    Get the work items of a subject: one per condition, each with the runs of that condition.
+
+    Args:
+        subject (str):
+            The subject, e.g., "01"
+        data_dir (str):
+            The data directory
+
+    Returns:
+        (list):
+            The work items as dicts with the subject, condition, output folder and per run the XDF file name and
+            the name of its marker stream
+    """
+    conditions = condition_order[int(subject[-2:]) - 1]
+    items = []
+    for i_con in sorted(set(conditions), key=conditions.index):
+        condition_indexes = np.where(np.array(conditions) == i_con)
+        runs = []
+        for i_run in PARAMS["runs"]:
+            fn = os.path.join(data_dir, "data", f"sub-{subject}", "ses-01", "eeg",
+                              f"sub-{subject}_ses-01_task-cvep_run-{condition_indexes[0][i_run]+1:03d}_eeg.xdf")
+            runs.append(dict(fn=fn, marker_name=f"KeyboardMarkerStream{int(condition_indexes[0][i_run])+1}"))
+        out = get_path(data_dir, subject, condition_to_codename_saving[i_con])
+        items.append(dict(subject=subject, condition=i_con, runs=runs, out=out))
+    return items
+
+
+def get_signature(item, data_dir, params=PARAMS):
+    """
+    Get the signature of a work item, a hash of its inputs and parameters.
+
+    Args:
+        item (dict):
+            The work item as given by get_work_items
+        data_dir (str):
+            The data directory
+        params (dict):
+            The preprocessing parameters. Default: PARAMS
+
+    Returns:
+        (str):
+            The signature
+    """
+    codes = os.path.join(data_dir, "data", "codes", f"{condition_to_codename[item['condition']]}.npz")
+    inputs = [get_fingerprint(run["fn"]) for run in item["runs"]] + [get_fingerprint(codes)]
+    return hashlib.sha1(json.dumps([inputs, params], sort_keys=True).encode()).hexdigest()
+
+
+def preprocess_run(fn, marker_name, cache_dir=None, params=PARAMS, bands=None):
+    """
+    Preprocess one run: band-pass filter, epoch and downsample the trials. The continuous data of each band are
+    cached with the recording (see filterbank.py), such that other bands or epochs reuse them. The trials are sliced
+    and downsampled in one step (see resampling.py).
+
+    Args:
+        fn (str):
+            The XDF file of the run
+        marker_name (str):
+            The name of the marker stream of the run
+        cache_dir (str):
+            The cache folder of the recordings (see ingestion.load_recording). Default: None
+        params (dict):
+            The preprocessing parameters. Default: PARAMS
+        bands (list):
+            The (l_freq, h_freq) of each band of a filter bank. If None, the band of params. Default: None
+
+    Returns:
+        (tuple):
+            The trials of shape (trials, channels, samples), or (bands, trials, channels, samples) if bands are
+            given, and the labels of shape (trials)
+    """
+    import mne
+
+    trial_time = params["trial_time"]
+    n_trials = params["n_trials"]
+
+    # Load EEG and markers, parsing the XDF file only once (and not at all if cached)
+    # N.B. the EX1-8 and AIB1-32 channels are not loaded
+    recording = load_recording(fn, cache_dir=cache_dir)
+    raw = recording.to_raw(marker_stream=marker_name)
+
+    # Adjust marker channel data
+    raw._data[0, :] -= np.median(raw._data[0, :])
+    raw._data[0, :] = np.diff(np.concatenate((np.zeros(1), raw._data[0, :]))) > 0
+
+    # Read events
+    events = mne.find_events(raw, stim_channel="Trig1", verbose=False)
+    if events.shape[0] != n_trials:
+        print(f"\tFound more/less than {n_trials} events in {os.path.basename(fn)} before correction: {events.shape[0]}")
+    idx = np.concatenate(([True], np.diff(events[:, 0]) > 0.5*raw.info["sfreq"]))
+    events = events[idx, :]
+    assert events.shape[0] == n_trials, f"\tFound more/less than {n_trials} events in {os.path.basename(fn)} after correction: {events.shape[0]}"
+
+    # Filtering, all bands in one pass over the continuous data (and not at all if cached)
+    picks = np.arange(1, 65)
+    outputs = filter_recording(recording, [(params["l_freq"], params["h_freq"])] if bands is None else bands, picks)
+
+    # Slicing and resampling
+    # N.B. Only the samples of [0, trial_time] are computed, the data around the trials is the context of the
+    # anti-aliasing filter
+    # N.B. Downsampling is done per trial, from its onset, to maintain accurate stimulus timing
+    resampler = Resampler(raw.info["sfreq"], params["fs"], int(round(trial_time * params["fs"])))
+    onsets = events[:, 0] - raw.first_samp
+    inside = (onsets + resampler.first >= 0) & (onsets + resampler.last <= raw.n_times)
+    if not np.all(inside):
+        print(f"\tDropped {np.sum(~inside)} trials that exceed the data in {os.path.basename(fn)}")
+    onsets = onsets[inside]
+    X = np.empty((len(outputs), onsets.size, picks.size, resampler.n_samples), dtype="float32")
+    for output, out in zip(outputs, X):
+        resampler.apply(output, onsets, out)
+    X = X[0] if bands is None else X
+
+    # Load labels from the event index of the marker stream (parsed once, cached with the recording), keeping those
+    # of the trials that were not dropped
+    y = np.asarray(load_events(recording, marker_name).labels())
+    assert y.size == inside.size, f"\tFound {y.size} labels for {inside.size} trials in {os.path.basename(fn)}"
+    return X, y[inside].tolist()
+
+
+def is_up_to_date(item, signature):
+    """
+    Check whether the derivative of a work item was made from the same inputs and parameters.
+
+    Args:
+        item (dict):
+            The work item as given by get_work_items
+        signature (str):
+            The current signature of the work item (see get_signature)
+
+    Returns:
+        (bool):
+            True if the derivative exists and has the same signature, otherwise False
+    """
+    if not os.path.exists(os.path.join(item["out"], "info.json")):
+        return False
+    return Derivative(item["out"]).signature == signature
+
+
+def _preprocess_run(args):
+    return preprocess_run(*args)
+
+
+def run_batch(subjects, data_dir, n_workers=None, force=False, params=PARAMS):
+    """
+    Preprocess the runs of all conditions of a list of subjects in parallel, and save a derivative per subject and
+    condition: X (trials channels samples), y (trials), V (classes samples) and fs (see derivatives.py).
+
+    Args:
+        subjects (list):
+            The subjects, e.g., ["01", "02"]
+        data_dir (str):
+            The data directory
+        n_workers (int):
+            The maximum number of worker processes. If None, the number of CPUs. Default: None
+        force (bool):
+            Whether to preprocess derivatives that are up to date as well. Default: False
+        params (dict):
+            The preprocessing parameters. Default: PARAMS
+
+    Returns:
+        (list):
+            The folders of the derivatives that were (re)made. Items of which a run fails are reported and skipped,
+            the other items are still saved
+    """
+    cache_dir = os.path.join(data_dir, "cache")
+
+    # Select the work items whose inputs or parameters changed
+    items = []
+    for subject in subjects:
+        for item in get_work_items(subject, data_dir):
+            signature = get_signature(item, data_dir, params)
+            if force or not is_up_to_date(item, signature):
+                items.append((item, signature))
+            else:
+                print(f"Skipping {os.path.basename(item['out'])} (up to date)")
+
+    # Fan out all runs of all items, saving the derivative of an item as soon as all its runs are done
+    done, failed = [], []
+    results = [[None] * len(item["runs"]) for item, _ in items]
+    remaining = [len(item["runs"]) for item, _ in items]
+    errors = [None] * len(items)
+
+    def finish(i_item, i_run, result=None, error=None):
+        item, signature = items[i_item]
+        if error is not None and errors[i_item] is None:
+            errors[i_item] = error
+            print(f"Failed {os.path.basename(item['out'])}: {type(error).__name__}: {str(error).strip()}")
+        results[i_item][i_run] = result
+        remaining[i_item] -= 1
+        if remaining[i_item] > 0:
+            return
+        if errors[i_item] is not None:
+            failed.append(item["out"])
+            return
+        try:
+            save_item(item, signature, results[i_item], data_dir, params)
+            done.append(item["out"])
+        except Exception as error:
+            print(f"Failed {os.path.basename(item['out'])}: {type(error).__name__}: {str(error).strip()}")
+            failed.append(item["out"])
+        results[i_item] = None
+
+    runs = [(i_item, i_run, (run["fn"], run["marker_name"], cache_dir, params))
+            for i_item, (item, _) in enumerate(items) for i_run, run in enumerate(item["runs"])]
+    if n_workers == 1:
+        for i_item, i_run, args in runs:
+            try:
+                result = _preprocess_run(args)
+            except Exception as error:
+                finish(i_item, i_run, error=error)
+            else:
+                finish(i_item, i_run, result)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = {pool.submit(_preprocess_run, args): (i_item, i_run) for i_item, i_run, args in runs}
+            for future in as_completed(futures):
+                error = future.exception()
+                finish(*futures[future], result=None if error is not None else future.result(), error=error)
+
+    if failed:
+        print(f"Failed {len(failed)} of {len(items)} derivatives: "
+              f"{', '.join(os.path.basename(out) for out in failed)}")
+    return done
+
+
+def save_item(item, signature, results, data_dir, params=PARAMS):
+    """
+    Save the derivative of a work item from the results of its runs.
+
+    Args:
+        item (dict):
+            The work item as given by get_work_items
+        signature (str):
+            The signature of the work item (see get_signature)
+        results (list):
+            The trials and labels of each run of the item (see preprocess_run)
+        data_dir (str):
+            The data directory
+        params (dict):
+            The preprocessing parameters. Default: PARAMS
+    """
+    # Extract data
+    X = np.concatenate([eeg for eeg, _ in results], axis=0).astype("float32")  # trials channels samples
+    y = np.array([label for _, labels in results for label in labels]).astype("uint8")
+
+    # Load codes
+    fn = os.path.join(data_dir, "data", "codes", f"{condition_to_codename[item['condition']]}.npz")
+    V = np.load(fn)["codes_real"]
+    V = np.repeat(V, int(params["fs"] / params["pr"]), axis=1).astype("uint8")
+
+    # Print summary
+    print("Condition:", condition_to_codename_saving[item["condition"]], "subject:", item["subject"])
+    print("\tX:", X.shape)
+    print("\ty:", y.shape)
+    print("\tV:", V.shape)
+
+    # Save data
+    save_derivative(item["out"], X, y, V, params["fs"], condition_to_codename_saving[item["condition"]],
+                    condition_to_codename[item["condition"]], signature=signature)
+
+
+def preprocess(subject, data_dir):
+    """
+    The preprocessing function. This function preprocesses the raw data by band-pas filtering the data between 6 and
+    21 Hz, epoching the trials, and downsampling the data to 120 Hz.
+
+    subject: participant number (e.g., "01")
+    data_dir: the data directory
+    """
+    return run_batch([subject], data_dir)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Preprocess c-VEP recordings")
+    parser.add_argument("subjects", type=str, nargs="+", help="subjects, e.g., 01 02")
+    parser.add_argument("-d", "--data-dir", type=str, help="data directory",
+                        default=os.path.join(os.path.expanduser("~"), "ideaProjects", "programming", "BCI", "Thesis", "steven", "steven"))
+    parser.add_argument("-w", "--workers", type=int, help="maximum number of worker processes", default=None)
+    parser.add_argument("-f", "--force", action="store_true", help="also preprocess derivatives that are up to date")
+    args = parser.parse_args()
+
+    run_batch(args.subjects, args.data_dir, args.workers, args.force)
@@ -0,0 +1,111 @@
+"""
+Fused epoching and polyphase resampling. The trials are sliced from the continuous data and resampled in one step,
+computing only the output samples that are kept: each output sample is the inner product of the input samples around
+it with one phase of a polyphase low-pass filter (the filter of scipy.signal.resample_poly). The input around the
+trials serves only as context of the filter, and no full-rate epochs are made.
+
+Usage:
+    resampler = Resampler(2048, 120, n_samples=504)
+    X = resampler.apply(eeg, onsets)  # (trials, channels, samples)
+"""
+
+from fractions import Fraction
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def design_resampler(fs, sfreq, max_denominator=1000):
+    """
+    Design the polyphase low-pass filter of a rational resampling, as scipy.signal.resample_poly does.
+
+    Args:
+        fs (float):
+            The sampling frequency of the input
+        sfreq (float):
+            The sampling frequency of the output
+        max_denominator (int):
+            The maximum up- and downsampling factor, to which the ratio of the (effective) sampling frequencies is
+            rounded. Default: 1000
+
+    Returns:
+        (tuple):
+            The upsampling and downsampling factors, and the filter at the upsampled rate of odd length
+    """
+    from scipy.signal import firwin
+    ratio = Fraction(sfreq / fs).limit_denominator(max_denominator)
+    up, down = ratio.numerator, ratio.denominator
+    half_len = 10 * max(up, down)
+    h = up * firwin(2 * half_len + 1, 1 / max(up, down), window=("kaiser", 5.0))
+    return up, down, h
+
+
+class Resampler(object):
+    """
+    A rational resampler of trials of a fixed length, sliced at onsets from continuous data.
+    """
+
+    def __init__(self, fs, sfreq, n_samples):
+        """
+        Design the phases of the resampler.
+
+        Args:
+            fs (float):
+                The sampling frequency of the input
+            sfreq (float):
+                The sampling frequency of the output
+            n_samples (int):
+                The number of output samples of each trial, starting at the onset
+        """
+        self.fs = fs
+        self.sfreq = sfreq
+        self.n_samples = n_samples
+        self.up, self.down, h = design_resampler(fs, sfreq)
+        half_len = h.size // 2
+
+        # Output sample n lies at input sample n * down / up. The outputs n and n + up share their weights (the
+        # phase), the window of input samples of the latter shifted by down
+        self.n_taps = (2 * half_len) // self.up + 1
+        starts, counts, self.weights = [], [], []
+        for n in range(min(self.up, n_samples)):
+            start = -((half_len - n * self.down) // self.up)  # ceil((n * down - half_len) / up)
+            idx = half_len + n * self.down - (start + np.arange(self.n_taps)) * self.up
+            starts.append(start)
+            counts.append(len(range(n, n_samples, self.up)))
+            self.weights.append(np.where((idx >= 0) & (idx < h.size), h[np.clip(idx, 0, h.size - 1)], 0))
+
+        # The input window of a trial relative to its onset, and the start of the window of each phase in it
+        self.first = min(starts)
+        self.last = max(start + (count - 1) * self.down for start, count in zip(starts, counts)) + self.n_taps
+        self.phases = [(start - self.first, count) for start, count in zip(starts, counts)]
+
+    def apply(self, x, onsets, out=None):
+        """
+        Slice and resample the trials.
+
+        Args:
+            x (np.ndarray):
+                The continuous data of shape (channels, samples), e.g., a memory-mapped array
+            onsets (array-like):
+                The sample of the onset of each trial in x
+            out (np.ndarray):
+                The array to write the trials to of shape (trials, channels, samples). If None, a new array of float32.
+                Default: None
+
+        Returns:
+            (np.ndarray):
+                The trials of shape (trials, channels, samples)
+        """
+        n_channels, n_times = x.shape
+        if out is None:
+            out = np.empty((len(onsets), n_channels, self.n_samples), dtype="float32")
+        for i_trial, onset in enumerate(onsets):
+            # The input window of the trial, zero-padded where it exceeds the data
+            a, b = onset + self.first, onset + self.last
+            segment = np.asarray(x[:, max(a, 0):min(b, n_times)], dtype="float64")
+            if a < 0 or b > n_times:
+                segment = np.pad(segment, ((0, 0), (max(-a, 0), max(b - n_times, 0))))
+
+            windows = sliding_window_view(segment, self.n_taps, axis=1)
+            for n, ((start, count), weights) in enumerate(zip(self.phases, self.weights)):
+                out[i_trial, :, n::self.up] = windows[:, start:start + (count - 1) * self.down + 1:self.down] @ weights
+        return out
@@ -0,0 +1,442 @@
+"""
+Results store of the decoding study. Per subject and condition, the cross-validated accuracy of each fold, the ITR,
+the time the decoding took and the questionnaire ratings are kept in one table, keyed by (subject, condition,
+parameters). Updating the store decodes only the entries whose derivative or parameters changed, and the group
+statistics are computed over the whole table at once.
+
+Usage:
+    store = ResultsStore(os.path.join(data_dir, "derivatives", "results"))
+    store.update(data_dir, ["01", "02", "03", "04", "05"])  # decodes subject 05 only
+    accuracy = store.matrix("accuracy")  # (subjects, conditions)
+    summarize(accuracy), anova(accuracy, "Accuracy", store.subjects), paired_test(accuracy, [2, 3], [0, 1])
+"""
+
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from derivatives import get_path, load_derivative
+from crossvalidation import loo_ecca
+
+CONDITIONS = ["classes=5_bw", "classes=5_grating", "classes=30_bw", "classes=30_grating"]
+
+PARAMS = dict(
+    trial_time=4.2,  # decoding window in seconds
+    intertrial_time=0.8,  # ITI in seconds for computing ITR
+    pr=60,  # presentation rate of the codes
+)
+
+QUESTIONNAIRE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "questionnaire.csv")
+RATINGS = ("comfort", "fatigue", "distraction")
+SCALE = 13.6  # the length of the visual analogue scales of the questionnaire in cm, rescaled to 0 to 10
+
+MEASURES = ("accuracy", "itr", "decode_time", "n_trials", "n_classes") + RATINGS
+
+VERSION = 1  # the version of the entries, part of the key of the parameters
+
+
+def get_params_key(params=PARAMS):
+    """
+    Get the key of the decoding parameters, part of the name of each entry.
+
+    Args:
+        params (dict):
+            The decoding parameters. Default: PARAMS
+
+    Returns:
+        (str):
+            The key
+    """
+    return hashlib.sha1(json.dumps([VERSION, params], sort_keys=True).encode()).hexdigest()[:10]
+
+
+def get_fingerprint(data_dir, subject, condition):
+    """
+    Get the fingerprint of a derivative, which changes whenever it is (re)made.
+
+    Args:
+        data_dir (str):
+            The data directory
+        subject (str):
+            The subject, e.g., "01"
+        condition (str):
+            The condition, e.g., "classes=30_bw"
+
+    Returns:
+        (str):
+            The fingerprint, or None if there is no derivative
+    """
+    fn = os.path.join(get_path(data_dir, subject, condition), "info.json")
+    if not os.path.exists(fn):
+        return None
+    with open(fn, "r") as fid:
+        signature = json.load(fid).get("signature")
+    stat = os.stat(fn)
+    return f"{signature}_{stat.st_size}_{stat.st_mtime_ns}"
+
+
+def get_design(derivative, pr=60):
+    """
+    Get the eCCA design of a derivative, as decode() in decoding.ipynb: the codes are shifts of one code by an equal
+    number of bits, and the template spans one code cycle.
+
+    Args:
+        derivative (derivatives.Derivative):
+            The derivative
+        pr (int):
+            The presentation rate of the codes. Default: 60
+
+    Returns:
+        (tuple):
+            The number of classes, the latency in seconds of each class of shape (classes) and the duration of one code
+            cycle in seconds
+    """
+    V = derivative.V
+    if V.shape[0] == 31:  # the 30-class set has a spare code
+        V = V[:-1]
+    n_classes = V.shape[0]
+    n_bits = int(V.shape[1] * pr / derivative.fs)
+    lags = np.arange(n_classes) * ((n_bits // n_classes) / pr)
+    return n_classes, lags, V.shape[1] / derivative.fs
+
+
+def decode_entry(data_dir, subject, condition, params=PARAMS):
+    """
+    Decode one subject and condition with leave-one-out cross-validation of eCCA, as decode() in decoding.ipynb.
+
+    Args:
+        data_dir (str):
+            The data directory
+        subject (str):
+            The subject, e.g., "01"
+        condition (str):
+            The condition, e.g., "classes=30_bw"
+        params (dict):
+            The decoding parameters. Default: PARAMS
+
+    Returns:
+        (dict):
+            The labels, predictions and accuracy of each fold of shape (trials), the number of classes and the time
+            the decoding took in seconds
+    """
+    start = time.perf_counter()
+    derivative = load_derivative(data_dir, subject, condition)
+    y = np.array(derivative.y)
+    n_classes, lags, cycle_size = get_design(derivative, params["pr"])
+    X = derivative.get_data(tmax=params["trial_time"])
+    yh = loo_ecca(X, y, lags, derivative.fs, cycle_size)
+    return dict(y=y, yh=yh, accuracy=(yh == y).astype("float64"), n_classes=n_classes,
+                decode_time=time.perf_counter() - start)
+
+
+def _decode_entry(args):
+    return decode_entry(*args)
+
+
+def load_ratings(fn=QUESTIONNAIRE, subjects=None, conditions=CONDITIONS, scale=SCALE):
+    """
+    Load the questionnaire ratings, averaged over the runs of each subject and condition.
+
+    Args:
+        fn (str):
+            The CSV file with a row per subject, condition and run, and a column per rating. Default: QUESTIONNAIRE
+        subjects (list):
+            The subjects. If None, all subjects in the file. Default: None
+        conditions (list):
+            The conditions. Default: CONDITIONS
+        scale (float):
+            The length of the scales, rescaled to 0 to 10. Default: SCALE
+
+    Returns:
+        (dict):
+            The ratings of shape (subjects, conditions) for each of RATINGS, NaN where missing
+    """
+    table = np.genfromtxt(fn, delimiter=",", names=True, dtype=None, encoding="utf-8", autostrip=True)
+    table = np.atleast_1d(table)
+    subject_column = np.char.zfill(table["subject"].astype("U8"), 2)
+    if subjects is None:
+        subjects = sorted(set(subject_column.tolist()))
+
+    # Map the rows to the cells of the (subjects, conditions) grid, and average all rows of a cell at once
+    i_subject = np.array([subjects.index(s) if s in subjects else -1 for s in subject_column.tolist()])
+    i_condition = np.array([conditions.index(c) if c in conditions else -1 for c in table["condition"].tolist()])
+    keep = (i_subject >= 0) & (i_condition >= 0)
+    cells = i_subject[keep] * len(conditions) + i_condition[keep]
+    counts = np.bincount(cells, minlength=len(subjects) * len(conditions))
+    ratings = dict()
+    for name in RATINGS:
+        sums = np.bincount(cells, weights=table[name][keep].astype("float64"), minlength=counts.size)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ratings[name] = (sums / counts * 10 / scale).reshape((len(subjects), len(conditions)))
+    return ratings
+
+
+class ResultsStore(object):
+    """
+    The results of the decoding study, one entry per subject, condition and parameters, each a small .npz file.
+    """
+
+    def __init__(self, path, params=PARAMS, conditions=CONDITIONS, questionnaire=QUESTIONNAIRE):
+        """
+        Open a results store.
+
+        Args:
+            path (str):
+                The folder of the store, created if it does not exist
+            params (dict):
+                The decoding parameters. Default: PARAMS
+            conditions (list):
+                The conditions. Default: CONDITIONS
+            questionnaire (str):
+                The CSV file of the questionnaire ratings (see load_ratings). Default: QUESTIONNAIRE
+        """
+        self.path = path
+        self.params = params
+        self.conditions = conditions
+        self.questionnaire = questionnaire
+        self.subjects = []
+        self._entries = dict()
+        os.makedirs(path, exist_ok=True)
+
+    def get_fn(self, subject, condition):
+        """
+        Get the file of an entry.
+
+        Args:
+            subject (str):
+                The subject, e.g., "01"
+            condition (str):
+                The condition, e.g., "classes=30_bw"
+
+        Returns:
+            (str):
+                The file of the entry
+        """
+        return os.path.join(self.path, f"{subject}_{condition}_{get_params_key(self.params)}.npz")
+
+    def get_entry(self, subject, condition):
+        """
+        Get an entry, read from its file once.
+
+        Args:
+            subject (str):
+                The subject, e.g., "01"
+            condition (str):
+                The condition, e.g., "classes=30_bw"
+
+        Returns:
+            (dict):
+                The entry (see decode_entry) and the fingerprint of its derivative, or None if there is none
+        """
+        key = (subject, condition)
+        if key not in self._entries:
+            fn = self.get_fn(subject, condition)
+            if not os.path.exists(fn):
+                return None
+            with np.load(fn) as data:
+                self._entries[key] = {name: data[name] for name in data.files}
+                self._entries[key]["fingerprint"] = str(self._entries[key]["fingerprint"])
+        return self._entries[key]
+
+    def update(self, data_dir, subjects, n_workers=None, force=False):
+        """
+        Decode the entries of subjects that are missing, or whose derivative or parameters changed, in parallel.
+
+        Args:
+            data_dir (str):
+                The data directory
+            subjects (list):
+                The subjects, e.g., ["01", "02"]
+            n_workers (int):
+                The maximum number of worker processes. If None, the number of CPUs. Default: None
+            force (bool):
+                Whether to decode entries that are up to date as well. Default: False
+
+        Returns:
+            (list):
+                The (subject, condition) of the entries that were decoded
+        """
+        self.subjects = list(subjects)
+        todo = []
+        for subject in subjects:
+            for condition in self.conditions:
+                fingerprint = get_fingerprint(data_dir, subject, condition)
+                if fingerprint is None:
+                    print(f"No derivative of {subject} {condition}, skipping")
+                    continue
+                entry = self.get_entry(subject, condition)
+                if force or entry is None or entry["fingerprint"] != fingerprint:
+                    todo.append((subject, condition, fingerprint))
+        if not todo:
+            return []
+
+        items = [(data_dir, subject, condition, self.params) for subject, condition, _ in todo]
+        if n_workers == 1 or len(items) == 1:
+            results = list(map(_decode_entry, items))
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                results = list(pool.map(_decode_entry, items))
+
+        for (subject, condition, fingerprint), entry in zip(todo, results):
+            entry["fingerprint"] = fingerprint
+            fn = self.get_fn(subject, condition)
+            tmp = f"{fn}.tmp{os.getpid()}.npz"
+            np.savez(tmp, **entry)
+            os.replace(tmp, fn)
+            self._entries[(subject, condition)] = entry
+            print(f"Decoded {subject} {condition}: accuracy {entry['accuracy'].mean():.2f} in "
+                  f"{entry['decode_time']:.1f} s")
+        return [(subject, condition) for subject, condition, _ in todo]
+
+    def matrix(self, measure, subjects=None):
+        """
+        Get a measure of all subjects and conditions.
+
+        Args:
+            measure (str):
+                The measure, one of MEASURES: the accuracy averaged over folds, the ITR of that accuracy in bits per
+                minute, the time the decoding took in seconds, the number of trials or classes, or one of RATINGS
+            subjects (list):
+                The subjects. If None, those of the last update. Default: None
+
+        Returns:
+            (np.ndarray):
+                The measure of shape (subjects, conditions), NaN where missing
+        """
+        subjects = self.subjects if subjects is None else list(subjects)
+        if measure in RATINGS:
+            return load_ratings(self.questionnaire, subjects, self.conditions)[measure]
+        if measure == "itr":
+            import pyntbci
+            accuracy = self.matrix("accuracy", subjects)
+            n_classes = self.matrix("n_classes", subjects)
+            trial_time = self.params["trial_time"] + self.params["intertrial_time"]
+            itr = np.full(accuracy.shape, np.nan)
+            valid = ~np.isnan(accuracy)
+            itr[valid] = pyntbci.utilities.itr(n_classes[valid], accuracy[valid], np.full(valid.sum(), trial_time))
+            return itr
+
+        values = np.full((len(subjects), len(self.conditions)), np.nan)
+        for i_subject, subject in enumerate(subjects):
+            for i_condition, condition in enumerate(self.conditions):
+                entry = self.get_entry(subject, condition)
+                if entry is None:
+                    continue
+                if measure == "accuracy":
+                    values[i_subject, i_condition] = entry["accuracy"].mean()
+                elif measure == "n_trials":
+                    values[i_subject, i_condition] = entry["y"].size
+                else:
+                    values[i_subject, i_condition] = entry[measure]
+        return values
+
+    def folds(self, subject, condition):
+        """
+        Get the accuracy of each fold of an entry.
+
+        Args:
+            subject (str):
+                The subject, e.g., "01"
+            condition (str):
+                The condition, e.g., "classes=30_bw"
+
+        Returns:
+            (np.ndarray):
+                The accuracy of each fold of shape (folds)
+        """
+        return self.get_entry(subject, condition)["accuracy"]
+
+
+def summarize(values):
+    """
+    Compute the group mean and standard deviation of each condition.
+
+    Args:
+        values (np.ndarray):
+            The measure of shape (..., subjects, conditions), e.g., several measures stacked
+
+    Returns:
+        (tuple):
+            The mean and standard deviation over subjects of shape (..., conditions)
+    """
+    return np.nanmean(values, axis=-2), np.nanstd(values, axis=-2)
+
+
+def long_table(values, name, subjects, conditions=CONDITIONS):
+    """
+    Make the long table of a measure, with the within-subject factors of the conditions, as input to AnovaRM.
+
+    Args:
+        values (np.ndarray):
+            The measure of shape (subjects, conditions)
+        name (str):
+            The name of the column of the measure, e.g., "Accuracy"
+        subjects (list):
+            The subjects
+        conditions (list):
+            The conditions. Default: CONDITIONS
+
+    Returns:
+        (pd.DataFrame):
+            The table with columns Participant, Condition, Classes, Appearance and the measure
+    """
+    import pandas as pd
+    condition_column = np.tile(np.asarray(conditions), len(subjects))
+    classes, appearance = np.char.partition(np.char.replace(condition_column, "classes=", ""), "_")[:, ::2].T
+    return pd.DataFrame({
+        "Participant": np.repeat([f"P{subject}" for subject in subjects], len(conditions)),
+        "Condition": condition_column,
+        "Classes": classes,
+        "Appearance": appearance,
+        name: np.asarray(values).ravel(),
+    })
+
+
+def anova(values, name, subjects, conditions=CONDITIONS):
+    """
+    Fit the two-way repeated measures ANOVA of a measure, with the number of classes and the appearance as factors.
+
+    Args:
+        values (np.ndarray):
+            The measure of shape (subjects, conditions)
+        name (str):
+            The name of the measure, e.g., "Accuracy"
+        subjects (list):
+            The subjects
+        conditions (list):
+            The conditions. Default: CONDITIONS
+
+    Returns:
+        (statsmodels.stats.anova.AnovaResults):
+            The results
+    """
+    from statsmodels.stats.anova import AnovaRM
+    df = long_table(values, name, subjects, conditions)
+    return AnovaRM(df, depvar=name, subject="Participant", within=["Classes", "Appearance"]).fit()
+
+
+def paired_test(values, a, b, alternative="greater"):
+    """
+    Test the mean of conditions a against that of conditions b within subjects with a paired t-test, e.g., the
+    30-class against the 5-class conditions.
+
+    Args:
+        values (np.ndarray):
+            The measure of shape (..., subjects, conditions), e.g., several measures stacked
+        a (list):
+            The indexes of the conditions of the first group
+        b (list):
+            The indexes of the conditions of the second group
+        alternative (str):
+            The alternative hypothesis, see scipy.stats.ttest_rel. Default: "greater"
+
+    Returns:
+        (tuple):
+            The t statistic and p-value of shape (...), and the degrees of freedom
+    """
+    from scipy.stats import ttest_rel
+    values = np.asarray(values)
+    result = ttest_rel(values[..., a].mean(axis=-1), values[..., b].mean(axis=-1), axis=-1, alternative=alternative)
+    return result.statistic, result.pvalue, values.shape[-2] - 1
@@ -0,0 +1,509 @@
+"""
+Hyperparameter search of the eCCA decoding. Configs of a channel subset, a band and a decoding window are evaluated
+for each subject and condition with leave-one-out cross-validation (see crossvalidation.py), spread over processes.
+The intermediates that configs share are cached in the search folder: the trials filtered into each band as a
+memory-mapped array, which workers read instead of receiving pickled trials, and per band and window the eCCA
+statistics of all channels, which each channel subset indexes instead of recomputing them. The results are kept in
+one table, such that a rerun only evaluates new configs and changed derivatives, and are written out ranked.
+
+N.B. the derivatives are already filtered (6-21 Hz, see preprocessing.py), so a band narrows this band. The bands are
+applied to the trials, such that their edges get the padding of the filter instead of the continuous data.
+
+Usage:
+    configs = grid(dict(channels=["all", "occipital"], band=[None, (8.0, 16.0)], trial_time=[2.1, 4.2]))
+    table = run_search(data_dir, ["01", "02"], configs, os.path.join(data_dir, "derivatives", "search"))
+    python search.py 01 02 --random 50 -d data_dir
+"""
+
+import hashlib
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from derivatives import load_derivative
+from crossvalidation import loo_ecca, get_statistics
+from results import CONDITIONS, PARAMS, get_design, get_fingerprint
+
+# Channel subsets by the region of the labels, i.e., the label without its number, e.g., "PO" of "PO7"
+CHANNEL_SETS = {
+    "all": None,
+    "occipital": ("O", "PO", "I"),
+    "parieto-occipital": ("P", "PO", "O", "I"),
+    "centro-parieto-occipital": ("C", "CP", "P", "PO", "O", "I"),
+}
+
+# The config of decode(): all channels, the band of the derivative and the full trial
+CONFIG = dict(channels="all", band=None, trial_time=4.2)
+
+# The default search space, the values of each parameter of a config
+SPACE = dict(
+    channels=list(CHANNEL_SETS),
+    band=[None, (6.0, 15.0), (8.0, 16.0), (8.0, 21.0), (10.0, 21.0)],
+    trial_time=[1.05, 2.1, 3.15, 4.2],
+)
+
+DTYPE = np.dtype([
+    ("subject", "U16"),
+    ("condition", "U32"),
+    ("config", "U10"),  # the key of the config, see get_config_key
+    ("channels", "U256"),
+    ("l_freq", "f8"),  # NaN for the band of the derivative
+    ("h_freq", "f8"),
+    ("trial_time", "f8"),
+    ("fingerprint", "U16"),  # the key of the fingerprint of the derivative
+    ("accuracy", "f8"),
+    ("n_trials", "i4"),
+    ("n_classes", "i4"),
+    ("decode_time", "f8"),
+])
+
+RANK_DTYPE = np.dtype([
+    ("condition", "U32"),
+    ("rank", "i4"),
+    ("config", "U10"),
+    ("channels", "U256"),
+    ("l_freq", "f8"),
+    ("h_freq", "f8"),
+    ("trial_time", "f8"),
+    ("accuracy", "f8"),  # mean over subjects
+    ("accuracy_std", "f8"),
+    ("itr", "f8"),  # mean over subjects
+    ("n_subjects", "i4"),
+])
+
+VERSION = 1  # the version of the table and cached intermediates, part of their names
+
+
+def _get_key(value, n=10):
+    return hashlib.sha1(json.dumps([VERSION, value], sort_keys=True).encode()).hexdigest()[:n]
+
+
+def make_config(config):
+    """
+    Complete a config with the defaults of CONFIG, normalizing the band to floats.
+
+    Args:
+        config (dict):
+            The (partial) config: the channels as the name of a set in CHANNEL_SETS or a list of labels, the band as
+            (l_freq, h_freq) or None for the band of the derivative, and the decoding window in seconds
+
+    Returns:
+        (dict):
+            The config
+    """
+    config = dict(CONFIG, **config)
+    if config["band"] is not None:
+        config["band"] = tuple(float(f) for f in config["band"])
+    if not isinstance(config["channels"], str):
+        config["channels"] = list(config["channels"])
+    config["trial_time"] = float(config["trial_time"])
+    return config
+
+
+def get_config_key(config):
+    """
+    Get the key of a config, under which its results are kept.
+
+    Args:
+        config (dict):
+            The config, see make_config
+
+    Returns:
+        (str):
+            The key
+    """
+    return _get_key(make_config(config))
+
+
+def grid(space=SPACE):
+    """
+    Get the configs of a grid search: all combinations of the values of the parameters.
+
+    Args:
+        space (dict):
+            The values of each parameter. Default: SPACE
+
+    Returns:
+        (list):
+            The configs
+    """
+    names = list(space)
+    return [make_config(dict(zip(names, values))) for values in itertools.product(*[space[name] for name in names])]
+
+
+def sample(space=SPACE, n_configs=50, seed=None):
+    """
+    Get the configs of a random search: combinations of the values of the parameters drawn without replacement.
+
+    Args:
+        space (dict):
+            The values of each parameter. Default: SPACE
+        n_configs (int):
+            The number of configs, at most the size of the grid. Default: 50
+        seed (int):
+            The seed of the random generator. Default: None
+
+    Returns:
+        (list):
+            The configs
+    """
+    configs = grid(space)
+    rng = np.random.default_rng(seed)
+    return [configs[i] for i in rng.permutation(len(configs))[:n_configs]]
+
+
+def resolve_channels(channels, labels):
+    """
+    Get the indexes of the channels of a config.
+
+    Args:
+        channels (str | list):
+            The name of a set in CHANNEL_SETS or a list of labels
+        labels (list):
+            The labels of the channels of the derivative
+
+    Returns:
+        (np.ndarray):
+            The indexes of the channels in labels
+    """
+    if not isinstance(channels, str):
+        return np.array([labels.index(label) for label in channels])
+    if channels not in CHANNEL_SETS:
+        raise Exception("Unknown channel set:", channels)
+    if CHANNEL_SETS[channels] is None:
+        return np.arange(len(labels))
+    regions = [label.rstrip("0123456789z") for label in labels]
+    return np.array([i for i, region in enumerate(regions) if region in CHANNEL_SETS[channels]])
+
+
+def load_band(derivative, band, path):
+    """
+    Load the trials of a derivative filtered into a band, filtering them only if they are not cached yet.
+
+    Args:
+        derivative (derivatives.Derivative):
+            The derivative
+        band (tuple):
+            The (l_freq, h_freq) of the band, see filterbank.design_filter. If None, the trials of the derivative
+        path (str):
+            The cache folder of the derivative
+
+    Returns:
+        (np.ndarray):
+            The trials of shape (trials, channels, samples), read-only memory-mapped
+    """
+    if band is None:
+        return derivative.X
+    from filterbank import FilterBank
+    bank = FilterBank(derivative.fs, [band])
+    fn = os.path.join(path, f"{bank.get_key(0)}.npy")
+    if not os.path.exists(fn):
+        # Filter all trials and channels as one (trials * channels, samples) array
+        n_samples = derivative.X.shape[2]
+        x = np.asarray(derivative.X, dtype="float64").reshape((-1, n_samples))
+        os.makedirs(path, exist_ok=True)
+        tmp = f"{fn}.tmp{os.getpid()}.npy"
+        out = np.lib.format.open_memmap(tmp, mode="w+", dtype="float32", shape=derivative.X.shape)
+        bank.apply(x, [out.reshape((-1, n_samples))])
+        out.flush()
+        del out
+        os.replace(tmp, fn)
+    return np.load(fn, mmap_mode="r")
+
+
+def load_statistics(X, y, shifts, n_cycle, fn):
+    """
+    Load the eCCA statistics of trials (see crossvalidation.get_statistics), computing them only if they are not
+    cached yet.
+
+    Args:
+        X (np.ndarray):
+            The trials of shape (trials, channels, samples)
+        y (np.ndarray):
+            The labels of shape (trials)
+        shifts (np.ndarray):
+            The latency of each class in samples of shape (classes)
+        n_cycle (int):
+            The number of samples of one code cycle
+        fn (str):
+            The file to cache the statistics in
+
+    Returns:
+        (tuple):
+            The statistics, see crossvalidation.get_statistics
+    """
+    if os.path.exists(fn):
+        with np.load(fn) as data:
+            return data["Z"], data["S"], data["G"], int(data["n_cycles"])
+    Z, S, G, n_cycles = get_statistics(np.asarray(X, dtype="float64"), y, shifts, n_cycle)
+    tmp = f"{fn}.tmp{os.getpid()}.npz"
+    np.savez(tmp, Z=Z, S=S, G=G, n_cycles=n_cycles)
+    os.replace(tmp, fn)
+    return Z, S, G, n_cycles
+
+
+def evaluate(data_dir, subject, condition, band, configs, cache_dir, fingerprint, pr=PARAMS["pr"]):
+    """
+    Evaluate configs of one band on one subject and condition. The filtered trials and the statistics of each
+    decoding window are loaded once and shared by the configs.
+
+    Args:
+        data_dir (str):
+            The data directory
+        subject (str):
+            The subject, e.g., "01"
+        condition (str):
+            The condition, e.g., "classes=30_bw"
+        band (tuple):
+            The band of the configs, see load_band
+        configs (list):
+            The configs, see make_config
+        cache_dir (str):
+            The folder to cache the intermediates in
+        fingerprint (str):
+            The key of the fingerprint of the derivative, part of the name of its cache folder
+        pr (int):
+            The presentation rate of the codes. Default: PARAMS["pr"]
+
+    Returns:
+        (np.ndarray):
+            The results as a structured array of DTYPE, one row per config
+    """
+    derivative = load_derivative(data_dir, subject, condition)
+    fs = derivative.fs
+    y = np.array(derivative.y).astype("int")
+    n_classes, lags, cycle_size = get_design(derivative, pr)
+    shifts = np.array([int(np.round(lag * fs)) for lag in lags])
+    n_cycle = int(cycle_size * fs)
+
+    path = os.path.join(cache_dir, f"{subject}_{condition}_{fingerprint}_pr{pr}")
+    os.makedirs(path, exist_ok=True)
+    start = time.perf_counter()
+    X = load_band(derivative, band, path)
+    band_key = "derivative" if band is None else f"{band[0]}-{band[1]}"
+    setup_time = time.perf_counter() - start
+
+    rows = np.zeros(len(configs), dtype=DTYPE)
+    statistics = dict()
+    for row, config in zip(rows, configs):
+        start = time.perf_counter()
+        n_samples = int(round(config["trial_time"] * fs))
+        if n_samples not in statistics:
+            fn = os.path.join(path, f"{band_key}_{n_samples}_statistics.npz")
+            statistics[n_samples] = load_statistics(X[:, :, :n_samples], y, shifts, n_cycle, fn)
+
+        # The statistics of a channel subset are those of all channels indexed to the subset
+        picks = resolve_channels(config["channels"], derivative.channels)
+        Z, S, G, n_cycles = statistics[n_samples]
+        try:
+            yh = loo_ecca(X[:, picks, :n_samples], y, lags, fs, cycle_size,
+                          statistics=(Z[:, picks], S[:, picks], G[:, picks][:, :, picks], n_cycles))
+            accuracy = np.mean(yh == y)
+        except np.linalg.LinAlgError as error:
+            # An ill-conditioned config (see crossvalidation.MAX_CONDITION) gets no accuracy, and is ranked last
+            print(f"Failed {subject} {condition} {get_config_key(config)}: {error}")
+            accuracy = np.nan
+
+        row["subject"], row["condition"], row["config"] = subject, condition, get_config_key(config)
+        row["channels"] = config["channels"] if isinstance(config["channels"], str) else ",".join(config["channels"])
+        row["l_freq"], row["h_freq"] = (np.nan, np.nan) if band is None else band
+        row["trial_time"] = config["trial_time"]
+        row["fingerprint"] = fingerprint
+        row["accuracy"] = accuracy
+        row["n_trials"], row["n_classes"] = y.size, n_classes
+        row["decode_time"] = time.perf_counter() - start
+    rows["decode_time"] += setup_time / len(configs)
+    return rows
+
+
+def _evaluate(args):
+    return evaluate(*args)
+
+
+def run_search(data_dir, subjects, configs, path, conditions=CONDITIONS, n_workers=None, pr=PARAMS["pr"],
+               force=False):
+    """
+    Evaluate configs on all subjects and conditions in parallel, skipping those in the results table of the search
+    whose derivative did not change. Each task is one subject, condition and band, such that the configs that share
+    intermediates are evaluated by one worker. The table and its ranking (see rank) are written to the search folder.
+
+    Args:
+        data_dir (str):
+            The data directory
+        subjects (list):
+            The subjects, e.g., ["01", "02"]
+        configs (list):
+            The configs, see make_config, grid and sample
+        path (str):
+            The folder of the search, with the results table, the ranking and the cached intermediates
+        conditions (list):
+            The conditions. Default: CONDITIONS
+        n_workers (int):
+            The maximum number of worker processes. If None, the number of CPUs. Default: None
+        pr (int):
+            The presentation rate of the codes. Default: PARAMS["pr"]
+        force (bool):
+            Whether to evaluate configs that are in the table as well. Default: False
+
+    Returns:
+        (np.ndarray):
+            The results table as a structured array of DTYPE, with the rows of earlier searches
+    """
+    configs = [make_config(config) for config in configs]
+    keys = [get_config_key(config) for config in configs]
+    os.makedirs(path, exist_ok=True)
+    fn = os.path.join(path, f"search_v{VERSION}.npy")
+    table = np.load(fn) if os.path.exists(fn) else np.zeros(0, dtype=DTYPE)
+    done = set(zip(table["subject"].tolist(), table["condition"].tolist(), table["config"].tolist(),
+                   table["fingerprint"].tolist()))
+
+    # Group the configs to evaluate by subject, condition and band
+    tasks = dict()
+    for subject in subjects:
+        for condition in conditions:
+            fingerprint = get_fingerprint(data_dir, subject, condition)
+            if fingerprint is None:
+                print(f"No derivative of {subject} {condition}, skipping")
+                continue
+            fingerprint = _get_key(fingerprint, 16)
+            for config, key in zip(configs, keys):
+                if force or (subject, condition, key, fingerprint) not in done:
+                    tasks.setdefault((subject, condition, config["band"], fingerprint), []).append(config)
+    if not tasks:
+        return table
+
+    items = [(data_dir, subject, condition, band, task, os.path.join(path, "cache"), fingerprint, pr)
+             for (subject, condition, band, fingerprint), task in tasks.items()]
+    print(f"Evaluating {sum(len(task) for task in tasks.values())} configs in {len(items)} tasks")
+    if n_workers == 1 or len(items) == 1:
+        results = list(map(_evaluate, items))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(_evaluate, items))
+
+    # Replace the rows of the evaluated configs, e.g., of a changed derivative
+    new = np.concatenate(results)
+    evaluated = set(zip(new["subject"].tolist(), new["condition"].tolist(), new["config"].tolist()))
+    keep = [key not in evaluated for key in zip(table["subject"].tolist(), table["condition"].tolist(),
+                                                table["config"].tolist())]
+    table = np.concatenate([table[np.array(keep, dtype="bool")], new])
+    table = table[np.lexsort((table["config"], table["condition"], table["subject"]))]
+
+    # Write to a temporary file first, such that readers never see a partial table
+    tmp = f"{fn}.tmp{os.getpid()}.npy"
+    np.save(tmp, table)
+    os.replace(tmp, fn)
+    write_ranking(rank(table, subjects, conditions), os.path.join(path, "ranking.csv"))
+    return table
+
+
+def rank(table, subjects=None, conditions=None, intertrial_time=PARAMS["intertrial_time"]):
+    """
+    Rank the configs of each condition by their accuracy averaged over subjects, ties broken by the ITR. Configs
+    that are missing for some subjects are ranked after those of all subjects, and configs that failed for a subject
+    (NaN accuracy, see evaluate) last.
+
+    Args:
+        table (np.ndarray):
+            The results table as a structured array of DTYPE
+        subjects (list):
+            The subjects to average over. If None, all subjects in the table. Default: None
+        conditions (list):
+            The conditions. If None, all conditions in the table. Default: None
+        intertrial_time (float):
+            The time between trials in seconds, added to the decoding window for the ITR. Default:
+            PARAMS["intertrial_time"]
+
+    Returns:
+        (np.ndarray):
+            The ranking as a structured array of RANK_DTYPE, one row per condition and config
+    """
+    import pyntbci
+    if subjects is not None:
+        table = table[np.isin(table["subject"], subjects)]
+    if conditions is not None:
+        table = table[np.isin(table["condition"], conditions)]
+    if table.size == 0:
+        return np.zeros(0, dtype=RANK_DTYPE)
+    itr = pyntbci.utilities.itr(table["n_classes"], table["accuracy"], table["trial_time"] + intertrial_time)
+
+    # Aggregate the subjects of each condition and config at once
+    groups, first, inverse = np.unique(np.char.add(np.char.add(table["condition"], "_"), table["config"]),
+                                       return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    n = np.bincount(inverse)
+    mean = np.bincount(inverse, table["accuracy"]) / n
+    std = np.sqrt(np.maximum(np.bincount(inverse, table["accuracy"] ** 2) / n - mean ** 2, 0))
+
+    ranking = np.zeros(groups.shape[0], dtype=RANK_DTYPE)
+    for name in ("condition", "config", "channels", "l_freq", "h_freq", "trial_time"):
+        ranking[name] = table[name][first]
+    ranking["accuracy"], ranking["accuracy_std"] = mean, std
+    ranking["itr"] = np.bincount(inverse, itr) / n
+    ranking["n_subjects"] = n
+
+    # Sort by condition, then by the number of subjects, accuracy and ITR in descending order
+    ranking = ranking[np.lexsort((-ranking["itr"], -ranking["accuracy"], -ranking["n_subjects"],
+                                  ranking["condition"]))]
+    _, starts, counts = np.unique(ranking["condition"], return_index=True, return_counts=True)
+    ranking["rank"] = 1 + np.arange(ranking.size) - np.repeat(starts, counts)
+    return ranking
+
+
+def write_ranking(ranking, fn):
+    """
+    Write a ranking to a CSV file.
+
+    Args:
+        ranking (np.ndarray):
+            The ranking as a structured array of RANK_DTYPE, see rank
+        fn (str):
+            The CSV file
+    """
+    tmp = f"{fn}.tmp{os.getpid()}"
+    with open(tmp, "w") as fid:
+        fid.write(",".join(RANK_DTYPE.names) + "\n")
+        for row in ranking.tolist():
+            fid.write(",".join(f'"{value}"' if isinstance(value, str) and "," in value else
+                               f"{value:.4f}" if isinstance(value, float) else str(value) for value in row) + "\n")
+    os.replace(tmp, fn)
+
+
+def print_ranking(ranking, n_best=5):
+    """
+    Print the best configs of each condition.
+
+    Args:
+        ranking (np.ndarray):
+            The ranking as a structured array of RANK_DTYPE, see rank
+        n_best (int):
+            The number of configs per condition. Default: 5
+    """
+    print("condition\t\trank\tchannels\t\tband\t\twindow\taccuracy\titr\tsubjects")
+    for row in ranking[ranking["rank"] <= n_best]:
+        band = "derivative" if np.isnan(row["l_freq"]) else f"{row['l_freq']:g}-{row['h_freq']:g} Hz"
+        print(f"{row['condition']}\t{row['rank']}\t{row['channels'][:20]:<20}\t{band:<12}\t{row['trial_time']:g}\t"
+              f"{row['accuracy']:.3f} ({row['accuracy_std']:.3f})\t{row['itr']:.1f}\t{row['n_subjects']}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Hyperparameter search of the eCCA decoding")
+    parser.add_argument("subjects", type=str, nargs="+", help="subjects, e.g., 01 02")
+    parser.add_argument("-d", "--data-dir", type=str, help="data directory",
+                        default=os.path.join(os.path.expanduser("~"), "ideaProjects", "programming", "BCI", "Thesis", "steven", "steven"))
+    parser.add_argument("-o", "--output", type=str, help="folder of the search, if not derivatives/search",
+                        default=None)
+    parser.add_argument("-r", "--random", type=int, help="number of random configs, if not the full grid",
+                        default=None)
+    parser.add_argument("--seed", type=int, help="seed of the random search", default=None)
+    parser.add_argument("-w", "--workers", type=int, help="maximum number of worker processes", default=None)
+    parser.add_argument("-f", "--force", action="store_true", help="evaluate configs that are in the table as well")
+    args = parser.parse_args()
+
+    configs = grid() if args.random is None else sample(n_configs=args.random, seed=args.seed)
+    path = os.path.join(args.data_dir, "derivatives", "search") if args.output is None else args.output
+    table = run_search(args.data_dir, args.subjects, configs, path, n_workers=args.workers, force=args.force)
+    print_ranking(rank(table, args.subjects))
@@ -0,0 +1,318 @@
+"""
+Synthetic c-VEP data. The codes of a code set are convolved with a transient response kernel, projected onto the
+channels of the BioSemi 64 cap with an occipital pattern, and mixed with spatially correlated 1/f noise. The data
+are written as derivatives (see derivatives.py), such that the analyses run without the recorded data.
+
+Usage:
+    python synthetic.py ~/synthetic 01 02 --trials 60 --snr 0.05
+"""
+
+import os
+import numpy as np
+from mne.filter import filter_data
+from derivatives import CAPFILE, read_channels, save_derivative, get_path
+
+CODES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "codes")
+
+# The conditions and their code sets, as preprocessing.py writes them
+CONDITIONS = {
+    "classes=30_bw": "m_sequence_shift_classes=30",
+    "classes=5_grating": "m_sequence_shift_classes=5",
+    "classes=5_bw": "m_sequence_shift_classes=5",
+    "classes=30_grating": "m_sequence_shift_classes=30",
+}
+
+# The peaks of the transient response: latency (s), amplitude and width (s), resembling the N70, P100 and N135
+PEAKS = ((0.07, -0.8, 0.012), (0.10, 1.0, 0.015), (0.135, -0.6, 0.02))
+
+FS = 120
+PR = 60
+
+
+def load_codes(name, fs=FS, pr=PR, path=CODES):
+    """
+    Load a code set at the sampling frequency.
+
+    Args:
+        name (str):
+            The name of the code set, i.e., its .npz file in path
+        fs (int):
+            The sampling frequency. Default: FS
+        pr (int):
+            The presentation rate of the codes. Default: PR
+        path (str):
+            The folder of the code sets. Default: CODES
+
+    Returns:
+        (np.ndarray):
+            The codes of shape (classes, samples)
+    """
+    data = np.load(os.path.join(path, f"{name}.npz"))
+    V = data["codes_real"] if "codes_real" in data else data["codes"].T
+    return np.repeat(V, int(fs / pr), axis=1).astype("uint8")
+
+
+def shift_codes(code, n_classes):
+    """
+    Make the circular shifts of a code with an equal distance between classes, as the m-sequence code sets.
+
+    Args:
+        code (np.ndarray):
+            The code of shape (samples)
+        n_classes (int):
+            The number of classes, at most the number of samples
+
+    Returns:
+        (tuple):
+            The codes of shape (classes, samples), and the shift in samples between consecutive classes
+    """
+    stride = code.size // n_classes
+    assert stride > 0, f"Cannot make {n_classes} shifts of a code of {code.size} samples"
+    idx = (np.arange(code.size)[np.newaxis, :] - stride * np.arange(n_classes)[:, np.newaxis]) % code.size
+    return code[idx], stride
+
+
+def read_positions(capfile=CAPFILE):
+    """
+    Read the 2D positions of the channels from a cap file (EEGLAB polar coordinates).
+
+    Args:
+        capfile (str):
+            The cap file. Default: CAPFILE
+
+    Returns:
+        (np.ndarray):
+            The (x, y) positions of the channels of shape (channels, 2), the nose pointing to positive y
+    """
+    with open(capfile, "r") as fid:
+        fields = [line.split() for line in fid.readlines() if line.strip()]
+    theta = np.deg2rad([float(field[1]) for field in fields])
+    radius = np.array([float(field[2]) for field in fields])
+    return np.stack((radius * np.sin(theta), radius * np.cos(theta)), axis=1)
+
+
+def select_channels(n_channels, center="Oz"):
+    """
+    Select the channels closest to a channel, e.g., the occipital channels for c-VEP.
+
+    Args:
+        n_channels (int):
+            The number of channels
+        center (str):
+            The label of the channel at the center of the selection. Default: "Oz"
+
+    Returns:
+        (np.ndarray):
+            The indexes of the channels in the cap, in cap order
+    """
+    positions = read_positions()
+    distance = np.linalg.norm(positions - positions[read_channels().index(center)], axis=1)
+    return np.sort(np.argsort(distance, kind="stable")[:n_channels])
+
+
+def make_kernel(fs=FS, peaks=PEAKS, duration=0.3):
+    """
+    Make a transient response kernel as a sum of Gaussian peaks.
+
+    Args:
+        fs (int):
+            The sampling frequency. Default: FS
+        peaks (tuple):
+            The (latency, amplitude, width) of each peak, in seconds. Default: PEAKS
+        duration (float):
+            The duration of the kernel in seconds. Default: 0.3
+
+    Returns:
+        (np.ndarray):
+            The kernel of shape (samples) with a maximum absolute value of 1
+    """
+    t = np.arange(int(duration * fs)) / fs
+    kernel = np.zeros(t.size)
+    for latency, amplitude, width in peaks:
+        kernel += amplitude * np.exp(-0.5 * ((t - latency) / width) ** 2)
+    return kernel / np.abs(kernel).max()
+
+
+def make_noise(n_trials, n_channels, n_samples, fs=FS, exponent=1.0, alpha=1.0, length=0.3, sensor=0.1, channels=None,
+               rng=None):
+    """
+    Make spatially correlated colored noise: a 1/f^exponent spectrum with an alpha peak, mixed over the channels with
+    a correlation that decays with their distance on the scalp, plus independent white noise per channel.
+
+    Args:
+        n_trials (int):
+            The number of trials
+        n_channels (int):
+            The number of channels
+        n_samples (int):
+            The number of samples
+        fs (int):
+            The sampling frequency. Default: FS
+        exponent (float):
+            The exponent of the 1/f power spectrum. Default: 1.0
+        alpha (float):
+            The amplitude of the alpha (10 Hz) peak relative to the 1/f spectrum at 10 Hz. Default: 1.0
+        length (float):
+            The distance at which the correlation between channels decays to 1/e, in units of the cap radius.
+            Default: 0.3
+        sensor (float):
+            The amplitude of the independent white noise relative to the correlated noise. Default: 0.1
+        channels (np.ndarray):
+            The indexes of the channels in the cap. If None, the channels closest to Oz. Default: None
+        rng (np.random.Generator):
+            The random generator. Default: None
+
+    Returns:
+        (np.ndarray):
+            The noise of shape (trials, channels, samples) with unit variance per channel
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    if channels is None:
+        channels = select_channels(n_channels)
+
+    # Temporal: shape white noise in the frequency domain
+    f = np.fft.rfftfreq(n_samples, 1 / fs)
+    amplitude = np.zeros(f.size)
+    amplitude[1:] = f[1:] ** (-exponent / 2)
+    amplitude += alpha * 10 ** (-exponent / 2) * np.exp(-0.5 * ((f - 10) / 1.0) ** 2)
+    noise = np.fft.irfft(np.fft.rfft(rng.standard_normal((n_trials, n_channels, n_samples))) * amplitude, n=n_samples)
+
+    # Spatial: mix by the Cholesky factor of the correlation of the channels
+    positions = read_positions()[channels]
+    distance = np.linalg.norm(positions[:, np.newaxis, :] - positions[np.newaxis, :, :], axis=2)
+    mixing = np.linalg.cholesky(np.exp(-distance / length) + 1e-6 * np.eye(n_channels))
+    noise = np.einsum("ij,tjs->tis", mixing, noise / noise.std())
+    noise += sensor * rng.standard_normal(noise.shape)
+    return noise / noise.std(axis=(0, 2), keepdims=True)
+
+
+def make_data(V, y, fs=FS, n_channels=64, trial_time=4.2, kernel=None, snr=0.05, l_freq=6.0, h_freq=21.0, scale=1e-5,
+              seed=None, **kwargs):
+    """
+    Make synthetic trials: the response to the code of each trial on an occipital pattern plus colored noise.
+
+    Args:
+        V (np.ndarray):
+            The codes at the sampling frequency of shape (classes, samples)
+        y (np.ndarray):
+            The labels of shape (trials)
+        fs (int):
+            The sampling frequency. Default: FS
+        n_channels (int):
+            The number of channels, those closest to Oz. Default: 64
+        trial_time (float):
+            The duration of a trial in seconds, the codes are repeated. Default: 4.2
+        kernel (np.ndarray):
+            The transient response kernel. If None, make_kernel(fs). Default: None
+        snr (float):
+            The ratio of the variance of the response and the noise at the center of the pattern. Default: 0.05
+        l_freq (float):
+            The lower pass-band edge of the band-pass filter, the FIR filter of preprocessing. If None, no filter.
+            Default: 6.0
+        h_freq (float):
+            The upper pass-band edge of the band-pass filter. Default: 21.0
+        scale (float):
+            The amplitude of the noise, in volts. Default: 1e-5
+        seed (int):
+            The seed of the random generator. Default: None
+        **kwargs:
+            The parameters of the noise (see make_noise)
+
+    Returns:
+        (np.ndarray):
+            The trials of shape (trials, channels, samples) of float32
+    """
+    rng = np.random.default_rng(seed)
+    if kernel is None:
+        kernel = make_kernel(fs)
+    n_samples = int(trial_time * fs)
+    channels = select_channels(n_channels)
+
+    # The response to each code, the codes repeated over the trial
+    n_tiles = int(np.ceil(n_samples / V.shape[1]))
+    responses = np.array([np.convolve(np.tile(code, n_tiles), kernel)[:n_samples] for code in V.astype("float")])
+    responses /= responses.std()
+
+    # The pattern of the response, centered on Oz
+    positions = read_positions()
+    distance = np.linalg.norm(positions[channels] - positions[read_channels().index("Oz")], axis=1)
+    pattern = np.exp(-0.5 * (distance / 0.2) ** 2)
+
+    noise = make_noise(len(y), n_channels, n_samples, fs, channels=channels, rng=rng, **kwargs)
+    X = np.sqrt(snr) * pattern[np.newaxis, :, np.newaxis] * responses[y][:, np.newaxis, :] + noise
+    if l_freq is not None:
+        X = filter_data(X, fs, l_freq, h_freq, verbose=False)
+    return (scale * X).astype("float32")
+
+
+def make_labels(n_trials, n_classes, seed=None):
+    """
+    Make balanced labels in random order, as the speller presents its cues.
+
+    Args:
+        n_trials (int):
+            The number of trials
+        n_classes (int):
+            The number of classes
+        seed (int):
+            The seed of the random generator. Default: None
+
+    Returns:
+        (np.ndarray):
+            The labels of shape (trials) of uint8
+    """
+    rng = np.random.default_rng(seed)
+    return rng.permutation(np.arange(n_classes).repeat(int(np.ceil(n_trials / n_classes))))[:n_trials].astype("uint8")
+
+
+def make_subject(data_dir, subject, n_trials=60, n_channels=64, seed=0, **kwargs):
+    """
+    Write synthetic derivatives of all conditions of a subject, in the layout of preprocessing.py.
+
+    Args:
+        data_dir (str):
+            The data directory
+        subject (str):
+            The subject, e.g., "01"
+        n_trials (int):
+            The number of trials per condition. Default: 60
+        n_channels (int):
+            The number of channels. Default: 64
+        seed (int):
+            The seed of the random generator, combined with the subject and condition. Default: 0
+        **kwargs:
+            The parameters of the data (see make_data)
+
+    Returns:
+        (list):
+            The folders of the derivatives
+    """
+    fs = kwargs.pop("fs", FS)
+    channels = [read_channels()[i] for i in select_channels(n_channels)]
+    done = []
+    for i_condition, (condition, codename) in enumerate(CONDITIONS.items()):
+        V = load_codes(codename, fs)
+        n_classes = 30 if V.shape[0] == 31 else V.shape[0]  # the 30-class set has a spare code
+        y = make_labels(n_trials, n_classes, seed=[seed, i_condition, *subject.encode()])
+        X = make_data(V, y, fs, n_channels, seed=[seed, i_condition, 1, *subject.encode()], **kwargs)
+        path = get_path(data_dir, subject, condition)
+        save_derivative(path, X, y, V, fs, condition, codename, channels=channels, signature="synthetic")
+        print(f"{os.path.basename(path)}: X {X.shape}, y {y.shape}, V {V.shape}")
+        done.append(path)
+    return done
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Write synthetic c-VEP derivatives")
+    parser.add_argument("data_dir", type=str, help="data directory")
+    parser.add_argument("subjects", type=str, nargs="+", help="subjects, e.g., 01 02")
+    parser.add_argument("-n", "--trials", type=int, help="number of trials per condition", default=60)
+    parser.add_argument("-c", "--channels", type=int, help="number of channels", default=64)
+    parser.add_argument("--snr", type=float, help="signal to noise ratio", default=0.05)
+    parser.add_argument("--seed", type=int, help="seed of the random generator", default=0)
+    args = parser.parse_args()
+
+    for subject in args.subjects:
+        make_subject(args.data_dir, subject, args.trials, args.channels, args.seed, snr=args.snr)
@@ -7,6 +7,7 @@ Python implementation of a keyboard for the noise-tagging project.
 """
 
 
+import os
 from PIL import Image, ImageDraw, ImageFont
 
 
@@ -14,41 +15,89 @@ path = "/Users/u829215/pynt_codes/experiment/images"
 width = 150
 height = 150
 keys = [
-        "A", "B", "C", "D", "E", "F", "G", "H", 
-        "I", "J", "K", "L", "M", "N", "O", "P", 
-        "Q", "R", "S", "T", "U", "V", "W", "X", 
+        "A", "B", "C", "D", "E", "F", "G", "H",
+        "I", "J", "K", "L", "M", "N", "O", "P",
+        "Q", "R", "S", "T", "U", "V", "W", "X",
         "Y", "Z", "_", ".", "?", "!", "<", "#",
 		"1", "2", "3", "4", "5", "6", "7", "8",
 		"9", "0"]
 colors = ["black", "white", "green", "blue"]
 text_color = (128, 128, 128)
+font_file = "/System/Library/Fonts/Supplemental/Courier New Bold.ttf"
+font_size = 30
 
-# Set font type
-font = ImageFont.truetype("/System/Library/Fonts/Supplemental/Courier New Bold.ttf", size=30)
+# Size of the bw images shipped in images/ (see images/generate_images.py)
+bw_width = 100
+bw_height = 100
 
-# Speller symbols
-for key in keys:
-	for color in colors:
-		img = Image.new("RGB", (width, height), color=color)
+
+def get_font_file():
+	"""
+	Get the font file that the symbols are actually rendered with.
+
+	Returns:
+		(str):
+			The font file, or None if it is not available and the default font is used
+	"""
+	return font_file if os.path.exists(font_file) else None
+
+
+def load_font():
+	"""
+	Load the font of the symbols, falling back to the default font if the font file is not available.
+
+	Returns:
+		(ImageFont):
+			The font
+	"""
+	if get_font_file() is not None:
+		return ImageFont.truetype(font_file, size=font_size)
+	print(f"Warning: font file {font_file} not found, the symbols are rendered in the default font instead")
+	return ImageFont.load_default(size=font_size)
+
+
+def render_key(symbol, color, font=None, size=(width, height)):
+	"""
+	Render the image of a key: a symbol centered on a colored background.
+
+	Args:
+		symbol (str):
+			The symbol. If None, the image has no symbol
+		color (str):
+			The color of the background
+		font (ImageFont):
+			The font of the symbol. If None, it is loaded with load_font(). Default: None
+		size (array-like):
+			The (width, height) of the image in pixels. Default: (width, height)
+
+	Returns:
+		(Image):
+			The image
+	"""
+	img = Image.new("RGB", tuple(size), color=color)
+	if symbol is not None:
+		font = load_font() if font is None else font
 		img_draw = ImageDraw.Draw(img)
-		text_width, text_height = img_draw.textsize(key, font=font)
-		x_pos = (width - text_width) / 2
-		y_pos = (height - text_height) / 2
-		img_draw.text((x_pos, y_pos), key, font=font, fill=text_color)
-		img.save(f"{key}_{color}.png")
-
-# VEP fixation
-for color in colors:
-	img = Image.new("RGB", (width, height), color=color)
-	img_draw = ImageDraw.Draw(img)
-	text_width, text_height = img_draw.textsize("+", font=font)
-	x_pos = (width - text_width) / 2
-	y_pos = (height - text_height) / 2
-	img_draw.text((x_pos, y_pos), "+", font=font, fill=text_color)
-	img.save(f"+_{color}.png")
-
-# No symbol
-for color in colors:
-	img = Image.new("RGB", (width, height), color=color)
-	img_draw = ImageDraw.Draw(img)
-	img.save(f"{color}.png")
\ No newline at end of file
+		_, _, text_width, text_height = img_draw.textbbox((0, 0), symbol, font=font)
+		x_pos = (size[0] - text_width) / 2
+		y_pos = (size[1] - text_height) / 2
+		img_draw.text((x_pos, y_pos), symbol, font=font, fill=text_color)
+	return img
+
+
+if __name__ == "__main__":
+	# Set font type
+	font = load_font()
+
+	# Speller symbols
+	for key in keys:
+		for color in colors:
+			render_key(key, color, font).save(f"{key}_{color}.png")
+
+	# VEP fixation
+	for color in colors:
+		render_key("+", color, font).save(f"+_{color}.png")
+
+	# No symbol
+	for color in colors:
+		render_key(None, color).save(f"{color}.png")
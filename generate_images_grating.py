@@ -1,3 +1,5 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image, ImageDraw
 import numpy as np
 #188 for steven's laptop 150 for lab-computer
@@ -13,14 +15,20 @@ FONT_SIZE = 30
 #121
 GRAY_COLOR = (121,121,121)
 
+# Gabor patches of the grating
+GAMMA = 0.6
+LAMDA = 5
+PHI = 0.0
+SIGMA = 2
+CONTRAST_SCALING = 0.62
+
 KEYS = [
-    "!"]
-    #, "@", "#", "$", "%", "^", "&", "asterisk", "(", ")", "_", "+",  # 12
-    #"1", "2", "3", "4", "5", "6", "7", "8", "9", "0", "-", "=",  # 12
-    #"Q", "W", "E", "R", "T", "Y", "U", "I", "O", "P", "[", "]",  # 12
-    #"A", "S", "D", "F", "G", "H", "J", "K", "L", "colon", "quote", "bar",  # 12
-    #"tilde", "Z", "X", "C", "V", "B", "N", "M", "comma", ".", "question", "slash",  # 12
-    #"smaller", "space", "larger"]  # 3
+    "!", "@", "#", "$", "%", "^", "&", "asterisk", "(", ")", "_", "+",  # 12
+    "1", "2", "3", "4", "5", "6", "7", "8", "9", "0", "-", "=",  # 12
+    "Q", "W", "E", "R", "T", "Y", "U", "I", "O", "P", "[", "]",  # 12
+    "A", "S", "D", "F", "G", "H", "J", "K", "L", "colon", "quote", "bar",  # 12
+    "tilde", "Z", "X", "C", "V", "B", "N", "M", "comma", ".", "question", "slash",  # 12
+    "smaller", "space", "larger"]  # 3
 KEY_MAPPING = {  # Windows does not allow / , : * ? " < > | ~ in file names
     "slash": "/",
     "comma": ",",
@@ -34,63 +42,181 @@ KEY_MAPPING = {  # Windows does not allow / , : * ? " < > | ~ in file names
     "tilde": "~",
 }
 
-#sigma = 4 normally,
-#def generate_gabor_patch(size=(60, 60), theta=np.pi / 2, gamma=1, lamda=1, phi=0.0, sigma=0.4):
-def generate_gabor_patch(size=(60, 60), theta=np.pi / 2, gamma=0.6, lamda=5, phi=0.0, sigma=2):
-    x, y = np.meshgrid(
+
+def make_grid(size=(60, 60)):
+    """
+    Make the pixel grid of a gabor patch, centered at zero.
+
+    Args:
+        size (array-like):
+            The (height, width) of the patch in pixels. Default: (60, 60)
+
+    Returns:
+        (tuple):
+            The x and y coordinates of each pixel, both of shape size
+    """
+    return np.meshgrid(
         np.linspace(-size[1] // 2, size[1] // 2, size[1]),
         np.linspace(-size[0] // 2, size[0] // 2, size[0]))
 
-    x_theta = x * np.cos(theta) + y * np.sin(theta)
-    y_theta = -x * np.sin(theta) + y * np.cos(theta)
 
-    CONTRAST_SCALING = 0.62
+#sigma = 4 normally,
+#def generate_gabor_patch(size=(60, 60), theta=np.pi / 2, gamma=1, lamda=1, phi=0.0, sigma=0.4):
+def generate_gabor_patches(thetas, size=(60, 60), gamma=GAMMA, lamda=LAMDA, phi=PHI, sigma=SIGMA, grid=None):
+    """
+    Generate a batch of gabor patches that differ in orientation, all on one shared grid.
+
+    Args:
+        thetas (array-like):
+            The orientation in radians of each of the patches
+        size (array-like):
+            The (height, width) of the patches in pixels. Default: (60, 60)
+        grid (tuple):
+            The precomputed grid of the patches as given by make_grid(size). If None, it is computed. Default: None
+
+    Returns:
+        (np.ndarray):
+            The gabor patches of shape (len(thetas), height, width)
+    """
+    x, y = make_grid(size) if grid is None else grid
+    thetas = np.asarray(thetas)[:, np.newaxis, np.newaxis]
+    cos = np.cos(thetas)
+    sin = np.sin(thetas)
+
+    x_theta = x * cos + y * sin
+    y_theta = -x * sin + y * cos
+
     gabor = CONTRAST_SCALING * np.exp(-(x_theta**2 + gamma**2 * y_theta**2) / (2 * sigma**2)) * np.cos((2 * np.pi * x_theta / lamda) + phi)
     return gabor
 
 
-# Create image with gabor patches
-grating_image = np.zeros(shape=(WIDTH, HEIGHT), dtype="float32")
-for i in range(N_PATCHES):
-    patch = generate_gabor_patch(size=(PATCH_HEIGHT, PATCH_WIDTH), theta=np.random.rand() * np.pi)
-    while True:
-        x_pos = int(np.random.rand() * (WIDTH - PATCH_WIDTH))
-        y_pos = int(np.random.rand() * (HEIGHT - PATCH_HEIGHT))
-        if np.sqrt((x_pos + PATCH_WIDTH//2 - WIDTH//2)**2 + (y_pos + PATCH_HEIGHT//2 - HEIGHT//2)**2) > FONT_SIZE//2:
-            break
-    grating_image[y_pos:y_pos + PATCH_HEIGHT, x_pos:x_pos + PATCH_WIDTH] += patch
-grating_image *= 121
-grating_image += 121
-grating_image = np.clip(grating_image, a_min=0, a_max=255)
-
-
-# Create images with symbols
-for key in KEYS:
-    if key == "space":
-
-        img = Image.new(mode="RGB", size=(WIDTH, HEIGHT), color=GRAY_COLOR)
-        img_draw = ImageDraw.Draw(img)
-        img.save(f"gray.png")
-
-        img = Image.fromarray(np.repeat(grating_image[:, :, np.newaxis], repeats=3, axis=2).astype("uint8"))
-        img_draw = ImageDraw.Draw(img)
-        img.save(f"grating.png")
-
-    else:
-        if key in KEY_MAPPING:
-            symbol = KEY_MAPPING[key]
-        else:
-            symbol = key
-
-        img = Image.new(mode="RGB", size=(WIDTH, HEIGHT), color=GRAY_COLOR)
-        img_draw = ImageDraw.Draw(img)
+def generate_gabor_patch(size=(60, 60), theta=np.pi / 2, gamma=GAMMA, lamda=LAMDA, phi=PHI, sigma=SIGMA):
+    return generate_gabor_patches([theta], size, gamma, lamda, phi, sigma)[0]
+
+
+def sample_positions(rng, n_patches=N_PATCHES):
+    """
+    Sample the top left positions of patches uniformly over the image, rejecting positions whose patch center
+    lies on the symbol in the center of the image. Candidates are drawn in batches instead of one at a time.
+
+    Args:
+        rng (np.random.Generator):
+            The random number generator
+        n_patches (int):
+            The number of positions. Default: N_PATCHES
+
+    Returns:
+        (tuple):
+            The x and y positions, both of shape (n_patches,)
+    """
+    x_pos = np.zeros(0, dtype="int")
+    y_pos = np.zeros(0, dtype="int")
+    while x_pos.size < n_patches:
+        candidates = rng.random((2 * n_patches, 2))
+        x = (candidates[:, 0] * (WIDTH - PATCH_WIDTH)).astype("int")
+        y = (candidates[:, 1] * (HEIGHT - PATCH_HEIGHT)).astype("int")
+        valid = np.sqrt((x + PATCH_WIDTH//2 - WIDTH//2)**2 + (y + PATCH_HEIGHT//2 - HEIGHT//2)**2) > FONT_SIZE//2
+        x_pos = np.concatenate((x_pos, x[valid]))
+        y_pos = np.concatenate((y_pos, y[valid]))
+    return x_pos[:n_patches], y_pos[:n_patches]
+
+
+def generate_grating(seed=None, n_patches=N_PATCHES):
+    """
+    Generate the grating background: randomly oriented gabor patches at random positions around the center.
+
+    Args:
+        seed (int):
+            The seed of the random number generator. The same seed gives a bit-identical grating. If None, the
+            grating is not reproducible. Default: None
+        n_patches (int):
+            The number of gabor patches. Default: N_PATCHES
+
+    Returns:
+        (np.ndarray):
+            The grating as gray values between 0 and 255 of shape (HEIGHT, WIDTH)
+    """
+    rng = np.random.default_rng(seed)
+    patches = generate_gabor_patches(rng.random(n_patches) * np.pi, size=(PATCH_HEIGHT, PATCH_WIDTH))
+    x_pos, y_pos = sample_positions(rng, n_patches)
+
+    # Add all patches at once by their flat pixel indices in the image
+    rows = y_pos[:, np.newaxis, np.newaxis] + np.arange(PATCH_HEIGHT)[np.newaxis, :, np.newaxis]
+    cols = x_pos[:, np.newaxis, np.newaxis] + np.arange(PATCH_WIDTH)[np.newaxis, np.newaxis, :]
+    grating_image = np.bincount((rows * WIDTH + cols).ravel(), weights=patches.ravel(), minlength=HEIGHT * WIDTH)
+    grating_image = grating_image.reshape((HEIGHT, WIDTH)).astype("float32")
+    grating_image *= 121
+    grating_image += 121
+    grating_image = np.clip(grating_image, a_min=0, a_max=255)
+    return grating_image
+
+
+def render_key(key, grating_image):
+    """
+    Render the images of a key: the symbol on a gray and on a grating background.
+
+    Args:
+        key (str):
+            The key, either a symbol or a name in KEY_MAPPING. The key "space" gives images without symbol
+        grating_image (np.ndarray):
+            The grating as gray values between 0 and 255 of shape (HEIGHT, WIDTH)
+
+    Returns:
+        (dict):
+            The images of the key as PIL images, keyed by their state: "gray" and "grating"
+    """
+    gray = Image.new(mode="RGB", size=(WIDTH, HEIGHT), color=GRAY_COLOR)
+    grating = Image.fromarray(np.repeat(grating_image[:, :, np.newaxis], repeats=3, axis=2).astype("uint8"))
+    if key != "space":
+        symbol = KEY_MAPPING.get(key, key)
+        img_draw = ImageDraw.Draw(gray)
         _, _, text_width, text_height = img_draw.textbbox(xy=(0, 0), text=symbol, font_size=FONT_SIZE)
         x_pos = (WIDTH - text_width) / 2
         y_pos = (HEIGHT - text_height) / 2
         img_draw.text(xy=(x_pos, y_pos), text=symbol, fill=TEXT_COLOR, font_size=FONT_SIZE)
-        img.save(f"{key}_gray.png")
+        ImageDraw.Draw(grating).text(xy=(x_pos, y_pos), text=symbol, fill=TEXT_COLOR, font_size=FONT_SIZE)
+    return {"gray": gray, "grating": grating}
 
-        img = Image.fromarray(np.repeat(grating_image[:, :, np.newaxis], repeats=3, axis=2).astype("uint8"))
-        img_draw = ImageDraw.Draw(img)
-        img_draw.text(xy=(x_pos, y_pos), text=symbol, fill=TEXT_COLOR, font_size=FONT_SIZE)
-        img.save(f"{key}_grating.png")
+
+def _save_key(key, grating_image, path):
+    prefix = "" if key == "space" else f"{key}_"
+    for state, img in render_key(key, grating_image).items():
+        img.save(os.path.join(path, f"{prefix}{state}.png"))
+    return key
+
+
+def generate_images(keys=KEYS, seed=None, path=".", n_workers=None):
+    """
+    Generate the gray and grating images of a set of keys in parallel. All keys share one grating background.
+
+    Args:
+        keys (list):
+            The keys to generate images for. Default: KEYS
+        seed (int):
+            The seed of the grating. The same seed gives bit-identical images. Default: None
+        path (str):
+            The folder to save the images in. Default: "."
+        n_workers (int):
+            The number of worker processes. If None, the number of CPUs. Default: None
+
+    Returns:
+        (np.ndarray):
+            The grating that was used of shape (HEIGHT, WIDTH)
+    """
+    grating_image = generate_grating(seed)
+    os.makedirs(path, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        list(pool.map(_save_key, keys, [grating_image] * len(keys), [path] * len(keys)))
+    return grating_image
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Generate gray and grating key images")
+    parser.add_argument("-k", "--keys", type=str, nargs="+", help="keys to generate, default: all", default=KEYS)
+    parser.add_argument("-s", "--seed", type=int, help="seed of the grating", default=None)
+    parser.add_argument("-o", "--output", type=str, help="folder to save the images in", default=".")
+    parser.add_argument("-w", "--workers", type=int, help="number of worker processes", default=None)
+    args = parser.parse_args()
+
+    generate_images(args.keys, args.seed, args.output, args.workers)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless backend of the keyboard: a null window and null stimuli with the interface of the PsychoPy window and
+stimuli the keyboard uses, and the monitor geometry to convert degrees to pixels. Nothing is rendered, and no display
+(nor PsychoPy) is needed, such that the CPU cost of the keyboard itself can be measured anywhere, e.g., on a build
+machine (see benchmark_keyboard.py).
+
+Usage:
+    keyboard = Keyboard(size, width, distance, stream=False, headless=True)
+"""
+
+import math
+import time
+import numpy as np
+from PIL import Image
+
+
+class Monitor(object):
+    """
+    The geometry of a monitor, as monitors.Monitor keeps it.
+    """
+
+    def __init__(self, name, width=None, distance=None):
+        """
+        Create a monitor.
+
+        Args:
+            name (str):
+                The name of the monitor
+            width (float):
+                The width of the screen in centimeters. Default: None
+            distance (float):
+                The distance of the user to the screen in centimeters. Default: None
+        """
+        self.name = name
+        self.width = width
+        self.distance = distance
+        self.size = None
+
+    def setSizePix(self, size):
+        self.size = size
+
+
+def deg2pix(degrees, monitor):
+    """
+    Convert degrees of visual angle to pixels, as misc.deg2pix does (without correcting for the flat screen).
+
+    Args:
+        degrees (float):
+            The visual angle in degrees
+        monitor (Monitor):
+            The monitor
+
+    Returns:
+        (float):
+            The size in pixels
+    """
+    cm = degrees * monitor.distance * math.tan(math.pi / 180)
+    return cm * monitor.size[0] / monitor.width
+
+
+class Window(object):
+    """
+    A null window. A flip draws the stimuli that are drawn automatically, calls the functions scheduled on the flip
+    and returns immediately, unless it is paced to the framerate.
+    """
+
+    def __init__(self, size=(800, 600), color=(0, 0, 0), framerate=60, pace=False, **kwargs):
+        """
+        Create a null window.
+
+        Args:
+            size (array-like):
+                The (width, height) of the window in pixels. Default: (800, 600)
+            color (array-like):
+                The background color of the window. Default: (0, 0, 0)
+            framerate (float):
+                The framerate in Hz the window reports. Default: 60
+            pace (bool):
+                Whether a flip waits for the next frame at the framerate, as a window waiting for the vertical
+                blank does. Default: False
+            **kwargs:
+                Any other arguments of visual.Window, which are ignored
+        """
+        self.size = np.array(size)
+        self.color = color
+        self.framerate = framerate
+        self.pace = pace
+        self.auto_draw = []
+        self.on_flip = []
+        self.n_draws = 0
+        self.n_flips = 0
+        self.last_flip = None
+
+    def flip(self):
+        """
+        Flip the window.
+
+        Returns:
+            (float):
+                The timestamp of the flip in seconds
+        """
+        for stimulus in self.auto_draw:
+            stimulus.draw()
+        if self.pace and self.last_flip is not None:
+            period = 1.0 / self.framerate
+            while time.perf_counter() < self.last_flip + period:
+                pass
+        timestamp = time.perf_counter()
+        for function, args, kwargs in self.on_flip:
+            function(*args, **kwargs)
+        self.on_flip = []
+        self.last_flip = timestamp
+        self.n_flips += 1
+        return timestamp
+
+    def callOnFlip(self, function, *args, **kwargs):
+        """
+        Call a function right after the next flip.
+
+        Args:
+            function (callable):
+                The function to call
+            *args:
+                The positional arguments of the function
+            **kwargs:
+                The keyword arguments of the function
+        """
+        self.on_flip.append((function, args, kwargs))
+
+    def getActualFrameRate(self, **kwargs):
+        """
+        Get the framerate of the window.
+
+        Returns:
+            (float):
+                The framerate in Hz
+        """
+        return self.framerate
+
+    def setMouseVisible(self, visible):
+        pass
+
+    def close(self):
+        self.auto_draw = []
+        self.on_flip = []
+
+
+class Stimulus(object):
+    """
+    A null stimulus, of which drawing only counts a draw call of its window.
+    """
+
+    def __init__(self, win, autoDraw=False, **kwargs):
+        """
+        Create a null stimulus.
+
+        Args:
+            win (Window):
+                The window to draw the stimulus in
+            autoDraw (bool):
+                Whether the stimulus is drawn on every flip. Default: False
+            **kwargs:
+                Any other arguments of the PsychoPy stimulus, which are ignored
+        """
+        self.win = win
+        self.autoDraw = False
+        self.setAutoDraw(autoDraw)
+
+    def draw(self):
+        self.win.n_draws += 1
+
+    def setAutoDraw(self, value):
+        """
+        Set whether the stimulus is drawn automatically on every flip.
+
+        Args:
+            value (bool):
+                Whether or not to draw the stimulus on every flip
+        """
+        if value and not self.autoDraw:
+            self.win.auto_draw.append(self)
+        elif not value and self.autoDraw:
+            self.win.auto_draw.remove(self)
+        self.autoDraw = value
+
+
+class ImageStim(Stimulus):
+    """
+    A null image stimulus. The image is loaded as a texture, as visual.ImageStim does, such that the memory of the
+    keys is accounted for.
+    """
+
+    def __init__(self, win, image=None, **kwargs):
+        """
+        Create a null image stimulus.
+
+        Args:
+            win (Window):
+                The window to draw the stimulus in
+            image (str | np.ndarray):
+                The image file, or texture of shape (height, width, 3) with values between -1 and 1
+            **kwargs:
+                Any other arguments of visual.ImageStim
+        """
+        super().__init__(win, **kwargs)
+        if isinstance(image, str):
+            image = np.flipud(np.asarray(Image.open(image).convert("RGB"))) / 127.5 - 1
+        self.image = np.array(image, dtype="float32")
+
+
+class TextBox2(Stimulus):
+    """
+    A null text box.
+    """
+
+    def __init__(self, win, text="", **kwargs):
+        """
+        Create a null text box.
+
+        Args:
+            win (Window):
+                The window to draw the stimulus in
+            text (str):
+                The text. Default: ""
+            **kwargs:
+                Any other arguments of visual.TextBox2
+        """
+        super().__init__(win, **kwargs)
+        self.text = text
+
+    def setText(self, text):
+        self.text = text
+
+
+class ElementArrayStim(Stimulus):
+    """
+    A null element array, keeping its texture and element phases.
+    """
+
+    def __init__(self, win, elementTex=None, phases=None, **kwargs):
+        """
+        Create a null element array.
+
+        Args:
+            win (Window):
+                The window to draw the stimulus in
+            elementTex (PIL.Image):
+                The texture of all elements. Default: None
+            phases (np.ndarray):
+                The texture phases of the elements of shape (n_elements, 2). Default: None
+            **kwargs:
+                Any other arguments of visual.ElementArrayStim
+        """
+        super().__init__(win, **kwargs)
+        self.texture = None if elementTex is None else np.asarray(elementTex, dtype="uint8")
+        self.phases = phases
@@ -0,0 +1,295 @@
+"""
+Statistics of the stimulus images. All {key}_{state}.png images of a folder are analyzed in parallel into one table:
+mean, minimum and maximum luminance, Michelson and RMS contrast, and the range and histogram of each color channel.
+The table is cached next to the images and an image is only analyzed again if its content hash changed. The
+validation checks that the keys of each stimulus set are matched, e.g., after regenerating a set.
+
+Usage:
+    python image_statistics.py images
+    python image_statistics.py images --check
+"""
+
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# The stimulus sets and their (on, off) states. Isoluminant sets have the same mean luminance in both states
+SETS = {
+    "bw": dict(states=("white", "black"), isoluminant=False),
+    "grating": dict(states=("grating", "gray"), isoluminant=True),
+}
+
+DTYPE = np.dtype([
+    ("file", "U64"),
+    ("key", "U16"),
+    ("state", "U16"),
+    ("hash", "U32"),
+    ("height", "i4"),
+    ("width", "i4"),
+    ("mean_luminance", "f8"),  # relative luminance between 0 and 1
+    ("min_luminance", "f8"),
+    ("max_luminance", "f8"),
+    ("michelson", "f8"),  # (max - min) / (max + min) of the luminance
+    ("rms", "f8"),  # standard deviation over mean of the luminance
+    ("channel_range", "f8", (3,)),  # (max - min) / 255 of the R, G and B channels
+    ("histogram", "i4", (3, 256)),  # the histogram of the R, G and B channels
+])
+
+VERSION = 1  # the version of the table, part of the name of cached tables
+
+
+def parse_name(fn):
+    """
+    Parse the key and state of an image from its file name.
+
+    Args:
+        fn (str):
+            The file name, e.g., "A_grating.png" or "__gray.png" for the key "_"
+
+    Returns:
+        (tuple):
+            The key and state, or None if the file is not a stimulus image
+    """
+    name, ext = os.path.splitext(os.path.basename(fn))
+    if ext.lower() != ".png" or "_" not in name[1:]:
+        return None
+    key, state = name.rsplit("_", 1)
+    return key, state
+
+
+def hash_file(fn):
+    """
+    Compute the content hash of a file.
+
+    Args:
+        fn (str):
+            The file name
+
+    Returns:
+        (str):
+            The hexadecimal content hash
+    """
+    with open(fn, "rb") as fid:
+        return hashlib.blake2b(fid.read(), digest_size=16).hexdigest()
+
+
+def luminance(image):
+    """
+    Compute the relative luminance of an sRGB image (ITU-R BT.709 primaries).
+
+    Args:
+        image (np.ndarray):
+            The RGB image of shape (height, width, 3) of uint8
+
+    Returns:
+        (np.ndarray):
+            The luminance between 0 and 1 of shape (height, width)
+    """
+    # Linearize through a table of the 256 values instead of per pixel
+    values = np.arange(256) / 255
+    table = np.where(values <= 0.04045, values / 12.92, ((values + 0.055) / 1.055) ** 2.4)
+    return table[image] @ np.array([0.2126, 0.7152, 0.0722])
+
+
+def analyze_image(fn):
+    """
+    Compute the statistics of an image.
+
+    Args:
+        fn (str):
+            The file name of the image
+
+    Returns:
+        (np.ndarray):
+            The statistics as a structured array of DTYPE of shape (1)
+    """
+    from PIL import Image
+
+    with open(fn, "rb") as fid:
+        content = fid.read()
+    with Image.open(fn) as img:
+        image = np.asarray(img.convert("RGB"))
+    L = luminance(image)
+
+    row = np.zeros(1, dtype=DTYPE)
+    row["file"] = os.path.basename(fn)
+    row["key"], row["state"] = parse_name(fn)
+    row["hash"] = hashlib.blake2b(content, digest_size=16).hexdigest()
+    row["height"], row["width"] = image.shape[:2]
+    row["mean_luminance"] = L.mean()
+    row["min_luminance"] = L.min()
+    row["max_luminance"] = L.max()
+    row["michelson"] = (L.max() - L.min()) / (L.max() + L.min()) if L.max() > 0 else 0
+    row["rms"] = L.std() / L.mean() if L.mean() > 0 else 0
+    pixels = image.reshape(-1, 3)
+    row["channel_range"] = (pixels.max(axis=0).astype("float64") - pixels.min(axis=0)) / 255
+    row["histogram"] = [np.bincount(pixels[:, i], minlength=256) for i in range(3)]
+    return row
+
+
+def load_statistics(path="images", cache_dir=None, n_workers=None):
+    """
+    Load the statistics of all stimulus images in a folder, analyzing only images that are new or changed.
+
+    Args:
+        path (str):
+            The folder of the images. Default: "images"
+        cache_dir (str):
+            The folder to cache the table in. If None, a folder ".stats" in path. Default: None
+        n_workers (int):
+            The maximum number of worker processes. If None, the number of CPUs. Default: None
+
+    Returns:
+        (np.ndarray):
+            The statistics as a structured array of DTYPE, one row per image sorted by file name
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(path, ".stats")
+    cache_fn = os.path.join(cache_dir, f"image_statistics_v{VERSION}.npy")
+    fns = sorted(os.path.join(path, fn) for fn in os.listdir(path) if parse_name(fn) is not None)
+
+    # Reuse the rows of images whose hash did not change
+    cached = dict()
+    if os.path.exists(cache_fn):
+        table = np.load(cache_fn, mmap_mode="r")
+        cached = {(str(row["file"]), str(row["hash"])): i for i, row in enumerate(table[["file", "hash"]])}
+    rows = [None] * len(fns)
+    todo = []
+    for i, fn in enumerate(fns):
+        key = (os.path.basename(fn), hash_file(fn))
+        if key in cached:
+            rows[i] = np.array(table[cached[key]:cached[key] + 1])
+        else:
+            todo.append(i)
+    if not todo:
+        return np.load(cache_fn, mmap_mode="r") if len(cached) == len(fns) else np.concatenate(rows)
+
+    if n_workers == 1 or len(todo) == 1:
+        results = list(map(analyze_image, [fns[i] for i in todo]))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(analyze_image, [fns[i] for i in todo], chunksize=16))
+    for i, row in zip(todo, results):
+        rows[i] = row
+    table = np.concatenate(rows) if rows else np.zeros(0, dtype=DTYPE)
+
+    # Write to a temporary file first, such that readers never see a partial table
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f"{cache_fn}.tmp{os.getpid()}.npy"
+    np.save(tmp, table)
+    os.replace(tmp, cache_fn)
+    return table
+
+
+def state_differences(table, on, off):
+    """
+    Compare the on and off state of each key that has both.
+
+    Args:
+        table (np.ndarray):
+            The statistics as a structured array of DTYPE
+        on (str):
+            The on state, e.g., "white"
+        off (str):
+            The off state, e.g., "black"
+
+    Returns:
+        (dict):
+            The keys, and per key the mean luminance of both states, their difference and their Michelson contrast
+    """
+    rows_on, rows_off = table[table["state"] == on], table[table["state"] == off]
+    keys, i_on, i_off = np.intersect1d(rows_on["key"], rows_off["key"], return_indices=True)
+    L_on, L_off = rows_on["mean_luminance"][i_on], rows_off["mean_luminance"][i_off]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        michelson = np.abs(L_on - L_off) / (L_on + L_off)
+    return dict(keys=keys, on=L_on, off=L_off, difference=L_on - L_off, michelson=michelson)
+
+
+def validate(table, sets=SETS, tolerance=0.02):
+    """
+    Validate that the keys of each stimulus set are matched: all keys have all states of the set, the luminance of
+    each state and the difference between the states are the same for all keys (within tolerance), and isoluminant
+    sets have the same mean luminance in both states.
+
+    Args:
+        table (np.ndarray):
+            The statistics as a structured array of DTYPE
+        sets (dict):
+            The stimulus sets, see SETS. Default: SETS
+        tolerance (float):
+            The tolerance in relative luminance. Default: 0.02
+
+    Returns:
+        (list):
+            The problems found, empty if the sets are valid
+    """
+    problems = []
+    for name, stimulus_set in sets.items():
+        on, off = stimulus_set["states"]
+        diff = state_differences(table, on, off)
+        for state in (on, off):
+            missing = sorted(set(table["key"][table["state"] == (off if state == on else on)].tolist()) -
+                             set(table["key"][table["state"] == state].tolist()))
+            if missing:
+                problems.append(f"{name}: keys without a {state} image: {' '.join(missing)}")
+        if diff["keys"].size == 0:
+            problems.append(f"{name}: no keys with both a {on} and a {off} image")
+            continue
+        for label, values in ((on, diff["on"]), (off, diff["off"]), (f"{on}-{off}", diff["difference"])):
+            spread = values.max() - values.min()
+            if spread > tolerance:
+                problems.append(f"{name}: luminance of {label} differs {spread:.3f} between keys "
+                                f"({diff['keys'][values.argmin()]} {values.min():.3f}, "
+                                f"{diff['keys'][values.argmax()]} {values.max():.3f})")
+        if stimulus_set.get("isoluminant"):
+            worst = np.argmax(np.abs(diff["difference"]))
+            if abs(diff["difference"][worst]) > tolerance:
+                problems.append(f"{name}: {on} and {off} are not isoluminant, e.g., {diff['keys'][worst]} differs "
+                                f"{diff['difference'][worst]:.3f}")
+    return problems
+
+
+def print_summary(table, sets=SETS):
+    """
+    Print the statistics of each state (mean and range over keys), and the difference between the states of each set.
+
+    Args:
+        table (np.ndarray):
+            The statistics as a structured array of DTYPE
+        sets (dict):
+            The stimulus sets, see SETS. Default: SETS
+    """
+    print("state\timages\tluminance\tmichelson\trms\t\tchannel range")
+    for state in np.unique(table["state"]):
+        rows = table[table["state"] == state]
+        print(f"{state}\t{rows.size}\t{rows['mean_luminance'].mean():.3f} "
+              f"({rows['mean_luminance'].min():.3f}-{rows['mean_luminance'].max():.3f})\t"
+              f"{rows['michelson'].mean():.3f}\t\t{rows['rms'].mean():.3f}\t\t"
+              f"{' '.join(f'{100 * value:.1f}%' for value in rows['channel_range'].mean(axis=0))}")
+    for name, stimulus_set in sets.items():
+        diff = state_differences(table, *stimulus_set["states"])
+        if diff["keys"].size:
+            print(f"{name}: {'-'.join(stimulus_set['states'])} luminance difference "
+                  f"{diff['difference'].mean():.3f} ({diff['difference'].min():.3f}-{diff['difference'].max():.3f}), "
+                  f"Michelson contrast {np.nanmean(diff['michelson']):.3f} over {diff['keys'].size} keys")
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description="Statistics and validation of the stimulus images")
+    parser.add_argument("path", type=str, nargs="?", help="folder of the images", default="images")
+    parser.add_argument("-w", "--workers", type=int, help="maximum number of worker processes", default=None)
+    parser.add_argument("-t", "--tolerance", type=float, help="tolerance in relative luminance", default=0.02)
+    parser.add_argument("--check", action="store_true", help="only validate, exit with 1 on problems")
+    args = parser.parse_args()
+
+    table = load_statistics(args.path, n_workers=args.workers)
+    if not args.check:
+        print_summary(table)
+    problems = validate(table, tolerance=args.tolerance)
+    for problem in problems:
+        print(problem)
+    print(f"{table.size} images, {len(problems)} problems")
+    sys.exit(1 if args.check and problems else 0)
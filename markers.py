@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Marker logging for the keyboard. Markers are time stamped on the render thread, but serialized and pushed to the
+LSL outlet by a background thread. Code tables are sent compactly: bit-packed, once per stream, and referenced by
+their content hash.
+"""
+
+import base64
+import hashlib
+import json
+import queue
+import threading
+import numpy as np
+
+# Markers that may be dropped when the queue stays full. All other markers, such as the trial and code markers that
+# epoching depends on, are never dropped: the caller waits for room instead
+OPTIONAL_MARKERS = ("timing_trial", "feedback")
+
+
+def encode_codes(codes):
+    """
+    Encode a code table compactly: the states of all codes bit-packed with as few bits per state as needed.
+
+    Args:
+        codes (dict):
+            The code table, mapping the name of each key to its code, a list of integer states
+
+    Returns:
+        (tuple):
+            The content hash and the encoded table as ;-separated key=value fields
+    """
+    names = list(codes.keys())
+    arrays = [np.asarray(codes[name], dtype="uint8") for name in names]
+    flat = np.concatenate(arrays)
+    n_bits = max(1, int(flat.max()).bit_length())
+    bits = (flat[:, np.newaxis] >> np.arange(n_bits, dtype="uint8")) & 1
+    data = base64.b64encode(np.packbits(bits.ravel()).tobytes()).decode("ascii")
+    fields = (f"n_bits={n_bits};keys={json.dumps(names, separators=(',', ':'))};"
+        f"lengths={json.dumps([array.size for array in arrays], separators=(',', ':'))};data={data}")
+    return hashlib.sha1(fields.encode()).hexdigest()[:16], fields
+
+
+def decode_codes(fields):
+    """
+    Decode a code table encoded by encode_codes.
+
+    Args:
+        fields (str):
+            The encoded table as ;-separated key=value fields, e.g., the code_table marker without its first field
+
+    Returns:
+        (dict):
+            The code table, mapping the name of each key to its code, a list of integer states
+    """
+    values = dict(field.split("=", 1) for field in fields.split(";") if "=" in field)
+    n_bits = int(values["n_bits"])
+    names = json.loads(values["keys"])
+    lengths = json.loads(values["lengths"])
+    bits = np.unpackbits(np.frombuffer(base64.b64decode(values["data"]), dtype="uint8"))
+    bits = bits[:sum(lengths) * n_bits].reshape((-1, n_bits))
+    flat = (bits << np.arange(n_bits, dtype="uint8")).sum(axis=1)
+    offsets = np.cumsum([0] + lengths)
+    return {name: flat[offsets[i]:offsets[i + 1]].tolist() for i, name in enumerate(names)}
+
+
+class MarkerDispatcher(object):
+    """
+    Pushes markers to an LSL outlet from a background thread. Markers are time stamped when they are logged, so the
+    time it takes to serialize and push them does not shift them, nor delay the caller. All markers are pushed by
+    the thread, in the order they are logged. If optional markers were dropped, a dropped_markers marker with their
+    count is pushed before the next marker.
+    """
+
+    def __init__(self, outlet, max_size=1024, timeout=0.002):
+        """
+        Create a marker dispatcher and start its thread.
+
+        Args:
+            outlet (pylsl.StreamOutlet):
+                The outlet to push markers to
+            max_size (int):
+                The maximum number of markers waiting to be pushed. Default: 1024
+            timeout (float):
+                The maximum time in seconds the caller waits for room in a full queue for an optional marker (see
+                OPTIONAL_MARKERS), after which it is dropped and counted in n_dropped. Default: 0.002
+        """
+        from pylsl import local_clock
+        self.clock = local_clock
+        self.outlet = outlet
+        self.queue = queue.Queue(maxsize=max_size)
+        self.timeout = timeout
+        self.n_dropped = 0
+        self.n_reported = 0
+        self.stopped = threading.Event()
+
+        # The content hashes of the code tables sent on this outlet
+        self.code_tables = set()
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        # Push until stopped and all waiting markers are pushed
+        while True:
+            try:
+                item = self.queue.get(timeout=0.05)
+            except queue.Empty:
+                if self.stopped.is_set():
+                    self._report_dropped(self.clock())
+                    break
+                continue
+            self._push(*item)
+
+    def _report_dropped(self, timestamp):
+        # Record the optional markers dropped since the last report in the stream
+        n_dropped = self.n_dropped
+        if n_dropped > self.n_reported:
+            self.outlet.push_sample([f"dropped_markers;n={n_dropped - self.n_reported}"], timestamp)
+            self.n_reported = n_dropped
+
+    def _push(self, marker, timestamp):
+        self._report_dropped(timestamp)
+        if isinstance(marker, dict):
+            content_hash, fields = encode_codes(marker)
+            if content_hash not in self.code_tables:
+                self.outlet.push_sample([f"code_table;hash={content_hash};{fields}"], timestamp)
+                self.code_tables.add(content_hash)
+            marker = [f"codes;hash={content_hash}"]
+        self.outlet.push_sample(marker, timestamp)
+
+    def push(self, marker):
+        """
+        Log a marker, time stamped now. Can be passed to window.callOnFlip to time stamp it at the flip. If the queue
+        is full, an optional marker (see OPTIONAL_MARKERS) is dropped after the timeout, any other marker waits for
+        room.
+
+        Args:
+            marker (list):
+                The marker as a list of one string, or a code table as a dict (see push_codes)
+        """
+        item = (marker, self.clock())
+        if isinstance(marker, dict) or str(marker[0]).split(";", 1)[0] not in OPTIONAL_MARKERS:
+            self.queue.put(item)
+            return
+        try:
+            self.queue.put(item, timeout=self.timeout)
+        except queue.Full:
+            self.n_dropped += 1
+            print(f"Dropped marker {marker[0]}, the marker queue was full")
+
+    def push_codes(self, codes):
+        """
+        Log a code table. The table is sent as a code_table marker the first time, followed by a codes marker that
+        refers to it by its content hash (see encode_codes).
+
+        Args:
+            codes (dict):
+                The code table, mapping the name of each key to its code, a list of integer states
+        """
+        self.push(dict(codes))
+
+    def close(self):
+        """
+        Push all waiting markers and stop the thread.
+        """
+        self.stopped.set()
+        self.thread.join()
+        if self.n_dropped > 0:
+            print(f"Dropped {self.n_dropped} optional markers in total, the marker queue was full")
@@ -0,0 +1,569 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Online decoding for the keyboard. The EEG and marker streams are read in a separate process, the EEG is band-pass
+filtered chunk by chunk into a ring buffer, and each trial is classified with a pre-fitted eCCA as soon as its data
+is complete. The keyboard polls the results between trials.
+
+Usage (fit a model on a derivative, see data/derivatives.py):
+    python online.py fit derivatives/01/01_cvep_classes=30_bw models/classes=30_bw.pkl
+"""
+
+import json
+import os
+import pickle
+import queue
+import time
+import multiprocessing
+import numpy as np
+from data.resampling import Resampler
+
+FS = 120  # sampling frequency of the model
+PR = 60  # codes presentation rate
+TRIAL_TIME = 4.2
+L_FREQ = 6.0
+H_FREQ = 21.0
+
+TRIGGER = 0  # the Trig1 channel of the BioSemi stream
+PICKS = np.arange(1, 65)  # the EEG channels of the BioSemi stream
+SCALE = 1e-6  # microvolts to volts
+
+
+class RingBuffer(object):
+    """
+    A preallocated ring buffer of samples for one producer. The producer publishes samples by advancing the count
+    after they are written, so readers need no lock: any sample below the count and within the last size samples
+    is valid.
+    """
+
+    def __init__(self, n_channels, size, dtype="float32"):
+        """
+        Create a ring buffer.
+
+        Args:
+            n_channels (int):
+                The number of channels
+            size (int):
+                The number of samples the buffer holds
+            dtype (str):
+                The data type of the samples. Default: "float32"
+        """
+        self.size = size
+        self.data = np.zeros((size, n_channels), dtype=dtype)
+        self.times = np.zeros(size, dtype="float64")
+        self.count = 0
+
+    def write(self, samples, times):
+        """
+        Write samples to the buffer, overwriting the oldest samples.
+
+        Args:
+            samples (np.ndarray):
+                The samples of shape (samples, channels)
+            times (np.ndarray):
+                The time stamps of shape (samples)
+        """
+        n = samples.shape[0]
+        if n > self.size:
+            samples, times = samples[-self.size:], times[-self.size:]
+            self.count += n - self.size
+            n = self.size
+        start = self.count % self.size
+        stop = min(start + n, self.size)
+        self.data[start:stop] = samples[:stop - start]
+        self.times[start:stop] = times[:stop - start]
+        self.data[:n - (stop - start)] = samples[stop - start:]
+        self.times[:n - (stop - start)] = times[stop - start:]
+        self.count += n
+
+    def read(self, start, stop):
+        """
+        Read samples from the buffer.
+
+        Args:
+            start (int):
+                The index of the first sample, counted from the first sample ever written
+            stop (int):
+                The index after the last sample
+
+        Returns:
+            (tuple):
+                The samples of shape (samples, channels) and their time stamps of shape (samples)
+        """
+        assert self.count - self.size <= start and stop <= self.count, f"Samples {start}-{stop} are not in the buffer"
+        idx = np.arange(start, stop) % self.size
+        return self.data[idx], self.times[idx]
+
+    def find(self, time):
+        """
+        Find the first sample at or after a time.
+
+        Args:
+            time (float):
+                The time
+
+        Returns:
+            (int):
+                The index of the sample, or None if no sample is that late yet
+        """
+        # Search the two contiguous segments of the ring in order, the oldest samples first, without reading data
+        first = max(0, self.count - self.size)
+        for start, stop in ((first, min(self.count, (first // self.size + 1) * self.size)),
+                            ((first // self.size + 1) * self.size, self.count)):
+            if start >= stop:
+                continue
+            times = self.times[start % self.size:(stop - 1) % self.size + 1]
+            i = np.searchsorted(times, time)
+            if i < times.size:
+                return start + i
+        return None
+
+
+class OnlineFilter(object):
+    """
+    The zero-phase FIR band-pass of the preprocessing (mne.io.Raw.filter), applied causally chunk by chunk. The
+    output equals the zero-phase filtered data delayed by the group delay of the filter.
+    """
+
+    def __init__(self, fs, l_freq, h_freq, n_channels):
+        """
+        Create an online filter.
+
+        Args:
+            fs (float):
+                The sampling frequency
+            l_freq (float):
+                The lower pass-band edge
+            h_freq (float):
+                The upper pass-band edge
+            n_channels (int):
+                The number of channels
+        """
+        import mne
+        self.h = mne.filter.create_filter(None, fs, l_freq, h_freq, fir_design="firwin", verbose=False)
+        self.delay = (self.h.size - 1) // 2
+        self.zi = np.zeros((self.h.size - 1, n_channels))
+
+    def apply(self, samples):
+        """
+        Filter the next chunk of samples.
+
+        Args:
+            samples (np.ndarray):
+                The samples of shape (samples, channels)
+
+        Returns:
+            (np.ndarray):
+                The filtered samples of shape (samples, channels)
+        """
+        from scipy.signal import lfilter
+        filtered, self.zi = lfilter(self.h, 1.0, samples, axis=0, zi=self.zi)
+        return filtered
+
+
+class TrialDecoder(object):
+    """
+    Preprocesses the EEG stream incrementally and classifies trials as soon as their data is complete. It is fed
+    chunks of EEG and markers, and does not depend on LSL itself. Optionally, it classifies the running trial while
+    it is presented to signal that it can stop early.
+    """
+
+    def __init__(self, model, fs_in, fs=FS, trial_time=TRIAL_TIME, l_freq=L_FREQ, h_freq=H_FREQ, picks=PICKS,
+                 trigger=TRIGGER, scale=SCALE, buffer_time=30.0, stop_margin=None, stop_min_time=1.0,
+                 stop_interval=0.1):
+        """
+        Create a trial decoder.
+
+        Args:
+            model (pyntbci.classifiers.eCCA):
+                The fitted classifier
+            fs_in (float):
+                The sampling frequency of the EEG stream
+            fs (int):
+                The sampling frequency of the model. Default: FS
+            trial_time (float):
+                The maximum duration of a trial in seconds. Default: TRIAL_TIME
+            l_freq (float):
+                The lower pass-band edge. Default: L_FREQ
+            h_freq (float):
+                The upper pass-band edge. Default: H_FREQ
+            picks (np.ndarray):
+                The indexes of the EEG channels in the stream. Default: PICKS
+            trigger (int):
+                The index of the trigger channel, whose rising edges mark trial onsets. If None, onsets are taken
+                from the markers. Default: TRIGGER
+            scale (float):
+                The scale of the EEG to the units of the model. Default: SCALE
+            buffer_time (float):
+                The duration of the ring buffer in seconds. Default: 30.0
+            stop_margin (float):
+                The margin between the correlation of the best and second best class at which the running trial
+                can stop. If None, trials do not stop early. Default: None
+            stop_min_time (float):
+                The minimum duration of a trial in seconds before it can stop. Default: 1.0
+            stop_interval (float):
+                The time in seconds between classifications of the running trial. Default: 0.1
+        """
+        self.model = model
+        self.fs_in = fs_in
+        self.fs = fs
+        self.trial_time = trial_time
+        self.picks = picks
+        self.trigger = trigger
+        self.scale = scale
+        self.stop_margin = stop_margin
+        self.stop_min_time = stop_min_time
+        self.stop_interval = stop_interval
+        self.filter = OnlineFilter(fs_in, l_freq, h_freq, len(picks))
+
+        # Channel 0 holds the raw trigger, the others the filtered EEG
+        self.buffer = RingBuffer(1 + len(picks), int(buffer_time * fs_in))
+
+        # Trials that are not classified yet, from their start_trial marker onwards
+        self.pending = []
+
+        # The resampler of each number of output samples, and the time after the last sample it needs as context
+        self.resamplers = dict()
+        self.context = self.get_resampler(1).last / fs_in
+
+    def push_eeg(self, samples, times):
+        """
+        Add a chunk of EEG.
+
+        Args:
+            samples (np.ndarray):
+                The samples of all channels of the stream of shape (samples, channels)
+            times (np.ndarray):
+                The time stamps of shape (samples)
+        """
+        samples = np.asarray(samples)
+        filtered = self.filter.apply(samples[:, self.picks] * self.scale)
+        trigger = samples[:, [self.trigger]] if self.trigger is not None else np.zeros((samples.shape[0], 1))
+        self.buffer.write(np.concatenate((trigger, filtered), axis=1), np.asarray(times))
+
+    def push_marker(self, marker, time):
+        """
+        Add a marker. A start_trial marker starts a trial, the stop_trial marker gives its duration.
+
+        Args:
+            marker (str):
+                The marker, e.g., "start_trial;trial=0" or "stop_trial;trial=0;stop_frame=120;elapsed=2.00000"
+            time (float):
+                The time stamp
+        """
+        fields = marker.split(";")
+        if fields[0] == "start_trial":
+            trial = int(fields[1].split("=")[1])
+            self.pending.append(dict(trial=trial, time=time, onset=None, duration=None, checked=0.0, stopped=False))
+        elif fields[0] == "stop_trial":
+            values = dict(field.split("=") for field in fields[1:])
+            for item in self.pending:
+                if item["trial"] == int(values["trial"]):
+                    item["duration"] = min(float(values.get("elapsed", self.trial_time)), self.trial_time)
+
+    def get_onset(self, time, margin=0.5):
+        """
+        Get the onset of a trial: the first rising edge of the trigger within a margin of its marker.
+
+        Args:
+            time (float):
+                The time stamp of the start_trial marker
+            margin (float):
+                The time in seconds around the marker to search the trigger in. Default: 0.5
+
+        Returns:
+            (int):
+                The index of the onset sample, or None if the data around the marker is not complete yet
+        """
+        last = self.buffer.find(time + margin)
+        if last is None:
+            return None
+        marker = self.buffer.find(time)
+        if self.trigger is None:
+            return marker
+        first = max(self.buffer.find(time - margin), self.buffer.count - self.buffer.size + 1)
+        trigger = self.buffer.read(first - 1, last)[0][:, 0]
+        edges = np.flatnonzero(np.diff(trigger) > 0)
+        if edges.size == 0:
+            return marker
+        return first + edges[0]
+
+    def get_resampler(self, n_samples):
+        """
+        Get the resampler of trials of a number of output samples, designed once.
+
+        Args:
+            n_samples (int):
+                The number of output samples of the trials
+
+        Returns:
+            (resampling.Resampler):
+                The resampler
+        """
+        if n_samples not in self.resamplers:
+            self.resamplers[n_samples] = Resampler(self.fs_in, self.fs, n_samples)
+        return self.resamplers[n_samples]
+
+    def get_stop(self, duration):
+        """
+        Get the end of the input of a trial in samples relative to its onset, including the context of the resampler.
+
+        Args:
+            duration (float):
+                The duration of the trial in seconds
+
+        Returns:
+            (int):
+                The index after the last sample of the input relative to the onset
+        """
+        return self.get_resampler(int(duration * self.fs)).last
+
+    def get_epoch(self, onset, duration):
+        """
+        Get the preprocessed data of a trial: filtered, sliced and downsampled in one step as in preprocessing (see
+        resampling.Resampler).
+
+        Args:
+            onset (int):
+                The index of the onset sample
+            duration (float):
+                The duration of the trial in seconds
+
+        Returns:
+            (np.ndarray):
+                The trial of shape (channels, samples)
+        """
+        resampler = self.get_resampler(int(duration * self.fs))
+        start = onset + resampler.first + self.filter.delay
+        x = self.buffer.read(start, start + resampler.last - resampler.first)[0][:, 1:].T
+        return resampler.apply(x, [-resampler.first])[0]
+
+    def check_stop(self):
+        """
+        Check whether the running trial can stop early, classifying the data of the trial so far.
+
+        Returns:
+            (bool):
+                True if the trial can stop, otherwise False
+        """
+        if self.stop_margin is None:
+            return False
+        for item in self.pending:
+            if item["duration"] is not None or item["stopped"]:
+                continue
+            if item["onset"] is None:
+                item["onset"] = self.get_onset(item["time"])
+                if item["onset"] is None:
+                    continue
+
+            # The filtered data is complete up to the group delay of the filter, the last samples are the context of
+            # the resampler
+            available = (self.buffer.count - self.filter.delay - item["onset"] - 1) / self.fs_in - self.context
+            if available < max(self.stop_min_time, item["checked"] + self.stop_interval):
+                continue
+            item["checked"] = available
+
+            scores = self.model.decision_function(self.get_epoch(item["onset"], available)[np.newaxis, :, :])[0]
+            second, best = np.sort(scores)[-2:]
+            if best - second >= self.stop_margin:
+                item["stopped"] = True
+                return True
+        return False
+
+    def poll(self):
+        """
+        Classify all trials whose data is complete.
+
+        Returns:
+            (list):
+                The results as (trial, label) tuples
+        """
+        results = []
+        for item in list(self.pending):
+            if item["onset"] is None:
+                item["onset"] = self.get_onset(item["time"])
+            if item["onset"] is None or item["duration"] is None:
+                continue
+            if self.buffer.count >= item["onset"] + self.get_stop(item["duration"]) + self.filter.delay:
+                X = self.get_epoch(item["onset"], item["duration"])[np.newaxis, :, :]
+                results.append((item["trial"], int(self.model.predict(X)[0])))
+                self.pending.remove(item)
+        return results
+
+
+def _run(model, eeg_stream, marker_stream, kwargs, results, ready, stopped, early_stop):
+    from pylsl import StreamInlet, resolve_byprop, proc_clocksync, proc_dejitter
+
+    # Connect to the streams, with all time stamps in the local clock
+    eeg_inlet = StreamInlet(resolve_byprop("name", eeg_stream)[0], processing_flags=proc_clocksync | proc_dejitter)
+    marker_inlet = StreamInlet(resolve_byprop("name", marker_stream)[0], processing_flags=proc_clocksync)
+    decoder = TrialDecoder(model, eeg_inlet.info().nominal_srate(), **kwargs)
+    ready.set()
+
+    while not stopped.is_set():
+        samples, times = eeg_inlet.pull_chunk(timeout=0.02)
+        if times:
+            decoder.push_eeg(samples, times)
+        markers, times = marker_inlet.pull_chunk(timeout=0.0)
+        for marker, time in zip(markers, times):
+            decoder.push_marker(marker[0], time)
+        if decoder.check_stop():
+            early_stop.set()
+        for result in decoder.poll():
+            results.put(result)
+
+
+class OnlineDecoder(object):
+    """
+    Runs a TrialDecoder on the LSL streams in its own process, such that it never takes time from the keyboard.
+    """
+
+    def __init__(self, model, marker_stream="KeyboardMarkerStream", eeg_stream="BioSemi", **kwargs):
+        """
+        Create an online decoder.
+
+        Args:
+            model (pyntbci.classifiers.eCCA):
+                The fitted classifier
+            marker_stream (str):
+                The name of the marker stream of the keyboard. Default: "KeyboardMarkerStream"
+            eeg_stream (str):
+                The name of the EEG stream. Default: "BioSemi"
+            kwargs (dict):
+                The arguments of the TrialDecoder
+        """
+        self.results = multiprocessing.Queue()
+        self.ready = multiprocessing.Event()
+        self.stopped = multiprocessing.Event()
+
+        # Set when the running trial can stop early, to be passed to Keyboard.run
+        self.early_stop = multiprocessing.Event()
+
+        self.process = multiprocessing.Process(target=_run, daemon=True, args=(
+            model, eeg_stream, marker_stream, kwargs, self.results, self.ready, self.stopped, self.early_stop))
+
+    def start(self, timeout=10.0):
+        """
+        Start decoding, waiting until the streams are connected.
+
+        Args:
+            timeout (float):
+                The maximum time in seconds to wait for the streams. Default: 10.0
+        """
+        self.process.start()
+        if not self.ready.wait(timeout):
+            self.stop()
+            raise Exception("Could not connect to the EEG and marker streams")
+
+    def get_result(self, timeout=None):
+        """
+        Get the next classified trial.
+
+        Args:
+            timeout (float):
+                The maximum time in seconds to wait for a result. If None, do not wait. Default: None
+
+        Returns:
+            (tuple):
+                The trial and the predicted label, or None if there is no result
+        """
+        try:
+            return self.results.get(block=timeout is not None, timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def get_trial_result(self, trial, timeout):
+        """
+        Get the classification of a trial. Results of earlier trials, e.g., one that arrived after its own timeout,
+        are discarded, such that a late result is never taken as the selection of a later trial.
+
+        Args:
+            trial (int):
+                The trial
+            timeout (float):
+                The maximum time in seconds to wait for the result of the trial
+
+        Returns:
+            (int):
+                The predicted label, or None if the trial was not classified within the timeout
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            result = self.get_result(timeout=max(0.0, deadline - time.monotonic()))
+            if result is None:
+                return None
+            if result[0] == trial:
+                return result[1]
+            print(f"\tDiscarded the classification of trial {result[0]} during trial {trial}")
+
+    def stop(self):
+        """
+        Stop decoding.
+        """
+        self.stopped.set()
+        self.process.join(timeout=1.0)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+def fit_model(X, y, fs, cycle_size, pr=PR):
+    """
+    Fit an eCCA as in decode(), with the circular shift of the codes as lags.
+
+    Args:
+        X (np.ndarray):
+            The trials of shape (trials, channels, samples)
+        y (np.ndarray):
+            The labels of shape (trials)
+        fs (int):
+            The sampling frequency
+        cycle_size (float):
+            The duration of one code cycle in seconds
+        pr (int):
+            The presentation rate of the codes. Default: PR
+
+    Returns:
+        (pyntbci.classifiers.eCCA):
+            The fitted classifier
+    """
+    import pyntbci
+    n_classes = int(np.max(y)) + 1
+    n_bits = int(round(cycle_size * pr))
+    lags = np.arange(n_classes) * ((n_bits // n_classes) / pr)
+    return pyntbci.classifiers.eCCA(lags=lags, fs=fs, cycle_size=cycle_size).fit(X, y)
+
+
+def load_model(fn):
+    """
+    Load a fitted classifier.
+
+    Args:
+        fn (str):
+            The pickle file
+
+    Returns:
+        (pyntbci.classifiers.eCCA):
+            The fitted classifier
+    """
+    with open(fn, "rb") as fid:
+        return pickle.load(fid)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Online decoding")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    fit = subparsers.add_parser("fit", help="fit a model on a derivative")
+    fit.add_argument("derivative", type=str, help="folder of the derivative")
+    fit.add_argument("model", type=str, help="pickle file to save the model in")
+    args = parser.parse_args()
+
+    with open(os.path.join(args.derivative, "info.json"), "r") as fid:
+        info = json.load(fid)
+    X = np.load(os.path.join(args.derivative, "X.npy"))
+    y = np.load(os.path.join(args.derivative, "y.npy"))
+    V = np.load(os.path.join(args.derivative, "V.npy"))
+    model = fit_model(X, y, info["fs"], V.shape[1] / info["fs"])
+    os.makedirs(os.path.dirname(os.path.abspath(args.model)), exist_ok=True)
+    with open(args.model, "wb") as fid:
+        pickle.dump(model, fid)
@@ -6,23 +6,340 @@
 Python implementation of a keyboard for the noise-tagging project.
 """
 
-import json
+import os
 import numpy as np
-from psychopy import visual, event, monitors, misc
-from psychopy import core
+from PIL import Image
+from stimuli import StimulusProvider, to_image
+from generate_images_grating import KEY_MAPPING
+import headless as headless_backend
 import random
 import itertools
-import pyntbci
 
-FR = 60
+FR = 60  # nominal framerate, until the framerate of the window is measured
 PR = 60  # codes presentation rate
 
+LIBRARY = None  # code sets, see codebook.py and get_library
+
+
+def get_library():
+    """
+    Get the library of code sets, opened on first use such that importing the keyboard does not (re)build it.
+
+    Returns:
+        (codebook.CodeLibrary):
+            The library
+    """
+    global LIBRARY
+    if LIBRARY is None:
+        from codebook import CodeLibrary
+        LIBRARY = CodeLibrary()
+    return LIBRARY
+
+
+class TrialPlan(object):
+    """
+    A compiled trial: the state of each key at each frame, precomputed such that presenting a trial only indexes 
+    into this plan.
+    """
+
+    def __init__(self, names, codes, n_frames, keys):
+        """
+        Compile a trial plan.
+
+        Args:
+            names (list):
+                The names of the keys to flash
+            codes (list):
+                The code sequence of integer states (images) for each of the keys in names. Codes shorter than 
+                n_frames are repeated
+            n_frames (int):
+                The number of frames of the trial
+            keys (dict):
+                The keys of the keyboard, mapping the name of a key to its list of images (stimuli)
+        """
+        self.names = names
+        self.n_frames = n_frames
+
+        # The frame x key state matrix
+        frames = np.arange(n_frames)
+        self.states = np.empty((n_frames, len(names)), dtype="uint8")
+        for i, code in enumerate(codes):
+            self.states[:, i] = code[frames % code.size]
+
+        # The frames at which any of the keys changes state (the first frame always counts as a change)
+        changed = np.ones(n_frames, dtype="bool")
+        changed[1:] = np.any(self.states[1:, :] != self.states[:-1, :], axis=1)
+        self.changes = np.flatnonzero(changed)
+
+        # The stimuli to draw at each frame
+        if isinstance(keys, KeyAtlas):
+            self.stimuli = keys.schedule(names, self.states)
+        else:
+            images = [keys[name] for name in names]
+            self.stimuli = [[images[i][state] for i, state in enumerate(row)] for row in self.states.tolist()]
+
+
+class FrameTimer(object):
+    """
+    Records the timestamp of every flip of a trial into a preallocated array and summarizes the frame timing of 
+    the trial, flagging frames that took longer than a threshold relative to the nominal frame period.
+    """
+
+    # Record of the per-trial summary in the binary timing log
+    SUMMARY_DTYPE = np.dtype([("trial", "i4"), ("n_frames", "i4"), ("n_dropped", "i4"), ("first", "f8"), 
+        ("max_interval", "f4"), ("mean_interval", "f4"), ("jitter", "f4")])
+
+    def __init__(self, framerate, threshold=1.5, max_frames=1024, log_file=None):
+        """
+        Create a frame timer.
+
+        Args:
+            framerate (float):
+                The nominal framerate in Hz
+            threshold (float):
+                A frame interval longer than threshold times the nominal frame period counts as a dropped frame. 
+                Default: 1.5
+            max_frames (int):
+                The number of timestamps that are preallocated, grown when a trial is longer. Default: 1024
+            log_file (str):
+                The file to append the binary per-trial summaries to (see SUMMARY_DTYPE). If None, nothing is 
+                written. Default: None
+        """
+        self.period = 1.0 / framerate
+        self.threshold = threshold
+        self.timestamps = np.zeros(max_frames, dtype="float64")
+        self.n_frames = 0
+        self.log_file = log_file
+
+    def start(self, n_frames):
+        """
+        Start recording a trial, making sure the timestamps of all frames fit the preallocated array.
+
+        Args:
+            n_frames (int):
+                The number of frames of the trial
+
+        Returns:
+            (np.ndarray): 
+                The array to write the flip timestamps in
+        """
+        if n_frames > self.timestamps.size:
+            self.timestamps = np.zeros(n_frames, dtype="float64")
+        self.n_frames = n_frames
+        return self.timestamps
+
+    def summary(self, trial=-1):
+        """
+        Summarize the frame timing of the last recorded trial.
+
+        Args:
+            trial (int):
+                The trial number to store with the summary. Default: -1
+
+        Returns:
+            (np.ndarray): 
+                The summary as a single record of SUMMARY_DTYPE
+        """
+        summary = np.zeros(1, dtype=self.SUMMARY_DTYPE)
+        summary["trial"] = trial
+        summary["n_frames"] = self.n_frames
+        if self.n_frames > 0:
+            summary["first"] = self.timestamps[0]
+        if self.n_frames > 1:
+            intervals = np.diff(self.timestamps[:self.n_frames])
+            summary["n_dropped"] = np.sum(intervals > self.threshold * self.period)
+            summary["max_interval"] = intervals.max()
+            summary["mean_interval"] = intervals.mean()
+            summary["jitter"] = intervals.std()
+        if self.log_file is not None:
+            with open(self.log_file, "ab") as fid:
+                summary.tofile(fid)
+        return summary[0]
+
+    @classmethod
+    def read_log(cls, log_file):
+        """
+        Read the per-trial summaries of a binary timing log.
+
+        Args:
+            log_file (str):
+                The binary timing log
+
+        Returns:
+            (np.ndarray): 
+                The summaries of all trials as a structured array of SUMMARY_DTYPE
+        """
+        return np.fromfile(log_file, dtype=cls.SUMMARY_DTYPE)
+
+    @staticmethod
+    def format(summary):
+        """
+        Format a summary as the fields of a marker.
+
+        Args:
+            summary (np.void):
+                The summary as a single record of SUMMARY_DTYPE
+
+        Returns:
+            (str): 
+                The summary as ;-separated key=value fields
+        """
+        return (f"n_frames={summary['n_frames']};n_dropped={summary['n_dropped']};"
+            f"max_interval={summary['max_interval']:.5f};mean_interval={summary['mean_interval']:.5f};"
+            f"jitter={summary['jitter']:.5f}")
+
+
+class AtlasFrame(object):
+    """
+    One frame of a key atlas: the atlas tile shown by each of the keys.
+    """
+
+    def __init__(self, atlas, phases):
+        """
+        Create an atlas frame.
+
+        Args:
+            atlas (KeyAtlas):
+                The key atlas that is drawn
+            phases (np.ndarray):
+                The texture phases of each of the keys in the atlas of shape (n_keys, 2), selecting their tiles
+        """
+        self.atlas = atlas
+        self.phases = phases
+
+    def draw(self):
+        """
+        Draw all keys of the atlas in one draw call.
+        """
+        self.atlas.stimulus.phases = self.phases
+        self.atlas.stimulus.draw()
+
+
+class KeyAtlas(object):
+    """
+    A texture atlas with the images of all keys, rendered as one element array. Each key is one element, and the 
+    state of a key selects its tile in the atlas by means of the texture coordinates of the element.
+    """
+
+    def __init__(self, window, backend=None):
+        """
+        Create an empty key atlas.
+
+        Args:
+            window (visual.Window):
+                The window to draw the keys in
+            backend (module):
+                The module that provides the stimuli, i.e., psychopy.visual or headless. If None, psychopy.visual.
+                Default: None
+        """
+        if backend is None:
+            from psychopy import visual as backend
+        self.window = window
+        self.backend = backend
+        self.names = []
+        self.sizes = []
+        self.positions = []
+        self.images = []
+        self.stimulus = None
+
+    def add_key(self, name, size, pos, images):
+        """
+        Add a key to the atlas. The atlas is (re)built lazily the next time it is shown or scheduled.
+
+        Args:
+            name (str):
+                The name of the key
+            size (array-like):
+                The (width, height) of the key in pixels
+            pos (array-like):
+                The (x, y) coordinate of the center of the key, relative to the center of the window
+            images (array-like):
+                The images of the key, either file names or textures (see stimuli.py). The first image is the 
+                default key
+        """
+        self.names.append(name)
+        self.sizes.append(size)
+        self.positions.append(pos)
+        self.images.append([Image.fromarray(to_image(image)) if isinstance(image, np.ndarray) else 
+            Image.open(image).convert("RGB") for image in images])
+        if self.stimulus is not None:
+            self.stimulus.setAutoDraw(False)
+            self.stimulus = None
+
+    def build(self):
+        """
+        Pack the images of all keys into a single square power-of-two texture and create the element array.
+        """
+        tiles = [image for images in self.images for image in images]
+        tile_size = max(max(image.size) for image in tiles)
+        n_cols = int(np.ceil(np.sqrt(len(tiles))))
+        side = int(2 ** np.ceil(np.log2(n_cols * tile_size)))
+        n_cols = side // tile_size
+
+        # Paste the tiles row by row from the top left
+        texture = Image.new("RGB", (side, side))
+        for i, image in enumerate(tiles):
+            row, col = divmod(i, n_cols)
+            texture.paste(image.resize((tile_size, tile_size)), (col * tile_size, row * tile_size))
+
+        # Texture phases that center each tile on its element (the texture is flipped vertically on upload)
+        rows, cols = np.divmod(np.arange(len(tiles)), n_cols)
+        self.tile_phases = np.stack((0.5 - (cols + 0.5) * tile_size / side, (rows + 0.5) * tile_size / side - 0.5), axis=1)
+        self.offsets = np.cumsum([0] + [len(images) for images in self.images[:-1]])
+        self.default_phases = self.tile_phases[self.offsets]
+
+        self.stimulus = self.backend.ElementArrayStim(win=self.window, units="pix", nElements=len(self.names), 
+            xys=self.positions, sizes=self.sizes, sfs=tile_size / side, phases=self.default_phases, 
+            elementTex=texture, elementMask=None, interpolate=False, autoLog=False)
+
+    def setAutoDraw(self, value):
+        """
+        Set whether the keys are drawn automatically on every flip, showing the default image of each key.
+
+        Args:
+            value (bool):
+                Whether or not to draw the keys on every flip
+        """
+        if len(self.names) == 0:
+            return
+        if self.stimulus is None:
+            self.build()
+        self.stimulus.phases = self.default_phases
+        self.stimulus.setAutoDraw(value)
+
+    def schedule(self, names, states):
+        """
+        Schedule the atlas frames of a trial. Keys that are not scheduled show their default image.
+
+        Args:
+            names (list):
+                The names of the keys that are scheduled
+            states (np.ndarray):
+                The frame x key state matrix of shape (n_frames, len(names))
+
+        Returns:
+            (list): 
+                The stimuli to draw at each frame, i.e., a single atlas frame per frame
+        """
+        if self.stimulus is None:
+            self.build()
+        keys = np.array([self.names.index(name) for name in names], dtype="int")
+        phases = np.tile(self.default_phases, (states.shape[0], 1, 1))
+        phases[:, keys, :] = self.tile_phases[self.offsets[keys] + states]
+
+        # Frames with identical states share one atlas frame
+        unique, inverse = np.unique(states, axis=0, return_inverse=True)
+        frames = [AtlasFrame(self, phases[np.flatnonzero(inverse.ravel() == i)[0]]) for i in range(unique.shape[0])]
+        return [[frames[i]] for i in inverse.ravel()]
+
+
 class Keyboard(object):
     """
     A keyboard with keys and text fields.
     """
 
-    def __init__(self, size, width, distance, screen=0, window_color=(0, 0, 0), stream=True, stream_postfix=""):
+    def __init__(self, size, width, distance, screen=0, window_color=(0, 0, 0), stream=True, stream_postfix="", atlas=False, 
+                 timing_log=None, headless=False):
         """
         Create a keyboard.
 
@@ -39,24 +356,91 @@ class Keyboard(object):
                 The background color of the window, default: (0, 0, 0)
             stream (bool):
                 Whether or not to log events/markers in an LSL stream. Default: True
+            atlas (bool):
+                Whether or not to render all keys from a single texture atlas in one draw call per frame, instead of 
+                one draw call per key. Default: False
+            timing_log (str):
+                The file to append binary per-trial frame timing summaries to. If None, frame timing is only 
+                recorded in memory and logged as markers. Default: None
+            headless (bool):
+                Whether to use a null window that needs no display and renders nothing (see headless.py), e.g., to 
+                measure the CPU cost of the keyboard. Default: False
         """
+        # Set up the backend, PsychoPy is only imported for a window on a display
+        self.headless = headless
+        if headless:
+            self.visual, monitors, self.deg2pix = headless_backend, headless_backend, headless_backend.deg2pix
+        else:
+            from psychopy import visual, monitors, misc
+            self.visual, self.deg2pix = visual, misc.deg2pix
+
         # Set up monitor (sets pixels per degree)
         self.monitor = monitors.Monitor("testMonitor", width=width, distance=distance)
         self.monitor.setSizePix(size)
 
         # Set up window
-        self.window = visual.Window(monitor=self.monitor, screen=screen, units="pix", size=size, color=window_color, fullscr=False, waitBlanking=False, allowGUI=False)
+        self.window = self.visual.Window(monitor=self.monitor, screen=screen, units="pix", size=size, color=window_color, fullscr=False, waitBlanking=False, allowGUI=False)
         self.window.setMouseVisible(False)
 
-        # Initialize keys and fields
-        self.keys = dict()
+        # Initialize fields
         self.fields = dict()
 
-        # Setup LSL stream
+        # Initialize layouts of keys, each with its own keys, texture atlas and cache of compiled trial plans
+        self.use_atlas = atlas
+        self.layouts = dict()
+        self.set_layout("default")
+
+        # Initialize frame timing instrumentation, at the nominal framerate until it is measured
+        self.timer = FrameTimer(FR, log_file=timing_log)
+
+        # The framerate is measured once, on first request
+        self.framerate = None
+
+        # Setup LSL stream, with markers pushed from a background thread
         self.stream = stream
-        if self.stream:
+        self.stream_postfix = None
+        self.markers = None
+        self.set_stream(stream_postfix)
+
+    def set_stream(self, stream_postfix=""):
+        """
+        Set the LSL marker stream that events/markers are logged to, replacing the current one, e.g., to use a 
+        separate stream per condition.
+
+        Args:
+            stream_postfix (str):
+                The postfix of the name of the stream, i.e., KeyboardMarkerStream{stream_postfix}. Default: ""
+        """
+        if self.stream and stream_postfix != self.stream_postfix:
             from pylsl import StreamInfo, StreamOutlet
+            from markers import MarkerDispatcher
+            if self.markers is not None:
+                self.markers.close()
+            self.stream_postfix = stream_postfix
             self.outlet = StreamOutlet(StreamInfo(name='KeyboardMarkerStream'+stream_postfix, type='Markers', channel_count=1, nominal_srate=0, channel_format='string', source_id='KeyboardMarkerStream'+stream_postfix))
+            self.markers = MarkerDispatcher(self.outlet)
+
+    def set_layout(self, name):
+        """
+        Set the active layout of keys. Layouts keep their keys and textures, such that switching back to a layout 
+        does not need to add its keys again. The keys of the previous layout are hidden.
+
+        Args:
+            name (str):
+                The name of the layout
+
+        Returns:
+            (bool): 
+                True if the layout is new, i.e., it has no keys yet, otherwise False
+        """
+        if self.layouts:
+            self.set_keys_auto_draw(False)
+        is_new = name not in self.layouts
+        if is_new:
+            self.layouts[name] = (dict(), KeyAtlas(self.window, self.visual) if self.use_atlas else None, dict())
+        self.keys, self.atlas, self.plans = self.layouts[name]
+        self.set_keys_auto_draw(True)
+        return is_new
 
     def get_size(self):
         """
@@ -76,18 +460,21 @@ class Keyboard(object):
             (float): 
                 The pixels per degree of visual angle
         """
-        return misc.deg2pix(1.0, self.monitor)
+        return self.deg2pix(1.0, self.monitor)
 
     def get_framerate(self):
         """
-        Get the framerate in Hz of the window.
+        Get the framerate in Hz of the window, as measured on first request, to 0.01 Hz (e.g., 59.94 Hz).
 
         Returns:
             (float): 
                 The framerate in Hz
         """
         #infoMsg="" --> this makes sure that the annoying message in the middle is removed
-        return int(np.round(self.window.getActualFrameRate(infoMsg="")))
+        if self.framerate is None:
+            self.framerate = round(float(self.window.getActualFrameRate(infoMsg="")), 2)
+            self.timer.period = 1.0 / self.framerate
+        return self.framerate
 
     def add_key(self, name, size, pos, images=["black.png", "white.png"]):
         """
@@ -101,13 +488,19 @@ class Keyboard(object):
             pos (array-like):
                 The (x, y) coordinate of the center of the key, relative to the center of the window
             images (array-like):
-                The images of the key. The first image is the default key. Indices will correspond to the 
-                values of the codes. Default: ["black.png", "white.png"]
+                The images of the key, either file names or textures as numpy arrays of shape (height, width, 3) 
+                with values between -1 and 1 (see stimuli.py). The first image is the default key. Indices will 
+                correspond to the values of the codes. Default: ["black.png", "white.png"]
         """
         assert name not in self.keys, "Trying to add a box with a name that already extists!"
+        self.plans.clear()
+        if self.atlas is not None:
+            self.keys[name] = list(images)
+            self.atlas.add_key(name, size, pos, images)
+            return
         self.keys[name] = []
         for image in images:
-            self.keys[name].append(visual.ImageStim(win=self.window, image=image, 
+            self.keys[name].append(self.visual.ImageStim(win=self.window, image=image, 
             units="pix", pos=pos, size=size, autoLog=False))
 
         # Set autoDraw to True for first default key to keep app visible
@@ -132,7 +525,7 @@ class Keyboard(object):
                 The color of the text on the text field, default: (-1, -1, -1)
         """
         assert name not in self.fields, "Trying to add a text field with a name that already extists!"
-        self.fields[name] = self.fields[name] = visual.TextBox2(win=self.window, text=text, font='Courier', 
+        self.fields[name] = self.fields[name] = self.visual.TextBox2(win=self.window, text=text, font='Courier', 
             units="pix", pos=pos, size=size, letterHeight=0.5*size[1], 
             color=text_color, fillColor=field_color, alignment="left", 
             autoDraw=True, autoLog=False)
@@ -148,64 +541,163 @@ class Keyboard(object):
                 The text
         """
         self.fields[name].setText(text)
+        if self.atlas is not None:
+            self.atlas.setAutoDraw(True)
         self.window.flip()
 
     def log(self, marker, on_flip=False):
+        """
+        Log a marker. It is time stamped on this thread, but serialized and pushed by a background thread.
+
+        Args:
+            marker (list):
+                The marker as a list of one string, or a string
+            on_flip (bool):
+                Whether to time stamp the marker at the next flip instead of now. Default: False
+        """
         if self.stream and not marker is None:
             if not isinstance(marker, list):
                 marker = [marker]
             if on_flip:
-                self.window.callOnFlip(self.outlet.push_sample, marker)
+                self.window.callOnFlip(self.markers.push, marker)
             else:
-                self.outlet.push_sample(marker)    
+                self.markers.push(marker)
+
+    def log_codes(self, codes):
+        """
+        Log a code table. It is sent bit-packed the first time on the current stream (code_table marker), and 
+        referred to by its content hash (codes marker), see markers.encode_codes.
+
+        Args:
+            codes (dict):
+                A dictionary with keys being the symbols to flash and the value a list (the code 
+                sequence) of integer states (images) for each frame
+        """
+        if self.stream:
+            self.markers.push_codes(codes)
     
-    def run(self, codes, duration=None, start_marker=None, stop_marker=None):
+    def compile(self, codes, duration=None):
         """
-        Present a trial with concurrent flashing of each of the symbols.
+        Compile codes into a trial plan. Plans are cached by the content of the codes and the number of frames, such 
+        that the same codes presented in many trials are only compiled once.
 
         Args:
             codes (dict): 
                 A dictionary with keys being the symbols to flash and the value a list (the code 
                 sequence) of integer states (images) for each frame
             duration (float):
-                The duration of the trial in seconds. If the duration is longer than the code
-                sequence, it is repeated. If no duration is given, the full length of the first 
-                code is used. Default: None
+                The duration of the trial in seconds, presented at the measured framerate. If no duration is given, 
+                the full length of the first code is used. Default: None
+
+        Returns:
+            (TrialPlan): 
+                The compiled trial plan
         """
         # Set number of frames
         if duration is None:
             n_frames = len(codes[list(codes.keys())[0]])
         else:
-            n_frames = int(duration * FR)
+            n_frames = int(round(duration * self.get_framerate()))
+
+        # Codes are mutable (e.g., highlights), so the cache is keyed by content
+        names = list(codes.keys())
+        arrays = [np.asarray(codes[name]).astype("uint8") for name in names]
+        signature = (n_frames, tuple((name, array.tobytes()) for name, array in zip(names, arrays)))
+        if signature not in self.plans:
+            self.plans[signature] = TrialPlan(names, arrays, n_frames, self.keys if self.atlas is None else self.atlas)
+        return self.plans[signature]
+
+    def run(self, codes, duration=None, start_marker=None, stop_marker=None, timing_marker=None, trial=-1, stop=None):
+        """
+        Present a trial with concurrent flashing of each of the symbols.
+
+        Args:
+            codes (dict): 
+                A dictionary with keys being the symbols to flash and the value a list (the code 
+                sequence) of integer states (images) for each frame
+            duration (float):
+                The duration of the trial in seconds. If the duration is longer than the code
+                sequence, it is repeated. If no duration is given, the full length of the first 
+                code is used. Default: None
+            timing_marker (str):
+                The marker to which the frame timing summary of the trial is appended, e.g., 
+                "timing;trial=0". If None, no frame timing summary is logged. Default: None
+            trial (int):
+                The trial number stored with the frame timing summary. Default: -1
+            stop (threading.Event):
+                A signal to end the trial early, e.g., a threading.Event or multiprocessing.Event set by a decoder. 
+                It is cleared at the start of the trial and checked every frame without blocking. Once it is set, 
+                the trial ends on the next frame, and the stop frame and elapsed time are appended to the stop 
+                marker. If None, the trial always lasts its full duration. Default: None
+
+        Returns:
+            (np.void): 
+                The frame timing summary of the trial (see FrameTimer.SUMMARY_DTYPE)
+        """
+        # Compile (or fetch from cache) the per-frame draw schedule
+        plan = self.compile(codes, duration)
+        stimuli = plan.stimuli
+
+        # Preallocated flip timestamps
+        timestamps = self.timer.start(plan.n_frames)
 
         # Set autoDraw to False for full control
-        for key in self.keys.values():
-            key[0].setAutoDraw(False)
+        self.set_keys_auto_draw(False)
 
         # Send start marker
         self.log(start_marker, on_flip=True)
+        if stop is not None:
+            stop.clear()
 
         # Loop frame flips
-        for i in range(n_frames):
+        n_frames = plan.n_frames
+        for i in range(plan.n_frames):
 
             # Check quiting
             if i % 60 == 0:
                 if self.is_quit():
                     self.quit()
 
+            # Check stopping
+            if stop is not None and stop.is_set():
+                n_frames = i
+                break
+
             # Draw keys with color depending on code state
-            for name, code in codes.items():
-                # added int()
-                self.keys[name][int(code[i % len(code)])].draw()
-            self.window.flip()
+            for stimulus in stimuli[i]:
+                stimulus.draw()
+            timestamps[i] = self.window.flip()
 
         # Send stop markers
+        if stop is not None and stop_marker is not None:
+            elapsed = timestamps[n_frames - 1] - timestamps[0] + self.timer.period if n_frames > 0 else 0.0
+            stop_marker = [f"{stop_marker[0]};stop_frame={n_frames};elapsed={elapsed:.5f}"]
         self.log(stop_marker)
+        self.timer.n_frames = n_frames
+
+        # Summarize frame timing
+        summary = self.timer.summary(trial)
+        if timing_marker is not None:
+            self.log(f"{timing_marker};{self.timer.format(summary)}")
 
         # Set autoDraw to True to keep app visible
-        for key in self.keys.values():
-            key[0].setAutoDraw(True)
+        self.set_keys_auto_draw(True)
         self.window.flip()
+        return summary
+
+    def set_keys_auto_draw(self, value):
+        """
+        Set whether the keys are drawn automatically on every flip, showing the default image of each key.
+
+        Args:
+            value (bool):
+                Whether or not to draw the keys on every flip
+        """
+        if self.atlas is not None:
+            self.atlas.setAutoDraw(value)
+        else:
+            for key in self.keys.values():
+                key[0].setAutoDraw(value)
 
     def is_quit(self):
         """
@@ -216,37 +708,102 @@ class Keyboard(object):
                 True is quit forced, otherwise False
         """
         # If quit keys pressed, return True
+        if self.headless:
+            return False
+        from psychopy import event
         if len(event.getKeys(keyList=["q", "escape"])) > 0:
             return True
         return False
 
-    def quit(self):
+    def close(self):
         """
-        Quit the keyboard.
+        Close the window of the keyboard, after pushing all waiting markers.
         """
+        if self.markers is not None:
+            self.markers.close()
+            self.markers = None
         self.window.setMouseVisible(True)
         self.window.close()
-        core.quit()
 
+    def quit(self):
+        """
+        Quit the keyboard.
+        """
+        self.close()
+        if not self.headless:
+            from psychopy import core
+            core.quit()
+
+
+STREAM = True
+SCREEN = 1
+SCREEN_SIZE = (2560, 1440)  # Mac: (1792, 1120), LabPC: (1920, 1080), Steven: (1920/1.25, 1080/1.25)
+SCREEN_WIDTH = 53.0  # Mac: (34,5), LabPC: 53.0
+SCREEN_DISTANCE = 50.0
+SCREEN_COLOR = (0, 0, 0)
+
+STT_WIDTH = 2.2
+STT_HEIGHT = 2.2
 
-def run_condition(classes=None, images=None, stream_postfix=""):
+TEXT_FIELD_HEIGHT = 5.0
+
+FEEDBACK_TIMEOUT = 2.0  # maximum time in seconds to wait for the classification of a trial
+
+
+def make_keyboard(stream_postfix="", atlas=False):
     """
-    Example experiment with initial setup and highlighting and presenting a few trials.
+    Open the keyboard window with its text field, to be reused for all conditions of a session.
+
+    Args:
+        stream_postfix (str):
+            The postfix of the name of the first marker stream. Default: ""
+        atlas (bool):
+            Whether or not to render the keys from a texture atlas. Default: False
+
+    Returns:
+        (Keyboard): 
+            The keyboard
     """
+    keyboard = Keyboard(size=SCREEN_SIZE, width=SCREEN_WIDTH, distance=SCREEN_DISTANCE, screen=SCREEN, window_color=SCREEN_COLOR, stream=STREAM, stream_postfix=stream_postfix, atlas=atlas)
+    ppd = keyboard.get_pixels_per_degree()
+
+    # Add text field at the top of the screen
+    x_pos = STT_WIDTH * ppd
+    y_pos = SCREEN_SIZE[1] / 2 - TEXT_FIELD_HEIGHT * ppd / 2
+    keyboard.add_text_field("text", "", (SCREEN_SIZE[0] - STT_WIDTH * ppd, TEXT_FIELD_HEIGHT * ppd), (x_pos, y_pos), (0, 0, 0), (-1, -1, -1))
+    return keyboard
 
-    STREAM = True
-    SCREEN = 1
-    SCREEN_SIZE = (2560, 1440)  # Mac: (1792, 1120), LabPC: (1920, 1080), Steven: (1920/1.25, 1080/1.25)
-    SCREEN_WIDTH = 53.0  # Mac: (34,5), LabPC: 53.0
-    SCREEN_DISTANCE = 50.0
-    SCREEN_COLOR = (0, 0, 0)
+
+def run_condition(classes=None, images=None, stream_postfix="", atlas=False, provider=None, keyboard=None, models=None, 
+                  stop_margin=None, code=None, pr=PR):
+    """
+    Example experiment with initial setup and highlighting and presenting a few trials.
+
+    Args:
+        provider (StimulusProvider):
+            The provider of the key textures. If None, the key images are loaded from the images folder. Default: None
+        keyboard (Keyboard):
+            The keyboard of the session (see make_keyboard), of which the layout of this condition is activated and 
+            the marker stream is replaced. If None, a keyboard is made for this condition only and closed 
+            afterwards. Default: None
+        models (str):
+            The folder with a fitted model per condition, e.g., "classes=30_bw.pkl" (see online.py). If given, 
+            each trial is classified online and the selected key is written in the text field. Default: None
+        stop_margin (float):
+            If given with models, trials stop early once the correlation of the best key exceeds that of the 
+            second best by this margin (see online.TrialDecoder). If None, trials last TRIAL_TIME. Default: None
+        code (str):
+            The name of the code set in data/codes (see codebook.py), of which the first codes are assigned to the 
+            keys. If None, the m-sequence shifts of the condition. Default: None
+        pr (float):
+            The presentation rate of the codes in bits per second, mapped onto the measured framerate of the 
+            keyboard (see codebook.frame_bits), also at non-integer ratios. The effective rate (see 
+            codebook.effective_rate) is logged with the condition. Default: PR
+    """
+    from psychopy import event
 
     N_TRIALS = 30
     trial_list = np.random.permutation(np.arange(classes).repeat(int(np.ceil(N_TRIALS / classes))))[:N_TRIALS]
-    STT_WIDTH = 2.2
-    STT_HEIGHT = 2.2
-
-    TEXT_FIELD_HEIGHT = 5.0
 
     KEY_WIDTH = 3.75
     KEY_HEIGHT = 3.75
@@ -261,14 +818,14 @@ def run_condition(classes=None, images=None, stream_postfix=""):
     
     if classes == 5:
         #use 12 shift m_sequence
-        codes = pyntbci.stimulus.shift(pyntbci.stimulus.make_m_sequence(), 12)
+        codename = "m_sequence_shift_classes=5"
         KEYS = [
         ["W"], 
         ["A", "S", "D"], 
         ["X"]]
     elif classes == 30:
         #use 2 shift m_sequence
-        codes = pyntbci.stimulus.shift(pyntbci.stimulus.make_m_sequence(), 2)
+        codename = "m_sequence_shift_classes=30"
         KEYS = [
             ["A", "B", "C", "D", "E", "F"],
             ["G", "H", "I", "J", "K", "L"],
@@ -278,42 +835,56 @@ def run_condition(classes=None, images=None, stream_postfix=""):
     else:
         raise Exception("Unkonwn classes:", classes)
     KEYS_ordered = [x for k in KEYS for x in k]
+    if code is not None:
+        codename = code
 
     CUE_TIME = 0.8
     TRIAL_TIME = 4.2
 
-    # Initialize keyboard
-    keyboard = Keyboard(size=SCREEN_SIZE, width=SCREEN_WIDTH, distance=SCREEN_DISTANCE, screen=SCREEN, window_color=SCREEN_COLOR, stream=STREAM, stream_postfix=stream_postfix)
+    # Initialize keyboard, or reuse the keyboard of the session
+    close = keyboard is None
+    if keyboard is None:
+        keyboard = make_keyboard(stream_postfix, atlas)
+    else:
+        keyboard.set_stream(stream_postfix)
     ppd = keyboard.get_pixels_per_degree()
 
-    # Add stimulus timing tracker at left top of the screen
-    x_pos = -SCREEN_SIZE[0] / 2 + STT_WIDTH / 2 * ppd 
-    y_pos = SCREEN_SIZE[1] / 2 - STT_HEIGHT / 2 * ppd 
-    images = ["images/black.png", "images/white.png"]
-    keyboard.add_key("stt", (STT_WIDTH * ppd, STT_HEIGHT * ppd), (x_pos, y_pos), images)
+    # Activate the layout of this condition, adding its keys only the first time
+    if keyboard.set_layout(f"classes={classes};images={images}"):
 
-    # Add text field at the top of the screen
-    x_pos = STT_WIDTH * ppd
-    y_pos = SCREEN_SIZE[1] / 2 - TEXT_FIELD_HEIGHT * ppd / 2
-    keyboard.add_text_field("text", "", (SCREEN_SIZE[0] - STT_WIDTH * ppd, TEXT_FIELD_HEIGHT * ppd), (x_pos, y_pos), (0, 0, 0), (-1, -1, -1))
-
-    # Add the keys
-    for y in range(len(KEYS)):
-        for x in range(len(KEYS[y])):
-            x_pos = (x - len(KEYS[y]) / 2 + 0.5) * (KEY_WIDTH + KEY_SPACE) * ppd
-            y_pos = -(y - len(KEYS) / 2) * (KEY_HEIGHT + KEY_SPACE) * ppd - TEXT_FIELD_HEIGHT * ppd
-            images = [f"images/{KEYS[y][x]}_{color}.png" for color in KEY_COLORS]
-            keyboard.add_key(KEYS[y][x], (KEY_WIDTH * ppd, KEY_HEIGHT * ppd), (x_pos, y_pos), images)
-
-    # Load sequences!
-    tmp = codes
+        # Add stimulus timing tracker at left top of the screen
+        x_pos = -SCREEN_SIZE[0] / 2 + STT_WIDTH / 2 * ppd 
+        y_pos = SCREEN_SIZE[1] / 2 - STT_HEIGHT / 2 * ppd 
+        if provider is None:
+            key_images = ["images/black.png", "images/white.png"]
+        else:
+            key_images = provider.get_images(None, ["black", "white"])
+        keyboard.add_key("stt", (STT_WIDTH * ppd, STT_HEIGHT * ppd), (x_pos, y_pos), key_images)
+
+        # Add the keys
+        for y in range(len(KEYS)):
+            for x in range(len(KEYS[y])):
+                x_pos = (x - len(KEYS[y]) / 2 + 0.5) * (KEY_WIDTH + KEY_SPACE) * ppd
+                y_pos = -(y - len(KEYS) / 2) * (KEY_HEIGHT + KEY_SPACE) * ppd - TEXT_FIELD_HEIGHT * ppd
+                if provider is None:
+                    key_images = [f"images/{KEYS[y][x]}_{color}.png" for color in KEY_COLORS]
+                else:
+                    key_images = provider.get_images(KEYS[y][x], KEY_COLORS)
+                keyboard.add_key(KEYS[y][x], (KEY_WIDTH * ppd, KEY_HEIGHT * ppd), (x_pos, y_pos), key_images)
+
+    # Load sequences! The codes at the framerate are cached by the library
+    framerate = keyboard.get_framerate()
+    from codebook import effective_rate
+    pr = effective_rate(framerate, pr)
+    tmp = get_library().presented(codename, framerate, pr, int(round(TRIAL_TIME * framerate)))
+    assert tmp.shape[0] >= classes, f"Code set {codename} has {tmp.shape[0]} codes for {classes} keys"
     codes = dict()
     i = 0
     for row in KEYS:
         for key in row:
-            codes[key] = np.repeat(tmp[i, :], int(FR / PR)).tolist()
+            codes[key] = tmp[i, :].tolist()
             i += 1
-    codes["stt"] = [1, 1] + [0] * int((1 + TRIAL_TIME) * keyboard.get_framerate())
+    codes["stt"] = [1, 1] + [0] * int((1 + TRIAL_TIME) * framerate)
 
 
     # Set highlights
@@ -330,8 +901,19 @@ def run_condition(classes=None, images=None, stream_postfix=""):
     keyboard.set_field_text("text", "")
     print("Starting.")
 
-    keyboard.log([f"condition;classes={classes};images={images}"])
-    keyboard.log([f"codes;{json.dumps(codes)}"])
+    # Start online decoding of the marker stream of this condition
+    decoder = None
+    text = ""
+    if models is not None:
+        from online import OnlineDecoder, load_model
+        model = load_model(os.path.join(models, f"classes={classes}_{images}.pkl"))
+        decoder = OnlineDecoder(model, marker_stream=f"KeyboardMarkerStream{keyboard.stream_postfix}", 
+                                stop_margin=stop_margin)
+        decoder.start()
+
+    keyboard.log([f"condition;classes={classes};images={images};fr={framerate:g};pr={pr:g};"
+                  f"frames_per_bit={framerate / pr:.4g}"])
+    keyboard.log_codes(codes)
 
     # Start run
     keyboard.log(marker=["start_run"])
@@ -355,11 +937,30 @@ def run_condition(classes=None, images=None, stream_postfix=""):
         highlights[target_key] = [0]
 
         # Trial
-        keyboard.run(codes, TRIAL_TIME, 
+        timing = keyboard.run(codes, TRIAL_TIME, 
             start_marker=[f"start_trial;trial={i_trial}"], 
-            stop_marker=[f"stop_trial;trial={i_trial}"])
+            stop_marker=[f"stop_trial;trial={i_trial}"], 
+            timing_marker=f"timing_trial;trial={i_trial}", trial=i_trial, 
+            stop=None if decoder is None or stop_margin is None else decoder.early_stop)
+        if timing["n_dropped"] > 0:
+            print(f"\tDropped {timing['n_dropped']} frames (max interval {1000 * timing['max_interval']:.1f} ms)")
+
+        # Feedback
+        if decoder is not None:
+            label = decoder.get_trial_result(i_trial, timeout=FEEDBACK_TIMEOUT)
+            if label is None:
+                print("\tNo classification")
+                keyboard.log([f"feedback;trial={i_trial};key=none"])
+            else:
+                selected_key = KEYS_ordered[label]
+                print(f"\tSelected {selected_key} (trial {i_trial})")
+                keyboard.log([f"feedback;trial={i_trial};label={label};key={selected_key}"])
+                text += KEY_MAPPING.get(selected_key, selected_key)
+                keyboard.set_field_text("text", text)
 
     # Wait for stop
+    if decoder is not None:
+        decoder.stop()
     keyboard.set_field_text("text", "Stopping...")
     keyboard.log(marker=["stop_run"])
     keyboard.run(highlights, 5.0)
@@ -367,15 +968,30 @@ def run_condition(classes=None, images=None, stream_postfix=""):
     print("Press button to continue.")
     event.waitKeys(keyList="c")
     keyboard.set_field_text("text", "")
+    if close:
+        keyboard.close()
 
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="Test keyboard.py")
     parser.add_argument("-n", "--ntrials", type=int, help="number of trials", default=5)
-    parser.add_argument("-c", "--code", type=str, help="code set to use", default="mseq_61_shift_2")
+    parser.add_argument("-c", "--code", type=str, help="code set to use (see codebook.py), if not the m-sequence shifts of each condition", default=None)
+    parser.add_argument("-a", "--atlas", action="store_true", help="render keys from a single texture atlas")
+    parser.add_argument("-p", "--procedural", action="store_true", help="generate key textures in memory instead of loading images")
+    parser.add_argument("-s", "--seed", type=int, help="seed of the procedural grating", default=0)
+    parser.add_argument("-m", "--models", type=str, help="folder of fitted models to classify trials online", default=None)
+    parser.add_argument("--pr", type=float, help="presentation rate of the codes in bits per second", default=PR)
+    parser.add_argument("--stop-margin", type=float, help="stop trials early at this correlation margin (with --models)", default=None)
     args = parser.parse_args()
 
+    # One provider for all conditions, such that textures are generated once
+    provider = StimulusProvider(seed=args.seed) if args.procedural else None
+
+    # One keyboard for all conditions, such that the window is opened and the framerate is measured once
+    keyboard = make_keyboard("1", args.atlas)
+    keyboard.get_framerate()
+
     # All the 4 conditon function in an array
     latin_square = [[1, 2, 4, 3, 2, 3, 1, 4],  # row
                     [2, 3, 1, 4, 1, 2, 4, 3],  # row, rotated by 1 to the left   
@@ -390,16 +1006,18 @@ if __name__ == "__main__":
     for i, i_condition in enumerate(latin_square[participant_nr]):
         #bw 30
         if i_condition == 1:
-            run_condition(classes = 30, images = "bw", stream_postfix=str(1+i))
+            run_condition(classes = 30, images = "bw", stream_postfix=str(1+i), provider=provider, keyboard=keyboard, models=args.models, stop_margin=args.stop_margin, code=args.code, pr=args.pr)
         #grating 5
         elif i_condition == 2:
-            run_condition(classes = 5, images = "grating", stream_postfix=str(1+i))
+            run_condition(classes = 5, images = "grating", stream_postfix=str(1+i), provider=provider, keyboard=keyboard, models=args.models, stop_margin=args.stop_margin, code=args.code, pr=args.pr)
         #bw 5
         elif i_condition == 3:
-            run_condition(classes = 5, images = "bw", stream_postfix=str(1+i))
+            run_condition(classes = 5, images = "bw", stream_postfix=str(1+i), provider=provider, keyboard=keyboard, models=args.models, stop_margin=args.stop_margin, code=args.code, pr=args.pr)
         #grating 30
         elif i_condition == 4:
-            run_condition(classes = 30, images = "grating", stream_postfix=str(1+i))
+            run_condition(classes = 30, images = "grating", stream_postfix=str(1+i), provider=provider, keyboard=keyboard, models=args.models, stop_margin=args.stop_margin, code=args.code, pr=args.pr)
+
+    keyboard.close()
 
 
 
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Procedural stimulus textures for the keyboard, generated in memory instead of loaded from PNG files.
+"""
+
+import hashlib
+import os
+import numpy as np
+import generate_images
+import generate_images_grating
+
+# States rendered as a symbol on a plain colored background (see generate_images.py)
+COLOR_STATES = ["black", "white", "green", "blue"]
+
+# States rendered as a symbol on a gray or grating background (see generate_images_grating.py)
+GRATING_STATES = ["gray", "grating"]
+
+
+def to_texture(image):
+    """
+    Convert an image to a PsychoPy texture.
+
+    Args:
+        image (np.ndarray):
+            The RGB image of shape (height, width, 3) with values between 0 and 255, the first row being the top
+
+    Returns:
+        (np.ndarray):
+            The texture of shape (height, width, 3) with values between -1 and 1, the first row being the bottom
+    """
+    return np.ascontiguousarray(np.flipud(image), dtype="float32") / 127.5 - 1
+
+
+def to_image(texture):
+    """
+    Convert a PsychoPy texture back to an image.
+
+    Args:
+        texture (np.ndarray):
+            The texture of shape (height, width, 3) with values between -1 and 1, the first row being the bottom
+
+    Returns:
+        (np.ndarray):
+            The RGB image of shape (height, width, 3) of uint8, the first row being the top
+    """
+    return np.round((np.flipud(texture) + 1) * 127.5).astype("uint8")
+
+
+class StimulusProvider(object):
+    """
+    Provides the textures of the keys. Textures are generated once and cached under a hash of everything they
+    depend on, in memory and optionally on disk.
+    """
+
+    def __init__(self, seed=0, cache_dir=None):
+        """
+        Create a stimulus provider.
+
+        Args:
+            seed (int):
+                The seed of the grating background. If None, the grating is random and textures are not cached on
+                disk. Default: 0
+            cache_dir (str):
+                The folder to cache generated textures in as .npy files. If None, textures are only cached in
+                memory. Default: None
+        """
+        self.seed = seed
+        self.cache_dir = cache_dir
+        self.textures = dict()
+        self.grating = None
+        self.font = None
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_hash(self, key, state):
+        """
+        Get the content hash of a texture, covering all parameters the texture is generated from.
+
+        Args:
+            key (str):
+                The name of the key, or None for no symbol
+            state (str):
+                The state (background) of the key
+
+        Returns:
+            (str):
+                The content hash
+        """
+        g = generate_images_grating
+        if state in GRATING_STATES:
+            params = (g.WIDTH, g.HEIGHT, g.PATCH_WIDTH, g.PATCH_HEIGHT, g.N_PATCHES, g.TEXT_COLOR, g.FONT_SIZE,
+                g.GRAY_COLOR, g.GAMMA, g.LAMDA, g.PHI, g.SIGMA, g.CONTRAST_SCALING,
+                self.seed if state == "grating" else None)
+        else:
+            params = (generate_images.bw_width, generate_images.bw_height, generate_images.text_color,
+                generate_images.get_font_file(), generate_images.font_size)
+        return hashlib.sha1(repr((key, state, params)).encode()).hexdigest()
+
+    def get(self, key, state):
+        """
+        Get the texture of a key in a state.
+
+        Args:
+            key (str):
+                The name of the key as used in the file names of the images, e.g., "A" or "question". If None, the
+                texture has no symbol
+            state (str):
+                The state (background) of the key: one of COLOR_STATES or GRATING_STATES
+
+        Returns:
+            (np.ndarray):
+                The texture of shape (height, width, 3) with values between -1 and 1, as accepted by
+                Keyboard.add_key
+        """
+        content_hash = self.get_hash(key, state)
+        if content_hash in self.textures:
+            return self.textures[content_hash]
+
+        fn = None
+        if self.cache_dir is not None and (self.seed is not None or state != "grating"):
+            fn = os.path.join(self.cache_dir, f"{content_hash}.npy")
+        if fn is not None and os.path.exists(fn):
+            texture = np.load(fn)
+        else:
+            texture = to_texture(self.render(key, state))
+            if fn is not None:
+                np.save(fn, texture)
+        self.textures[content_hash] = texture
+        return texture
+
+    def get_images(self, key, states):
+        """
+        Get the textures of a key in each of a list of states.
+
+        Args:
+            key (str):
+                The name of the key, or None for no symbol
+            states (list):
+                The states of the key
+
+        Returns:
+            (list):
+                The textures of the key, one per state
+        """
+        return [self.get(key, state) for state in states]
+
+    def render(self, key, state):
+        """
+        Render the image of a key in a state.
+
+        Args:
+            key (str):
+                The name of the key, or None for no symbol
+            state (str):
+                The state (background) of the key
+
+        Returns:
+            (np.ndarray):
+                The RGB image of shape (height, width, 3) of uint8
+        """
+        g = generate_images_grating
+        if state in GRATING_STATES:
+            if self.grating is None:
+                self.grating = g.generate_grating(self.seed)
+            return np.asarray(g.render_key("space" if key is None else key, self.grating)[state])
+        elif state in COLOR_STATES:
+            if self.font is None:
+                self.font = generate_images.load_font()
+            symbol = None if key is None else g.KEY_MAPPING.get(key, key)
+            return np.asarray(generate_images.render_key(symbol, state, self.font,
+                (generate_images.bw_width, generate_images.bw_height)))
+        else:
+            raise Exception("Unknown state:", state)